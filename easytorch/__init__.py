@@ -1,5 +1,21 @@
-from .config import default_args, default_args
-from .data import ETDataset, ETDataLoader
-from .easytorch import EasyTorch
-from .metrics import ETMetrics, ETAverages, Prf1a, ConfusionMatrix
-from .trainer import ETTrainer
+r"""
+Only the configuration is loaded on import. Everything else(torch, data, trainer...) is loaded on first use.
+"""
+import importlib as _importlib
+
+from .config import default_args
+
+_lazy = {
+    'ETDataset': '.data', 'ETDataLoader': '.data',
+    'EasyTorch': '.easytorch',
+    'ETMetrics': '.metrics', 'ETAverages': '.metrics', 'Prf1a': '.metrics', 'ConfusionMatrix': '.metrics',
+    'ETTrainer': '.trainer'
+}
+
+__all__ = ['default_args', *_lazy]
+
+
+def __getattr__(name):
+    if name in _lazy:
+        return getattr(_importlib.import_module(_lazy[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -3,10 +3,10 @@ import random as _random
 from collections import OrderedDict as _ODict
 import sys as _sys
 
-import torch as _torch
-
-cuda_available = _torch.cuda.is_available()
-num_gpus = _torch.cuda.device_count()
+r"""
+cuda_available, num_gpus, and args(parsed from sys.argv) are resolved on first access.
+So that importing easytorch neither loads torch/probes CUDA, nor parses arguments.
+"""
 
 metrics_eps = 10e-5
 metrics_num_precision = 5
@@ -39,10 +39,12 @@ default_args.add_argument('-ph', '--phase', default=None, choices=['train', 'tes
 default_args.add_argument("-b", "--batch_size", default=4, type=int, help="Mini-batch size.")
 default_args.add_argument('-ep', '--epochs', default=31, type=int, help='Number of epochs.')
 default_args.add_argument('-ni', '--num_iteration', default=1, type=int,
-                          help='Number of iterations for gradient accumulation.')
+                          help='Number of micro-batches each batch is split into for gradient accumulation.')
 default_args.add_argument('-lr', '--learning_rate', default=0.001, type=float, help='Learning rate.')
-default_args.add_argument('-gpus', '--gpus', default=[0] if cuda_available else [], nargs='*', type=int, help='How many gpus to use?')
-default_args.add_argument('-pin', '--pin_memory', default=cuda_available, type=boolean_string, help='Pin Memory.')
+default_args.add_argument('-gpus', '--gpus', default=None, nargs='*', type=int,
+                          help='How many gpus to use? Default is [0] if cuda is available.')
+default_args.add_argument('-pin', '--pin_memory', default=None, type=boolean_string,
+                          help='Pin Memory. Default is True if cuda is available.')
 default_args.add_argument('-nw', '--num_workers', default=4, type=int,
                           help='Number of workers to work on data loading.')
 default_args.add_argument('-data', '--dataset_dir', default='', type=str, help='Root path to Datasets.')
@@ -59,6 +61,71 @@ default_args.add_argument('-lsp', '--load_sparse', default=False, type=boolean_s
 default_args.add_argument('-nf', '--num_folds', default=None, type=int, help='Number of folds.')
 default_args.add_argument('-spr', '--split_ratio', default=None, nargs='*', type=float,
                           help='Split ratio. Eg: 0.6 0.2 0.2 or 0.8 0.2. Exclusive to num_fold.')
+default_args.add_argument('-pf', '--parallel_folds', default=0, type=int,
+                          help='Number of folds to run at the same time in worker processes.')
+default_args.add_argument('-pft', '--fold_threads', default=None, type=int,
+                          help='Torch threads per fold worker. Default divides all cpus among the workers.')
+default_args.add_argument('-pw', '--persistent_workers', default=False, type=boolean_string,
+                          help='Keep data loader workers alive across epochs and validation passes of a fold.')
+default_args.add_argument('-prf', '--prefetch_factor', default=2, type=int,
+                          help='Batches loaded in advance by each data loader worker.')
+default_args.add_argument('-pwr', '--prediction_writers', default=2, type=int,
+                          help='Threads that save predictions in the background. 0 saves them right away.')
+default_args.add_argument('-prc', '--precision', default='fp32', type=str, choices=['fp32', 'bf16', 'fp16'],
+                          help='Mixed precision(autocast) for training and evaluation.')
+default_args.add_argument('-cpr', '--compare_precision', default=False, type=boolean_string,
+                          help='Log the training throughput of -prc/--precision against fp32 before training.')
+default_args.add_argument('-cl', '--channels_last', default=False, type=boolean_string,
+                          help='Use channels_last memory format for models and 4D inputs.')
+default_args.add_argument('-cmp', '--compile', default=False, type=boolean_string,
+                          help='Compile the models with torch.compile.')
+default_args.add_argument('-cmm', '--compile_mode', default='default', type=str,
+                          choices=['default', 'reduce-overhead', 'max-autotune', 'max-autotune-no-cudagraphs'],
+                          help='torch.compile mode.')
+default_args.add_argument('-cmd', '--compile_dynamic', default='auto', type=str, choices=['auto', 'true', 'false'],
+                          help='Compile for dynamic shapes: auto(after a shape changes), true, or false.')
+default_args.add_argument('-ccd', '--compile_cache_dir', default=None, type=str,
+                          help='Directory to cache compiled kernels. Default is the torch inductor cache directory.')
+default_args.add_argument('-csp', '--compact_splits', default=False, type=boolean_string,
+                          help='Save splits as index arrays(.npz) against one list of files instead of json file lists.')
+default_args.add_argument('-mfd', '--manifest_dir', default=None, type=str,
+                          help='Directory of the cached listings of data_dir. Default is <log_dir>/manifests.')
+default_args.add_argument('-bal', '--balanced_sampling', default='none', type=str,
+                          choices=['none', 'weighted', 'stratified'],
+                          help='Sample training batches balanced by the classes in ETDataset.labels().')
+default_args.add_argument('-pmr', '--pool_mix_ratio', default=None, nargs='*', type=float,
+                          help='Share of each dataspec in the training batches of run_pooled. Eg: 1 1 for half each.')
+default_args.add_argument('-pmw', '--pool_with_replacement', default=False, type=boolean_string,
+                          help='Draw pooled training data with replacement(see -pmr/--pool_mix_ratio).')
+default_args.add_argument('-inm', '--in_memory', default=False, type=boolean_string,
+                          help='Load all samples of each dataset once into tensors, and slice batches from them.')
+default_args.add_argument('-cix', '--compact_indices', default=False, type=boolean_string,
+                          help='Keep dataset indices in a compact IndexStore(numeric coords only) instead of a list.')
+default_args.add_argument('-icm', '--image_cache_mb', default=0, type=float,
+                          help='Budget(in MB) of the decoded image cache shared by all data loader workers. 0 disables.')
+default_args.add_argument('-acp', '--async_checkpoint', default=True, type=boolean_string,
+                          help='Write checkpoints from a background thread.')
+default_args.add_argument('-rsm', '--resume', default=False, type=boolean_string,
+                          help='Periodically save full training state, and resume interrupted folds from it.')
+default_args.add_argument('-sfq', '--state_freq', default=1, type=int,
+                          help='Save full training state every given number of epochs if resume is set.')
+default_args.add_argument('-pint', '--plot_interval', default=10, type=float,
+                          help='Minimum seconds between re-drawing progress plots(Drawn in a background process).')
+default_args.add_argument('-ws', '--world_size', default=1, type=int,
+                          help='Number of processes for DistributedDataParallel training.')
+default_args.add_argument('-dbe', '--dist_backend', default='gloo', type=str,
+                          help='Backend for DistributedDataParallel. gloo works on CPUs.')
+default_args.add_argument('-du', '--dist_url', default='tcp://127.0.0.1:29500', type=str,
+                          help='Rendezvous address for the ranks spawned by easytorch.')
+
 
-_known, _unknown = default_args.parse_known_args()
-args = vars(_known)
+def __getattr__(name):
+    if name in ['cuda_available', 'num_gpus']:
+        import torch as _torch
+        globals().update(cuda_available=_torch.cuda.is_available(), num_gpus=_torch.cuda.device_count())
+    elif name == 'args':
+        _known, _unknown = default_args.parse_known_args()
+        globals()['args'] = vars(_known)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return globals()[name]
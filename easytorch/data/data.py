@@ -1,19 +1,34 @@
+import atexit as _atexit
+import copy as _copy
+import itertools as _itertools
 import json as _json
+import mmap as _mmap
 import os as _os
+import threading as _threading
+from collections import OrderedDict as _ODict, deque as _deque
+from multiprocessing import resource_tracker as _resource_tracker
+from multiprocessing import shared_memory as _shm
+from multiprocessing.managers import BaseManager as _BaseManager
+
 import numpy as _np
 
 import torch as _torch
-from torch.utils.data import DataLoader as _DataLoader, Dataset as _Dataset
+from torch.utils.data import DataLoader as _DataLoader, Dataset as _Dataset, Sampler as _Sampler
+from torch.utils.data.distributed import DistributedSampler as _DistributedSampler
 from torch.utils.data._utils.collate import default_collate as _default_collate
 import easytorch.config as _conf
+import easytorch.utils.distributed as _dist_utils
+from easytorch.data import datautils as _datautils
 from easytorch.utils.logger import *
 
 
 def safe_collate(batch):
     r"""
     Savely select batches/skip errors in file loading.
+    A batch with no loadable items is None(skipped by the trainer), so the positions of the batches stay the same.
     """
-    return _default_collate([b for b in batch if b])
+    batch = [b for b in batch if b]
+    return _default_collate(batch) if batch else None
 
 
 def seed_worker(worker_id):
@@ -28,6 +43,17 @@ class ETDataLoader(_DataLoader):
 
     @classmethod
     def new(cls, **kw):
+        r"""
+        In distributed runs, each rank only loads its own part of the dataset using a DistributedSampler.
+        Pass distributed=False to load everything in each rank(For example, to save predictions).
+        A batch_sampler(like GroupedBatchSampler) replaces batch_size, shuffle, sampler, and drop_last.
+        persistent_workers, prefetch_factor only apply with num_workers > 0.
+        balanced_sampling='weighted', or 'stratified' replaces shuffle with a ClassBalancedSampler, or
+         StratifiedBatchSampler built from dataset.labels().
+        pool_mix_ratio, or pool_with_replacement replaces shuffle of a pooled dataset(with indices of many
+         datasets, see ETDataset.pool()) with an InterleavedSampler.
+        Datasets with in_memory=True get an InMemoryLoader instead.
+        """
         _kw = {
             'dataset': None,
             'batch_size': 1,
@@ -38,19 +64,856 @@ class ETDataLoader(_DataLoader):
             'pin_memory': False,
             'drop_last': False,
             'timeout': 0,
-            'worker_init_fn': seed_worker if kw.get('seed_all') else None
+            'worker_init_fn': seed_worker if kw.get('seed_all') else None,
+            'persistent_workers': False,
+            'prefetch_factor': 2
         }
         for k in _kw.keys():
             _kw[k] = kw.get(k, _kw.get(k))
+
+        if not _kw['num_workers']:
+            """
+            torch < 2.0 does not take prefetch_factor=None, and with no workers it has nothing to prefetch anyway.
+            """
+            _kw.pop('prefetch_factor')
+            _kw['persistent_workers'] = False
+
+        balance = kw.get('balanced_sampling') or 'none'
+        if balance != 'none' and _kw['shuffle'] and _kw['sampler'] is None and _kw['batch_sampler'] is None:
+            labels = _kw['dataset'].labels()
+            if labels is None:
+                raise ValueError(f'{type(_kw["dataset"]).__name__}.labels() must be implemented for balanced sampling.')
+
+            distributed = _dist_utils.is_distributed() and kw.get('distributed', True)
+            if balance == 'weighted':
+                _kw['sampler'] = ClassBalancedSampler(labels, seed=kw.get('seed', 0), distributed=distributed)
+            else:
+                _kw['batch_sampler'] = StratifiedBatchSampler(labels, _kw['batch_size'], seed=kw.get('seed', 0),
+                                                              distributed=distributed)
+            _kw['shuffle'] = False
+
+        elif (kw.get('pool_mix_ratio') or kw.get('pool_with_replacement')) and _kw['shuffle'] \
+                and _kw['sampler'] is None and _kw['batch_sampler'] is None \
+                and len(getattr(_kw['dataset'], 'dataspecs', {})) > 1:
+            _kw['sampler'] = InterleavedSampler.of_pool(
+                _kw['dataset'], ratios=kw.get('pool_mix_ratio'), replacement=kw.get('pool_with_replacement', False),
+                seed=kw.get('seed', 0), distributed=_dist_utils.is_distributed() and kw.get('distributed', True))
+            _kw['shuffle'] = False
+
+        if _kw['batch_sampler'] is not None:
+            _kw.update(batch_size=1, shuffle=False, sampler=None, drop_last=False)
+
+        if _dist_utils.is_distributed() and kw.get('distributed', True) \
+                and _kw['sampler'] is None and _kw['batch_sampler'] is None:
+            """
+            Evaluation must see each sample exactly once over all the ranks, but DistributedSampler pads
+             the dataset with repeated samples(so that training ranks take equal steps).
+            """
+            if kw.get('mode') == 'eval' and not _kw['shuffle']:
+                _kw['sampler'] = ShardSampler(len(_kw['dataset']))
+            else:
+                _kw['sampler'] = _DistributedSampler(_kw['dataset'], shuffle=_kw['shuffle'])
+            _kw['shuffle'] = False
+
+        if getattr(_kw['dataset'], 'in_memory', False):
+            return InMemoryLoader(**_kw)
         return cls(collate_fn=safe_collate, **_kw)
 
 
+class _Indexed(_Dataset):
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, index):
+        return index, self.dataset[index]
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def _indexed_collate(batch):
+    r"""
+    Like safe_collate, but also gives the indices of the items that loaded.
+    """
+    batch = [(i, b) for i, b in batch if b]
+    return _torch.as_tensor([i for i, _ in batch], dtype=_torch.int64), \
+        _default_collate([b for _, b in batch]) if batch else None
+
+
+def _is_batch_list(obj):
+    r"""
+    default_collate leaves strings(like file names) as a list with an item per sample.
+    """
+    return isinstance(obj, list) and len(obj) > 0 and isinstance(obj[0], str)
+
+
+def _alloc(batch, n, pin_memory=False):
+    if isinstance(batch, _torch.Tensor):
+        return _torch.empty((n, *batch.shape[1:]), dtype=batch.dtype, pin_memory=pin_memory)
+    if isinstance(batch, dict):
+        return {k: _alloc(v, n, pin_memory) for k, v in batch.items()}
+    if _is_batch_list(batch):
+        return []
+    if isinstance(batch, (list, tuple)):
+        return [_alloc(v, n, pin_memory) for v in batch]
+    raise TypeError(f'Cannot keep {type(batch).__name__} in memory.')
+
+
+def _fill(store, batch, start):
+    if isinstance(store, _torch.Tensor):
+        store[start:start + len(batch)].copy_(batch)
+    elif isinstance(store, dict):
+        for k in store:
+            _fill(store[k], batch[k], start)
+    elif _is_batch_list(batch):
+        store.extend(batch)
+    else:
+        for s, b in zip(store, batch):
+            _fill(s, b, start)
+
+
+def _take(store, ix):
+    r"""
+    Batch of the samples at ix(a slice, or an index tensor) of the materialized store.
+    """
+    if isinstance(store, _torch.Tensor):
+        return store[ix] if isinstance(ix, slice) else store.index_select(0, ix)
+    if isinstance(store, dict):
+        return {k: _take(v, ix) for k, v in store.items()}
+    if store and isinstance(store[0], str):
+        return store[ix] if isinstance(ix, slice) else [store[i] for i in ix.tolist()]
+    return [_take(v, ix) for v in store]
+
+
+class InMemoryLoader:
+    def __init__(self, dataset=None, batch_size=1, sampler=None, shuffle=False, batch_sampler=None, num_workers=0,
+                 pin_memory=False, drop_last=False, worker_init_fn=None, **kw):
+        r"""
+        Batches sliced(or index_select-ed, when shuffled) from the samples of an in memory dataset, without
+         __getitem__, collate, or worker processes. See ETDataset.materialize(), which is done here if not yet.
+        Takes the same arguments, samplers, and batch samplers as ETDataLoader.
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.sampler = sampler
+        self.shuffle = shuffle
+        self.batch_sampler = batch_sampler
+        self.drop_last = drop_last
+        if dataset.tensors is None:
+            dataset.materialize(num_workers=num_workers, pin_memory=pin_memory and _torch.cuda.is_available(),
+                                worker_init_fn=worker_init_fn)
+
+    def _indices(self):
+        if self.batch_sampler is not None:
+            for batch in self.batch_sampler:
+                yield _torch.as_tensor(batch, dtype=_torch.int64)
+            return
+
+        if self.sampler is not None:
+            """
+            Taken batch by batch, so samplers that draw lazily(like InterleavedSampler) are not listed in full.
+            """
+            samples = iter(self.sampler)
+            while True:
+                batch = list(_itertools.islice(samples, self.batch_size))
+                if not batch or (self.drop_last and len(batch) < self.batch_size):
+                    return
+                yield _torch.as_tensor(batch, dtype=_torch.int64)
+
+        if self.shuffle:
+            """
+            Same order as the RandomSampler of a DataLoader, given the same torch random state.
+            """
+            generator = _torch.Generator()
+            generator.manual_seed(int(_torch.empty((), dtype=_torch.int64).random_().item()))
+            ix = _torch.randperm(len(self.dataset), generator=generator)
+        else:
+            ix = _torch.arange(len(self.dataset))
+        for i in range(0, len(ix), self.batch_size):
+            if not self.drop_last or i + self.batch_size <= len(ix):
+                yield ix[i:i + self.batch_size]
+
+    def __iter__(self):
+        for ix in self._indices():
+            if self.dataset.positions is not None:
+                ix = self.dataset.positions[ix]
+                ix = ix[ix >= 0]
+            if len(ix) == 0:
+                """
+                None like safe_collate, so batch positions(like GroupedBatchSampler.group_ends) stay in line.
+                """
+                yield None
+                continue
+
+            """
+            Consecutive samples(like in evaluation) are just a view.
+            """
+            if ix[-1] - ix[0] == len(ix) - 1 and bool((ix[1:] - ix[:-1] == 1).all()):
+                ix = slice(int(ix[0]), int(ix[-1]) + 1)
+            yield _take(self.dataset.tensors, ix)
+
+    def __len__(self):
+        if self.batch_sampler is not None:
+            return len(self.batch_sampler)
+        n = len(self.sampler) if self.sampler is not None else len(self.dataset)
+        return n // self.batch_size if self.drop_last else -(-n // self.batch_size)
+
+
+class ShardSampler(_Sampler):
+    def __init__(self, num_samples, rank=None, world_size=None):
+        r"""
+        Contiguous, not padded, shard of range(num_samples) for each rank: the first num_samples % world_size ranks
+         get one more sample. Used for distributed evaluation, so that reduced scores count each sample once.
+        """
+        self.rank = _dist_utils.get_rank() if rank is None else rank
+        self.world_size = _dist_utils.get_world_size() if world_size is None else world_size
+        size, extra = divmod(num_samples, self.world_size)
+        self.start = self.rank * size + min(self.rank, extra)
+        self.end = self.start + size + (self.rank < extra)
+
+    def __iter__(self):
+        return iter(range(self.start, self.end))
+
+    def __len__(self):
+        return self.end - self.start
+
+
+class GroupedBatchSampler(_Sampler):
+    def __init__(self, groups, batch_size=1):
+        r"""
+        Batches that never mix indices of two groups(like patches of two images in ETDataset.groups).
+        group_ends maps the position of the last batch of each group to that group.
+        """
+        self.groups = groups
+        self.batch_size = batch_size
+        self.batches = []
+        self.group_ends = {}
+        for g, (start, end) in enumerate(groups):
+            for i in range(start, end, batch_size):
+                self.batches.append(range(i, min(i + batch_size, end)))
+            if end > start:
+                self.group_ends[len(self.batches) - 1] = g
+
+    def __iter__(self):
+        for batch in self.batches:
+            yield list(batch)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class _ClassSampler(_Sampler):
+    def __init__(self, labels, distributed=False):
+        r"""
+        Indices sorted by class(order[starts[c]:starts[c] + counts[c]] are of class c), and the rank of this process.
+        """
+        ids, n = _datautils.class_ids(labels)
+        self.size = len(ids)
+        self.order = _np.argsort(ids, kind='stable')
+        self.counts = _np.bincount(ids, minlength=n)
+        self.starts = _np.cumsum(self.counts) - self.counts
+        self.classes = _np.flatnonzero(self.counts)
+        self.rank, self.world_size = 0, 1
+        if distributed:
+            self.rank, self.world_size = _dist_utils.get_rank(), _dist_utils.get_world_size()
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+
+class ClassBalancedSampler(_ClassSampler):
+    def __init__(self, labels, num_samples=None, seed=0, distributed=False):
+        r"""
+        Draws num_samples(Default len(labels), split among the ranks) indices with replacement so that each class
+         is equally likely. Same as a WeightedRandomSampler with datautils.balanced_weights(labels), but drawn as
+         numpy arrays(a class, then an item of it) without the 2^24 items limit of torch.multinomial.
+        Like DistributedSampler, set_epoch() must be called every epoch to draw new indices.
+        """
+        super().__init__(labels, distributed)
+        self.num_samples = -(-(num_samples or self.size) // self.world_size)
+        self.seed = seed
+
+    def __iter__(self):
+        rng = _np.random.default_rng([self.seed, self.epoch, self.rank])
+        c = self.classes[rng.integers(len(self.classes), size=self.num_samples)]
+        ix = self.starts[c] + (rng.random(self.num_samples) * self.counts[c]).astype(_np.int64)
+        return iter(self.order[ix].tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+class StratifiedBatchSampler(_ClassSampler):
+    def __init__(self, labels, batch_size, num_batches=None, seed=0, distributed=False):
+        r"""
+        Batches with (almost) the same number of items of each class. The items of each class are shuffled every
+         epoch and cycled through, so the small classes are repeated and the large ones sub-sampled.
+        num_batches(Default len(labels) // batch_size, like one epoch) are split among the ranks.
+        Like DistributedSampler, set_epoch() must be called every epoch to draw new batches.
+        """
+        super().__init__(labels, distributed)
+        self.batch_size = batch_size
+        self.num_batches = max((num_batches or self.size // batch_size) // self.world_size, 1)
+        self.seed = seed
+
+    def __iter__(self):
+        rng = _np.random.default_rng([self.seed, self.epoch])
+        n = self.num_batches * self.world_size
+
+        """
+        Class of each slot, rotated by one every batch so the extra slots(if batch_size % classes > 0) go round.
+        """
+        slots = ((_np.arange(self.batch_size)[None, :] + _np.arange(n)[:, None]) % len(self.classes)).ravel()
+        slots = slots.astype(_np.min_scalar_type(len(self.classes)))  # Small ints are radix sorted
+        by_class = _np.argsort(slots, kind='stable')
+        counts = _np.bincount(slots, minlength=len(self.classes))
+        batches = _np.empty(len(slots), dtype=_np.int64)
+        for k, (c, start) in enumerate(zip(self.classes, _np.cumsum(counts) - counts)):
+            items = self.order[self.starts[c] + rng.permutation(self.counts[c])]
+            batches[by_class[start:start + counts[k]]] = _np.resize(items, counts[k])
+
+        batches = rng.permuted(batches.reshape(n, self.batch_size), axis=1)
+        for batch in batches[self.rank::self.world_size]:
+            yield batch.tolist()
+
+    def __len__(self):
+        return self.num_batches
+
+
+def _lazy_permutation(i, n, key):
+    r"""
+    Items at positions i(an array) of a random permutation of range(n) given by key, without materializing it.
+    A 4 round Feistel network permutes the smallest 2^(2h) >= n, and the values >= n are permuted again
+     until they are in range(cycle walking), which takes less than 4 rounds on average.
+    """
+    half = _np.uint64(max((int(n - 1).bit_length() + 1) // 2, 1))
+    mask = (_np.uint64(1) << half) - _np.uint64(1)
+    keys = _np.random.default_rng(key).integers(0, 2 ** 63, size=4, dtype=_np.uint64)
+
+    def _permute(x):
+        left, right = x >> half, x & mask
+        for k in keys:
+            f = ((right ^ k) * _np.uint64(0x9E3779B97F4A7C15)) >> (_np.uint64(64) - half)
+            left, right = right, left ^ (f & mask)
+        return (left << half) | right
+
+    x = _permute(_np.asarray(i, dtype=_np.uint64))
+    out = x >= n
+    while out.any():
+        x[out] = _permute(x[out])
+        out[out] = x[out] >= n
+    return x.astype(_np.int64)
+
+
+class InterleavedSampler(_Sampler):
+    def __init__(self, sizes, ratios=None, num_samples=None, replacement=False, seed=0, distributed=False,
+                 chunk_size=4096):
+        r"""
+        Interleaves datasets stored one after another(sizes[0] indices, then sizes[1]...) in a random order, where
+         dataset d gives ratios[d] share of the indices in each epoch(Default proportional to sizes, so that without
+         replacement it is the same as plain shuffling).
+        Without replacement, each dataset is gone through in a random order(_lazy_permutation), and started over in a
+         new order once done. So a small dataset is repeated instead of drowned out, and a large one sub-sampled.
+        Indices are generated chunk_size at a time, so memory does not grow with num_samples(Default sum(sizes),
+         split among the ranks) or the sizes. Like DistributedSampler, set_epoch() must be called every epoch.
+        """
+        self.sizes = _np.asarray(sizes, dtype=_np.int64)
+        self.starts = _np.cumsum(self.sizes) - self.sizes
+        ratios = _np.asarray(self.sizes if ratios is None else ratios, dtype=_np.float64)
+        if len(ratios) != len(self.sizes):
+            raise ValueError(f'{len(ratios)} mixing ratios given for {len(self.sizes)} datasets.')
+        ratios = _np.where(self.sizes > 0, ratios, 0)
+        self.p = ratios / ratios.sum()
+
+        self.replacement = replacement
+        self.seed, self.epoch = seed, 0
+        self.rank, self.world_size = 0, 1
+        if distributed:
+            self.rank, self.world_size = _dist_utils.get_rank(), _dist_utils.get_world_size()
+        self.num_samples = -(-(num_samples or int(self.sizes.sum())) // self.world_size)
+        self.chunk_size = chunk_size * self.world_size
+
+    @classmethod
+    def of_pool(cls, dataset, **kw):
+        r"""
+        Sampler of a pooled ETDataset, whose indices are added one dataset after another.
+        """
+        if isinstance(dataset.indices, IndexStore):
+            ids, num_datasets = dataset.indices.dataset_ids, len(dataset.indices.names)
+        else:
+            names = {}
+            ids = _np.fromiter((names.setdefault(ix[0], len(names)) for ix in dataset.indices), dtype=_np.int64,
+                               count=len(dataset.indices))
+            num_datasets = len(names)
+        if _np.any(ids[1:] < ids[:-1]):
+            raise ValueError('Indices of each pooled dataset must be together.')
+        return cls(_np.bincount(ids, minlength=num_datasets), **kw)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _local(self, rng, d, pos):
+        if self.replacement:
+            return rng.integers(self.sizes[d], size=len(pos))
+
+        local = _np.empty(len(pos), dtype=_np.int64)
+        rounds = pos // self.sizes[d]
+        for r in _np.unique(rounds):
+            at = rounds == r
+            local[at] = _lazy_permutation(pos[at] % self.sizes[d], self.sizes[d], [self.seed, self.epoch, d, r])
+        return local
+
+    def __iter__(self):
+        rng = _np.random.default_rng([self.seed, self.epoch])
+        drawn = _np.zeros(len(self.sizes), dtype=_np.int64)
+        total = self.num_samples * self.world_size
+
+        """
+        Exact share of each dataset in this epoch(largest remainders get the rounding), handed out to the chunks
+         by drawing without replacement from what is left, which is a random interleaving of all of them.
+        """
+        left = _np.floor(total * self.p).astype(_np.int64)
+        left[_np.argsort(_np.floor(total * self.p) - total * self.p)[:total - left.sum()]] += 1
+        for step in range(0, total, self.chunk_size):
+            counts = rng.multivariate_hypergeometric(left, min(self.chunk_size, total - step))
+            left -= counts
+            choice = rng.permutation(_np.repeat(_np.arange(len(counts)), counts))
+            ix = _np.empty(len(choice), dtype=_np.int64)
+            for d, count in enumerate(counts):
+                if count > 0:
+                    at = choice == d
+                    ix[at] = self.starts[d] + self._local(rng, d, drawn[d] + _np.arange(count))
+                    drawn[d] += count
+            yield from ix[self.rank::self.world_size].tolist()
+
+    def __len__(self):
+        return self.num_samples
+
+
+class ShardReader:
+    def __init__(self, shard_dir):
+        r"""
+        Random access to the records packed by easytorch.data.datautils.pack_shards().
+        Shards are memory mapped on first access in each process, and records are returned as
+         zero copy memoryviews. Eg: np.frombuffer(reader[file], dtype=np.uint8), or PIL.Image.open(io.BytesIO(...)).
+        """
+        self.shard_dir = shard_dir
+        with open(shard_dir + _os.sep + 'index.json') as f:
+            index = _json.loads(f.read())
+        self.shards = index['shards']
+        self.records = index['records']
+        self._maps = {}
+
+    def _map(self, shard):
+        if shard not in self._maps:
+            with open(self.shard_dir + _os.sep + self.shards[shard], 'rb') as f:
+                self._maps[shard] = memoryview(_mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ))
+        return self._maps[shard]
+
+    def __getitem__(self, file):
+        shard, offset, length = self.records[file]
+        return self._map(shard)[offset:offset + length]
+
+    def __contains__(self, file):
+        return file in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getstate__(self):
+        r"""
+        Memory maps are not sent to data loader workers. Each worker maps the shards itself.
+        """
+        return {**self.__dict__, '_maps': {}}
+
+
+_shard_readers = {}
+
+
+def shard_reader(shard_dir):
+    r"""
+    One reader(and index) for each shard_dir, shared by all the datasets(Eg. sparse datasets of each test file).
+    """
+    if shard_dir not in _shard_readers:
+        _shard_readers[shard_dir] = ShardReader(shard_dir)
+    return _shard_readers[shard_dir]
+
+
+class _CacheIndex:
+    def __init__(self, max_bytes):
+        r"""
+        Book keeping of SharedArrayCache. Lives in the manager process, so every call is a single atomic round trip.
+        """
+        self.max_bytes = max_bytes
+        self.entries = _ODict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self.evicted = _deque(maxlen=4096)
+        self._lock = _threading.Lock()
+
+    def get(self, key):
+        r"""
+        Returns the entry of key(None if not cached), and the generation(number of evictions so far).
+        """
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return entry, self.generation
+
+    def evicted_since(self, generation):
+        r"""
+        Names of the blocks evicted after the given generation, or None if they are no longer all remembered.
+        """
+        with self._lock:
+            if self.generation - generation > len(self.evicted):
+                return None
+            return list(self.evicted)[len(self.evicted) - (self.generation - generation):]
+
+    def _evict(self):
+        evicted = []
+        while self.bytes > self.max_bytes:
+            _, (old, _, _, old_nbytes) = self.entries.popitem(last=False)
+            self.bytes -= old_nbytes
+            self.evicted.append(old)
+            self.generation += 1
+            evicted.append(old)
+        return evicted
+
+    def put(self, key, entry):
+        r"""
+        Returns the names of shared memory blocks to free: the least recently used ones evicted to fit the new one
+         in the budget, or the new one itself if it is already cached or too large.
+        """
+        name, shape, dtype, nbytes = entry
+        with self._lock:
+            if key in self.entries or nbytes > self.max_bytes:
+                return [name]
+            self.entries[key] = entry
+            self.bytes += nbytes
+            return self._evict()
+
+    def resize(self, max_bytes):
+        r"""
+        Change the budget. Returns the names of the blocks evicted to fit in it.
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            return self._evict()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': round(self.hits / max(self.hits + self.misses, 1), 5),
+                    'entries': len(self.entries), 'bytes': self.bytes}
+
+    def clear(self):
+        with self._lock:
+            names = [e[0] for e in self.entries.values()]
+            self.entries.clear()
+            self.bytes = 0
+            return names
+
+
+class _CacheManager(_BaseManager):
+    pass
+
+
+_CacheManager.register('CacheIndex', _CacheIndex)
+
+
+class SharedArrayCache:
+    def __init__(self, max_bytes, max_handles=256):
+        r"""
+        LRU cache of numpy arrays(like decoded images) in shared memory, with a total budget of max_bytes.
+        It is sent along with the dataset to all data loader workers, so an array decoded by one of them is
+         reused by all the others, in all epochs, instead of each worker decoding it again.
+        Arrays from get() are read only views of the shared memory.
+        Each process detaches the blocks evicted by any process(as seen from the generation of the index) on its
+         next get(), so the memory of evicted arrays is given back once no array of this process uses it.
+        @param max_handles: Shared memory blocks(open files) kept attached in each process. Attached blocks are
+         also kept within max_bytes.
+        """
+        self.max_bytes = max_bytes
+        self.max_handles = max_handles
+        self._manager = _CacheManager()
+        self._manager.start()
+        self._index = self._manager.CacheIndex(max_bytes)
+        self._handles = _ODict()
+        self._generation = 0
+        """
+        Workers must share the resource tracker of this process.
+        Else each one starts its own, that unlinks the arrays it cached when the worker exits.
+        """
+        _resource_tracker.ensure_running()
+
+    def __getstate__(self):
+        return {**self.__dict__, '_manager': None, '_handles': _ODict()}
+
+    def _detach(self, names):
+        for name in names:
+            try:
+                self._handles[name].close()
+                del self._handles[name]
+            except BufferError:
+                """
+                Still in use by some array in this process.
+                """
+                pass
+
+    def _sync(self, generation):
+        r"""
+        Detach the blocks evicted since the last seen generation.
+        """
+        if generation != self._generation:
+            names = self._index.evicted_since(self._generation)
+            self._detach([n for n in (self._handles if names is None else names) if n in self._handles])
+            self._generation = generation
+
+    def _attach(self, name):
+        shm = self._handles.pop(name, None) or _shm.SharedMemory(name=name)
+        self._handles[name] = shm
+        size, excess = 0, []
+        for i, old in enumerate(reversed(self._handles)):
+            size += self._handles[old].size
+            if i and (size > self.max_bytes or i >= self.max_handles):
+                excess.append(old)
+        self._detach(excess)
+        return shm
+
+    def _free(self, names):
+        for name in names:
+            shm = self._handles.pop(name, None)
+            try:
+                shm = shm or _shm.SharedMemory(name=name)
+                shm.unlink()
+                shm.close()
+            except (FileNotFoundError, BufferError):
+                pass
+
+    def get(self, key):
+        entry, generation = self._index.get(key)
+        self._sync(generation)
+        if entry is None:
+            return None
+        name, shape, dtype, _ = entry
+        try:
+            shm = self._attach(name)
+        except FileNotFoundError:
+            return None
+        arr = _np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        arr.flags.writeable = False
+        return arr
+
+    def put(self, key, arr):
+        arr = _np.ascontiguousarray(arr)
+        if arr.nbytes == 0 or arr.nbytes > self.max_bytes:
+            return arr
+        shm = _shm.SharedMemory(create=True, size=arr.nbytes)
+        _np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        self._handles[shm.name] = shm
+        self._free(self._index.put(key, (shm.name, arr.shape, arr.dtype.str, arr.nbytes)))
+        return arr
+
+    def stats(self):
+        r"""
+        Hits, misses, hit rate, number of arrays, and bytes used, over all the processes.
+        """
+        return self._index.stats()
+
+    def resize(self, max_bytes):
+        r"""
+        Change the budget of the cache(in all processes), evicting the least recently used arrays to fit in it.
+        """
+        self.max_bytes = max_bytes
+        self._free(self._index.resize(max_bytes))
+
+    def clear(self):
+        self._free(self._index.clear())
+
+
+_array_cache = None
+
+
+def shared_array_cache(max_bytes):
+    r"""
+    A single SharedArrayCache used by all the datasets. Its shared memory is freed when the main process exits.
+    Asking for it with another max_bytes resizes it.
+    """
+    global _array_cache
+    if _array_cache is None:
+        _array_cache = SharedArrayCache(max_bytes)
+        _atexit.register(_array_cache.clear)
+    elif _array_cache.max_bytes != max_bytes:
+        _array_cache.resize(max_bytes)
+    return _array_cache
+
+
+class IndexStore:
+    def __init__(self):
+        r"""
+        Compact store of dataset indices, used as ETDataset.indices in place of the list of lists
+         with -cix/--compact_indices(or by setting self.indices = IndexStore() in a dataset).
+        Dataset names and files are interned to int32 ids and the rest of each index(like patch coordinates)
+         go to one numeric array, so millions of indices take a few bytes each and are sent to the data loader
+         workers as a handful of arrays(or just a path after save(), as the loaded store is memory mapped).
+        It reads like the list: self.indices.append([dataset_name, file, *coords]) and
+         dataset_name, file, *coords = self.indices[i]. But all indices must have the same number of numeric coords,
+         and it can not be shuffled, or changed in place.
+        """
+        self.names, self._name_ids = [], {}
+        self.files, self._file_ids = [], {}
+        self._ids = _np.zeros((0, 2), dtype=_np.int32)
+        self._coords = _np.zeros((0, 0), dtype=_np.int64)
+        self._size = 0
+        self._path = None
+
+    @staticmethod
+    def _intern(value, values, ids):
+        i = ids.get(value)
+        if i is None:
+            i = ids[value] = len(values)
+            values.append(value)
+        return i
+
+    def _reserve(self, n, coords):
+        if self._path is not None:
+            raise RuntimeError(f'{self._path} is loaded read only.')
+
+        if self._size == 0 and self._coords.shape[1] != coords.shape[1]:
+            self._coords = _np.zeros((0, coords.shape[1]), dtype=self._coords.dtype)
+        if coords.shape[1] != self._coords.shape[1]:
+            raise ValueError(f'All indices must have {self._coords.shape[1]} coords, got {coords.shape[1]}.')
+
+        if coords.dtype.kind == 'f' and self._coords.dtype.kind != 'f':
+            self._coords = self._coords.astype(_np.float64)
+        elif coords.dtype.kind not in 'biuf':
+            raise ValueError('Only numbers can be stored after dataset_name and file. Use a list for other indices.')
+
+        if self._size + n > len(self._ids):
+            capacity = max(2 * len(self._ids), self._size + n, 1024)
+            self._ids = _np.resize(self._ids, (capacity, 2))
+            self._coords = _np.resize(self._coords, (capacity, self._coords.shape[1]))
+
+    def append(self, index):
+        self.extend(index[0], [index[1]], [index[2:]])
+
+    def extend(self, dataset_name, files, coords=None):
+        r"""
+        Add many indices of a dataset at once.
+        @param files: A list of files, or a single file that all the coords belong to(like all patches of an image).
+        @param coords: Array like of shape (number of indices, number of coords). Default is no coords.
+        """
+        single = isinstance(files, str)
+        n = len(coords) if single else len(files)
+        if n == 0:
+            return
+        coords = _np.asarray([] if coords is None else coords)
+        coords = _np.zeros((n, 0), dtype=_np.int64) if coords.size == 0 else coords.reshape(n, -1)
+        self._reserve(n, coords)
+
+        rows = slice(self._size, self._size + n)
+        self._ids[rows, 0] = self._intern(dataset_name, self.names, self._name_ids)
+        if single:
+            self._ids[rows, 1] = self._intern(files, self.files, self._file_ids)
+        else:
+            self._ids[rows, 1] = [self._intern(f, self.files, self._file_ids) for f in files]
+        self._coords[rows] = coords
+        self._size += n
+
+    @property
+    def dataset_ids(self):
+        return self._ids[:self._size, 0]
+
+    @property
+    def file_ids(self):
+        return self._ids[:self._size, 1]
+
+    @property
+    def coords(self):
+        return self._coords[:self._size]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            store = _copy.copy(self)
+            store._ids, store._coords = self._ids[:self._size][index].copy(), self.coords[index].copy()
+            store._size, store._path = len(store._ids), None
+            return store
+
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError(f'Index {index} out of range for {self._size} indices.')
+        d, f = self._ids[index]
+        return [self.names[d], self.files[f], *self._coords[index].tolist()]
+
+    def __iter__(self):
+        for i in range(self._size):
+            yield self[i]
+
+    def __len__(self):
+        return self._size
+
+    def save(self, path):
+        r"""
+        Save to a directory, that load() memory maps.
+        """
+        _os.makedirs(path, exist_ok=True)
+        _np.save(path + _os.sep + 'ids.npy', self._ids[:self._size])
+        _np.save(path + _os.sep + 'coords.npy', self.coords)
+        with open(path + _os.sep + 'names.json', 'w') as f:
+            f.write(_json.dumps({'names': self.names, 'files': self.files}))
+
+    @classmethod
+    def load(cls, path):
+        store = cls()
+        with open(path + _os.sep + 'names.json') as f:
+            names = _json.loads(f.read())
+        store.names, store.files = names['names'], names['files']
+        store._name_ids = {n: i for i, n in enumerate(store.names)}
+        store._file_ids = {n: i for i, n in enumerate(store.files)}
+        store._ids = _np.load(path + _os.sep + 'ids.npy', mmap_mode='r')
+        store._coords = _np.load(path + _os.sep + 'coords.npy', mmap_mode='r')
+        store._size = len(store._ids)
+        store._path = path
+        return store
+
+    def __getstate__(self):
+        if self._path is not None:
+            return {'_path': self._path}
+        state = {**self.__dict__, '_name_ids': None, '_file_ids': None}
+        state['_ids'], state['_coords'] = self._ids[:self._size], self.coords
+        return state
+
+    def __setstate__(self, state):
+        if '_ids' not in state:
+            self.__dict__.update(IndexStore.load(state['_path']).__dict__)
+            return
+        self.__dict__.update(state)
+        self._name_ids = {n: i for i, n in enumerate(self.names)}
+        self._file_ids = {n: i for i, n in enumerate(self.files)}
+
+
 class ETDataset(_Dataset):
     def __init__(self, mode='init', limit=_conf.data_load_limit, **kw):
         self.mode = mode
         self.limit = limit
         self.dataspecs = {}
-        self.indices = []
+        self.indices = IndexStore() if kw.get('compact_indices') else []
+        self.shards = {}
+        self.groups = []
+        self.array_cache = None
+        self.in_memory = kw.get('in_memory', False)
+        self.tensors = None
+        self.positions = None
+        if kw.get('image_cache_mb'):
+            self.array_cache = shared_array_cache(int(kw['image_cache_mb'] * 2 ** 20))
 
     def load_index(self, dataset_name, file):
         r"""
@@ -64,6 +927,10 @@ class ETDataset(_Dataset):
         We load the proper indices/names(whatever is called) of the files in order to prepare minibatches.
         Only load lim numbr of files so that it is easer to debug(Default is infinite, -lim/--load-lim argument).
         """
+        if type(self).load_index is ETDataset.load_index and isinstance(self.indices, IndexStore):
+            self.indices.extend(dataset_name, list(files)[:max(self.limit - len(self), 0)])
+            files = []
+
         for file in files:
             if len(self) >= self.limit:
                 break
@@ -85,36 +952,125 @@ class ETDataset(_Dataset):
     def transforms(self, **kw):
         return None
 
+    def materialize(self, num_workers=0, batch_size=256, pin_memory=False, worker_init_fn=None):
+        r"""
+        Load all the samples once(with num_workers data loader workers) into contiguous tensors in self.tensors,
+         shaped like a batch of all of them. Items that fail to load(see safe_collate) are left out, and
+         self.positions then maps each index to its position in self.tensors(-1 if left out).
+        Datasets with in_memory=True(-inm/--in_memory) are materialized by their data loader. As __getitem__ runs
+         only once, random augmentations must then be done on the batches(like in iteration()).
+        """
+        loader = _DataLoader(_Indexed(self), batch_size=batch_size, num_workers=num_workers,
+                             collate_fn=_indexed_collate, worker_init_fn=worker_init_fn)
+        store, size = None, 0
+        positions = _torch.full((len(self),), -1, dtype=_torch.int64)
+        for ix, batch in loader:
+            if len(ix) == 0:
+                continue
+            if store is None:
+                store = _alloc(batch, len(self), pin_memory)
+            _fill(store, batch, size)
+            positions[ix] = _torch.arange(size, size + len(ix))
+            size += len(ix)
+
+        self.tensors = _take(store, slice(0, size)) if store is not None else {}
+        self.positions = None if size == len(self) else positions
+        return self.tensors
+
+    def labels(self):
+        r"""
+        Class label of each index(aligned with self.indices), needed for -bal/--balanced_sampling.
+        It is called once per data loader, so build it vectorized for large datasets. Example with an IndexStore:
+            files = np.array(self.indices.files)[self.indices.file_ids]
+            return np.char.startswith(files, 'tumor').astype(int)
+        """
+        return None
+
+    def load_cached(self, dataset_name, file, load):
+        r"""
+        Decoded array of a file from the shared cache(-icm/--image_cache_mb) if it is there, else load() and cache it.
+        Useful when one image has many indices(like patches in U-Net). Example in __getitem__:
+            dataset_name, file, row_from, row_to, col_from, col_to = self.indices[index]
+            arr = self.load_cached(dataset_name, file, lambda: np.array(PIL.Image.open(path)))
+            patch = arr[row_from:row_to, col_from:col_to]
+        """
+        if self.array_cache is None:
+            return load()
+        key = f'{dataset_name}{_os.sep}{file}'
+        arr = self.array_cache.get(key)
+        if arr is None:
+            arr = self.array_cache.put(key, load())
+        return arr
+
+    def manifest(self, dataset_name):
+        r"""
+        Cached manifest(names, sizes, mtimes, and image shapes if the dataspec has 'manifest_shapes') of the files of
+         a dataset(see easytorch.data.datautils.manifest()). So load_index() can, for example, get the shape of
+         an image to compute its patches without opening it:
+            rows, cols, _ = self.manifest(dataset_name).info(file)['shape']
+        """
+        return _datautils.manifest(self.dataspecs[dataset_name])
+
+    def read(self, dataset_name, file):
+        r"""
+        Raw content of a data file. A zero copy view from the memory mapped shards if the dataspec has a
+         'shard_dir' packed with easytorch.data.datautils.pack_shards(), else read from its 'data_dir'.
+        """
+        if dataset_name in self.shards:
+            return self.shards[dataset_name][file]
+        with open(self.dataspecs[dataset_name]['data_dir'] + _os.sep + file, 'rb') as f:
+            return memoryview(f.read())
+
     def add(self, files, **kw):
         r"""
         An extra layer for added flexibility.
         """
         self.dataspecs[kw['name']] = kw
+        if kw.get('shard_dir') and _os.path.exists(kw['shard_dir'] + _os.sep + 'index.json'):
+            self.shards[kw['name']] = shard_reader(kw['shard_dir'])
         self._load_indices(dataset_name=kw['name'], files=files, verbose=kw.get('verbose'))
 
+    def add_sparse(self, files, **kw):
+        r"""
+        Add files one by one, recording the range of indices of each file(like all patches of an image) in groups.
+        Evaluation then runs them in a single data loader, and gives save_predictions() one file at a time.
+        """
+        for file in files:
+            start = len(self)
+            self.add(files=[file], **{**kw, 'verbose': False})
+            self.groups.append((start, len(self)))
+
+    def subset(self, start, end):
+        r"""
+        Shallow copy of this dataset with only the indices from start to end.
+        """
+        sub = _copy.copy(self)
+        sub.indices = self.indices[start:end]
+        sub.groups = []
+        return sub
+
     @classmethod
     def pool(cls, args, dataspecs, split_key=None, load_sparse=False):
         r"""
         This method takes multiple dataspecs and pools the first splits of all the datasets.
         So that we can train one single model on all the datasets. It will automatically refer correct data files,
             no need to move files in single folder.
+        args are passed on to the datasets, so options like -inm/--in_memory and -icm/--image_cache_mb apply.
         """
         all_d = []
         for dspec in dataspecs:
-            for split in _os.listdir(dspec['split_dir']):
-                split = _json.loads(open(dspec['split_dir'] + _os.sep + split).read())
+            for split in _datautils.list_splits(dspec['split_dir']):
+                split = _datautils.load_split(dspec['split_dir'], split)
                 if load_sparse:
-                    for file in split[split_key]:
-                        if len(all_d) >= args['load_limit']:
-                            break
-                        d = cls(mode=split_key)
-                        d.add(files=[file], debug=False, **dspec)
-                        all_d.append(d)
+                    if len(all_d) <= 0:
+                        all_d.append(cls(mode=split_key, **args))
+                    all_d[0].add_sparse(files=split[split_key][:max(args['load_limit'] - len(all_d[0].groups), 0)],
+                                        debug=False, **dspec)
                     if args['verbose']:
-                        success(f'{len(all_d)} sparse dataset loaded.')
+                        success(f'{len(all_d[0].groups)} sparse files loaded.')
                 else:
                     if len(all_d) <= 0:
-                        all_d.append(cls(mode=split_key, limit=args['load_limit']))
+                        all_d.append(cls(mode=split_key, limit=args['load_limit'], **args))
                     all_d[0].add(files=split[split_key], debug=args['verbose'], **dspec)
                 """
                 Pooling only works with 1 split at the moment.
@@ -1,14 +1,272 @@
+import fnmatch as _fnmatch
+import hashlib as _hashlib
 import json as _json
 import os as _os
 import random as _rd
+from concurrent import futures as _futures
 
 import numpy as _np
 from easytorch import config as _conf
+from easytorch.utils.logger import *
 
 _sep = _os.sep
 
 
-def create_ratio_split(files, save_to_dir=None, ratio: dict = None, first_key='train', name='SPLIT'):
+def list_files(data_dir, pattern=None):
+    r"""
+    Stream the names of files(not directories) in data_dir with os.scandir, optionally filtered by a glob pattern.
+    """
+    with _os.scandir(data_dir) as entries:
+        for entry in entries:
+            if entry.is_file() and (pattern is None or _fnmatch.fnmatch(entry.name, pattern)):
+                yield entry.name
+
+
+def _str_array(values):
+    arr = _np.empty(len(values), dtype=object)
+    arr[:] = list(values)
+    return arr
+
+
+class Manifest:
+    def __init__(self, data_dir, files, sizes, mtimes, shapes=None, dir_mtime=0):
+        r"""
+        Sorted names, sizes, and mtimes(ns) of the files in data_dir, and optionally their image shapes as
+         (rows, cols, channels) rows(-1 if not an image). Built by datautils.manifest(dspec).
+        Names are kept as an object array of str(a fixed width numpy str array takes 4 bytes per character of
+         the longest name for every file), and saved as one utf-8 blob with offsets.
+        """
+        self.data_dir = data_dir
+        self.files = _str_array(files)
+        self.sizes = _np.asarray(sizes, dtype=_np.int64)
+        self.mtimes = _np.asarray(mtimes, dtype=_np.int64)
+        self.shapes = None if shapes is None else _np.asarray(shapes, dtype=_np.int64).reshape(-1, 3)
+        self.dir_mtime = dir_mtime
+
+    def _find(self, file):
+        i = _np.searchsorted(self.files, file)
+        return i if i < len(self.files) and self.files[i] == file else -1
+
+    def __contains__(self, file):
+        return self._find(file) >= 0
+
+    def __len__(self):
+        return len(self.files)
+
+    def select(self, pattern=None):
+        r"""
+        Sorted list of file names, optionally filtered by a glob pattern.
+        """
+        files = self.files.tolist()
+        return files if pattern is None else _fnmatch.filter(files, pattern)
+
+    def info(self, file):
+        r"""
+        Like {'size': 1024, 'mtime': 1700000000000000000, 'shape': (584, 565, 3)} of a file.
+        """
+        i = self._find(file)
+        if i < 0:
+            raise KeyError(f'{file} is not in the manifest of {self.data_dir}.')
+        info = {'size': int(self.sizes[i]), 'mtime': int(self.mtimes[i])}
+        if self.shapes is not None:
+            info['shape'] = tuple(int(d) for d in self.shapes[i])
+        return info
+
+    def save(self, path):
+        r"""
+        Written to a temporary file and renamed, so concurrent runs never read a partial manifest.
+        """
+        _os.makedirs(_os.path.dirname(path), exist_ok=True)
+        names = [f.encode('utf-8', 'surrogateescape') for f in self.files]
+        arrays = dict(names=_np.frombuffer(b''.join(names), dtype=_np.uint8),
+                      offsets=_np.cumsum([0] + [len(n) for n in names], dtype=_np.int64),
+                      sizes=self.sizes, mtimes=self.mtimes,
+                      dir_mtime=_np.int64(self.dir_mtime), data_dir=_np.asarray(self.data_dir))
+        if self.shapes is not None:
+            arrays['shapes'] = self.shapes
+        tmp = f'{path}.{_os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            _np.savez(f, **arrays)
+        _os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with _np.load(path) as m:
+            blob, offsets = m['names'].tobytes(), m['offsets'].tolist()
+            files = [blob[a:b].decode('utf-8', 'surrogateescape') for a, b in zip(offsets[:-1], offsets[1:])]
+            return cls(str(m['data_dir']), files, m['sizes'], m['mtimes'],
+                       m['shapes'] if 'shapes' in m.files else None, int(m['dir_mtime']))
+
+
+def _image_shape(path):
+    from PIL import Image as _Image
+    try:
+        with _Image.open(path) as img:
+            return img.size[1], img.size[0], len(img.getbands())
+    except Exception:
+        return -1, -1, -1
+
+
+def scan(data_dir, shapes=False, previous=None, num_threads=16):
+    r"""
+    Build the Manifest of data_dir. Files are listed once, and stat(and image headers read) from num_threads
+     threads, as each is a round trip on network file systems.
+    @param previous: Manifest of an earlier scan. Only files not in it are stat, the others are reused.
+    Files removed while scanning are left out.
+    """
+    dir_mtime = _os.stat(data_dir).st_mtime_ns
+    files = _str_array(sorted(list_files(data_dir)))
+
+    sizes, mtimes = _np.zeros(len(files), dtype=_np.int64), _np.zeros(len(files), dtype=_np.int64)
+    shape_arr = _np.full((len(files), 3), -1, dtype=_np.int64) if shapes else None
+    new = _np.ones(len(files), dtype=bool)
+    if previous is not None and len(previous) > 0 and len(files) > 0 and not (shapes and previous.shapes is None):
+        ix = _np.minimum(_np.searchsorted(previous.files, files), len(previous) - 1)
+        old = previous.files[ix] == files
+        sizes[old], mtimes[old] = previous.sizes[ix[old]], previous.mtimes[ix[old]]
+        if shapes:
+            shape_arr[old] = previous.shapes[ix[old]]
+        new = ~old
+
+    def _stat(i):
+        path = data_dir + _sep + files[i]
+        try:
+            st = _os.stat(path)
+        except FileNotFoundError:
+            return i, None, None, None
+        return i, st.st_size, st.st_mtime_ns, _image_shape(path) if shapes else None
+
+    found = _np.ones(len(files), dtype=bool)
+    with _futures.ThreadPoolExecutor(max(num_threads, 1)) as pool:
+        for i, size, mtime, shape in pool.map(_stat, _np.flatnonzero(new)):
+            if size is None:
+                found[i] = False
+                continue
+            sizes[i], mtimes[i] = size, mtime
+            if shapes:
+                shape_arr[i] = shape
+
+    return Manifest(data_dir, files[found], sizes[found], mtimes[found],
+                    None if shape_arr is None else shape_arr[found], dir_mtime)
+
+
+def manifest_path(dspec):
+    r"""
+    dspec['manifest'] if given, else a file named after data_dir in dspec['manifest_dir'](-mfd/--manifest_dir,
+     <log_dir>/manifests in EasyTorch runs). Default is a .manifests directory next to data_dir.
+    """
+    if dspec.get('manifest'):
+        return dspec['manifest']
+
+    data_dir = _os.path.abspath(dspec['data_dir'])
+    cache_dir = dspec.get('manifest_dir') or _os.path.join(_os.path.dirname(data_dir), '.manifests')
+    key = _hashlib.sha1(data_dir.encode()).hexdigest()[:16]
+    return cache_dir + _sep + f'{_os.path.basename(data_dir)}_{key}.npz'
+
+
+_manifests = {}
+
+
+def manifest(dspec, refresh=False, num_threads=16):
+    r"""
+    Manifest of dspec['data_dir'], loaded once per process from the persistent manifest file.
+    It is re-scanned only if data_dir was modified(files added, removed, or renamed) since, and then only the new
+     files are stat. Use refresh=True after files are modified in place, to stat them all again.
+    Optional dataspec keys:
+        manifest, manifest_dir: Where the manifest file is kept, see manifest_path().
+        manifest_shapes: Also record the shapes of images(read from their headers).
+    """
+    path = manifest_path(dspec)
+    shapes = dspec.get('manifest_shapes', False)
+    dir_mtime = _os.stat(dspec['data_dir']).st_mtime_ns
+
+    m = _manifests.get(path)
+    if m is None and _os.path.exists(path) and not refresh:
+        try:
+            m = Manifest.load(path)
+        except Exception:
+            m = None
+
+    if m is None or refresh or m.dir_mtime != dir_mtime or (shapes and m.shapes is None):
+        m = scan(dspec['data_dir'], shapes, None if refresh else m, num_threads)
+        try:
+            m.save(path)
+        except OSError as e:
+            warn(f'Manifest of {dspec["data_dir"]} is not saved to {path}: {e}')
+
+    _manifests[path] = m
+    return m
+
+
+def _rng():
+    r"""
+    Numpy random generator seeded from python random, so splits follow the easytorch seed.
+    """
+    return _np.random.default_rng(_rd.getrandbits(32))
+
+
+def _split_base(name):
+    r"""
+    Folds name_0, name_1... share one list of files.
+    """
+    base, _, i = name.rpartition('_')
+    return base if base and i.isdigit() else name
+
+
+def save_split(split_dir, name, files, split_ix, compact=False):
+    r"""
+    Save a split given as a dict of index arrays(like {'train': ix, 'validation': ix, 'test': ix}) against files.
+    @param compact: Save just the index arrays in name.npz, against the list of files in split_dir/name_files.txt
+        (written once for all the folds), instead of all the file names of each key in name.json.
+    """
+    if compact:
+        files_path = split_dir + _sep + f'{_split_base(name)}_files.txt'
+        if not _os.path.exists(files_path):
+            with open(files_path, 'w') as f:
+                f.write('\n'.join(files))
+        _np.savez(split_dir + _sep + f'{name}.npz', **{k: _np.asarray(ix, dtype=_np.int64) for k, ix in split_ix.items()})
+    else:
+        with open(split_dir + _sep + f'{name}.json', 'w') as f:
+            f.write(_json.dumps({k: [files[i] for i in ix] for k, ix in split_ix.items()}))
+
+
+def list_splits(split_dir):
+    r"""
+    Split files in split_dir: all the files(json splits need not end with .json), but the lists of files of
+     compact .npz splits.
+    """
+    files = sorted(f for f in _os.listdir(split_dir) if _os.path.isfile(split_dir + _sep + f))
+    file_lists = {f'{_split_base(f[:-4])}_files.txt' for f in files if f.endswith('.npz')}
+    return [f for f in files if f not in file_lists]
+
+
+_split_files = {}
+
+
+def load_split(split_dir, split_file):
+    r"""
+    Load a split as a dict of lists of file names. Files lists of compact splits are read once for all the folds.
+    """
+    path = split_dir + _sep + split_file
+    if not split_file.endswith('.npz'):
+        try:
+            with open(path) as f:
+                return _json.loads(f.read())
+        except ValueError as e:
+            raise ValueError(f'{path} is not a split file(json, or compact .npz). '
+                             f'Keep only split files in the split directory.') from e
+
+    files_path = split_dir + _sep + f'{_split_base(split_file[:-4])}_files.txt'
+    key = (files_path, _os.path.getmtime(files_path))
+    if key not in _split_files:
+        with open(files_path) as f:
+            _split_files[key] = _str_array(f.read().split('\n'))
+    files = _split_files[key]
+    with _np.load(path) as split:
+        return {k: files[split[k]].tolist() for k in split.files}
+
+
+def create_ratio_split(files, save_to_dir=None, ratio: dict = None, first_key='train', name='SPLIT', compact=False):
     keys = [first_key]
     if len(ratio) == 2:
         keys.append('test')
@@ -19,36 +277,71 @@ def create_ratio_split(files, save_to_dir=None, ratio: dict = None, first_key='t
     _ratio = ratio[::-1]
     locs = _np.array([sum(_ratio[0:i + 1]) for i in range(len(ratio) - 1)])
     locs = (locs * len(files)).astype(int)
-    splits = _np.split(files[::-1], locs)[::-1]
-    splits = dict([(k, sp.tolist()[::-1]) for k, sp in zip(keys, splits)])
+    ix = _np.arange(len(files))
+    splits = _np.split(ix[::-1], locs)[::-1]
+    split_ix = dict([(k, sp[::-1]) for k, sp in zip(keys, splits)])
     if save_to_dir:
-        f = open(save_to_dir + _sep + f'{name}.json', "w")
-        f.write(_json.dumps(splits))
-        f.close()
+        save_split(save_to_dir, name, list(files), split_ix, compact)
     else:
-        return splits
+        return {k: [files[i] for i in ix] for k, ix in split_ix.items()}
 
 
-def create_k_fold_splits(files, k=0, save_to_dir=None, shuffle_files=True, name='SPLIT'):
-    if shuffle_files:
-        _rd.shuffle(files)
+def kfold_ids(n, k, labels=None, groups=None, shuffle=True):
+    r"""
+    Fold(0 to k-1) of each of n items, as an array.
+    @param labels: Stratify by these labels, so that each fold has (almost) the same share of each label.
+    @param groups: Items of a group(like images of a patient) are all put in the same fold.
+        Groups are assigned largest first to the smallest fold. labels are ignored if groups are given.
+    """
+    rng = _rng()
+    if groups is not None:
+        _, group_ix = _np.unique(_np.asarray(groups), return_inverse=True)
+        sizes = _np.bincount(group_ix)
+        order = rng.permutation(len(sizes)) if shuffle else _np.arange(len(sizes))
+        order = order[_np.argsort(-sizes[order], kind='stable')]
+        group_fold, fold_sizes = _np.zeros(len(sizes), dtype=_np.int64), _np.zeros(k, dtype=_np.int64)
+        for g in order:
+            group_fold[g] = _np.argmin(fold_sizes)
+            fold_sizes[group_fold[g]] += sizes[g]
+        return group_fold[group_ix]
 
-    ix_splits = _np.array_split(_np.arange(len(files)), k)
-    for i in range(len(ix_splits)):
-        test_ix = ix_splits[i].tolist()
-        val_ix = ix_splits[(i + 1) % len(ix_splits)].tolist()
-        train_ix = [ix for ix in _np.arange(len(files)) if ix not in test_ix + val_ix]
+    order = rng.permutation(n) if shuffle else _np.arange(n)
+    fold = _np.empty(n, dtype=_np.int64)
+    if labels is None:
+        fold[order] = _np.repeat(_np.arange(k), [len(a) for a in _np.array_split(_np.arange(n), k)])
+        return fold
 
-        splits = {'train': [files[ix] for ix in train_ix],
-                  'validation': [files[ix] for ix in val_ix],
-                  'test': [files[ix] for ix in test_ix]}
+    """
+    Deal the items of each label round robin to the folds, starting where the previous label stopped.
+    """
+    _, label_ix = _np.unique(_np.asarray(labels), return_inverse=True)
+    order = order[_np.argsort(label_ix[order], kind='stable')]
+    counts = _np.bincount(label_ix)
+    starts = _np.concatenate([[0], _np.cumsum(counts)[:-1]])
+    sorted_labels = label_ix[order]
+    fold[order] = (_np.arange(n) - starts[sorted_labels] + starts[sorted_labels] % k) % k
+    return fold
+
+
+def create_k_fold_splits(files, k=0, save_to_dir=None, shuffle_files=True, name='SPLIT', labels=None, groups=None,
+                         compact=False):
+    r"""
+    k splits, where fold i is the test set of split i, fold i+1 its validation set, and the rest train set.
+    @param labels, groups: For stratified or group k-fold, see kfold_ids().
+    @param compact: Save index arrays against one list of files, see save_split().
+    """
+    fold = kfold_ids(len(files), k, labels, groups, shuffle_files)
+
+    for i in range(k):
+        test, val = fold == i, fold == (i + 1) % k
+        split_ix = {'train': _np.flatnonzero(~(test | val)),
+                    'validation': _np.flatnonzero(val),
+                    'test': _np.flatnonzero(test)}
 
         if save_to_dir:
-            f = open(save_to_dir + _sep + f"{name}_{i}.json", "w")
-            f.write(_json.dumps(splits))
-            f.close()
+            save_split(save_to_dir, f"{name}_{i}", files, split_ix, compact)
         else:
-            return splits
+            return {key: [files[ix] for ix in split_ix[key]] for key in split_ix}
 
 
 def uniform_mix_two_lists(smaller, larger, shuffle=True):
@@ -73,27 +366,79 @@ def uniform_mix_two_lists(smaller, larger, shuffle=True):
     return accumulator
 
 
+def class_ids(labels):
+    r"""
+    Labels as class ids 0 to C-1 and the number of classes C. Non-negative integer labels are used as they are,
+     other labels(like negative integers, or strings) are numbered in sorted order.
+    """
+    labels = _np.asarray(labels)
+    if _np.issubdtype(labels.dtype, _np.integer) and labels.min(initial=0) >= 0:
+        return labels.astype(_np.int64, copy=False), int(labels.max(initial=-1)) + 1
+    classes, ids = _np.unique(labels, return_inverse=True)
+    return ids, len(classes)
+
+
+def balanced_weights(labels, nclasses=None):
+    r"""
+    Sampling weight(N / count of its class) of each item, so that each class is drawn equally often.
+    """
+    ids, n = class_ids(labels)
+    count = _np.bincount(ids, minlength=max(nclasses or 0, n))
+    return (len(ids) / _np.maximum(count, 1))[ids]
+
+
 def make_weights_for_balanced_classes(images, nclasses):
-    count = [0] * nclasses
-    for item in images:
-        count[item[1]] += 1
-    weight_per_class = [0.] * nclasses
-    N = float(sum(count))
-    for i in range(nclasses):
-        weight_per_class[i] = N / float(count[i])
-    weight = [0] * len(images)
-    for idx, val in enumerate(images):
-        weight[idx] = weight_per_class[val[1]]
-    return weight
+    return balanced_weights([item[1] for item in images], nclasses).tolist()
+
+
+def pack_shards(dspec, files=None, shard_size=2 ** 30, align=64):
+    r"""
+    Pack the files of a dataspec into a few large shard files in dspec['shard_dir'], so that
+     datasets can read records from memory mapped shards instead of opening millions of small files.
+    Records are keyed by file name in shard_dir/index.json, so the existing splits work unchanged.
+    @param files: Files in dspec['data_dir'] to pack. Default is all.
+    @param shard_size: Start a new shard once this many bytes are written.
+    @param align: Each record starts at a multiple of this many bytes, so that it can be viewed as any numpy dtype.
+    """
+    if files is None:
+        files = manifest(dspec).select()
+    _os.makedirs(dspec['shard_dir'], exist_ok=True)
+
+    index = {'shards': [], 'records': {}}
+    shard, size = None, 0
+    for file in files:
+        with open(dspec['data_dir'] + _sep + file, 'rb') as f:
+            buf = f.read()
+
+        if shard is None or (size > 0 and size + len(buf) > shard_size):
+            if shard is not None:
+                shard.close()
+            index['shards'].append(f"shard_{len(index['shards']):05d}.bin")
+            shard, size = open(dspec['shard_dir'] + _sep + index['shards'][-1], 'wb'), 0
+
+        index['records'][file] = [len(index['shards']) - 1, size, len(buf)]
+        pad = -len(buf) % align
+        shard.write(buf + b'\0' * pad)
+        size += len(buf) + pad
+
+    if shard is not None:
+        shard.close()
+    with open(dspec['shard_dir'] + _sep + 'index.json', 'w') as f:
+        f.write(_json.dumps(index))
+    return index
 
 
 def create_splits_(log_dir, dspec):
-    if dspec.get('split_dir') and _os.path.exists(dspec.get('split_dir')) and len(list(
-            _os.listdir(dspec.get('split_dir')))) > 0:
+    r"""
+    True if the splits of dspec must be created. data_dir is not listed here, the splitter lists it
+     from the manifest(see manifest()) only when needed.
+    """
+    if dspec.get('split_dir') and _os.path.exists(dspec.get('split_dir')) and len(
+            list_splits(dspec.get('split_dir'))) > 0:
         return False
 
     dspec['split_dir'] = log_dir + _sep + 'splits'
-    if _os.path.exists(dspec['split_dir']) and len(list(_os.listdir(dspec['split_dir']))) > 0:
+    if _os.path.exists(dspec['split_dir']) and len(list_splits(dspec['split_dir'])) > 0:
         return False
 
     _os.makedirs(dspec['split_dir'], exist_ok=True)
@@ -102,17 +447,31 @@ def create_splits_(log_dir, dspec):
 
 def init_kfolds_(dspec, args):
     r"""
-    Initialize k-folds for given dataspec.
+    Initialize k-folds for given dataspec. Files are listed from the cached manifest of data_dir.
         If: custom splits path is given it will use the splits from there
         else: will create new k-splits and run k-fold cross validation.
+    Optional dataspec keys:
+        file_pattern: Only use files in data_dir matching this glob pattern. Eg. '*.png'
+        manifest, manifest_dir, manifest_shapes: See manifest().
+        stratify_by, group_by: Functions of file name that give its label(stratified k-fold),
+         or group(group k-fold, like patient id of an image). They are only called here, in the main process,
+         so lambdas are fine. But with -ws/--world_size > 1 on platforms without fork, the dataspecs are pickled
+         to the ranks, and these must then be functions defined at the top level of a module.
+    Splits are saved in the compact format(see save_split()) if -csp/--compact_splits is set.
+    Files are in the order of their names(not of os.listdir as before), so ratio splits(which do not shuffle)
+     take the train, validation, and test files in that order.
     """
+    files = manifest(dspec).select(dspec.get('file_pattern'))
+    compact = args.get('compact_splits', False)
     if args.get('num_folds'):
-        create_k_fold_splits(_os.listdir(dspec['data_dir']), k=args['num_folds'],
-                             save_to_dir=dspec['split_dir'], shuffle_files=True, name=dspec['name'])
+        labels = [dspec['stratify_by'](f) for f in files] if dspec.get('stratify_by') else None
+        groups = [dspec['group_by'](f) for f in files] if dspec.get('group_by') else None
+        create_k_fold_splits(files, k=args['num_folds'], save_to_dir=dspec['split_dir'], shuffle_files=True,
+                             name=dspec['name'], labels=labels, groups=groups, compact=compact)
     else:
         if args['split_ratio'] is None or len(args['split_ratio']) == 0:
             args['split_ratio'] = _conf.data_split_ratio
-        create_ratio_split(_os.listdir(dspec['data_dir']),
+        create_ratio_split(files,
                            save_to_dir=dspec['split_dir'],
                            ratio=args['split_ratio'],
-                           name=dspec['name'])
+                           name=dspec['name'], compact=compact)
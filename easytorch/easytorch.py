@@ -1,11 +1,14 @@
-import json as _json
+import copy as _copy
+import multiprocessing as _mp
 import os as _os
 import pprint as _pp
 from argparse import ArgumentParser as _AP
+from concurrent import futures as _futures
 from typing import List as _List, Union as _Union, Callable as _Callable
 
 import easytorch.config as _conf
 import easytorch.utils as _utils
+import easytorch.utils.distributed as _dist_utils
 from easytorch.data import datautils as _du
 import torch as _torch
 import numpy as _np
@@ -13,6 +16,40 @@ import random as _random
 from easytorch.utils.logger import *
 
 _sep = _os.sep
+_fold_worker = {}
+
+
+def _init_fold_worker(runner_cls, args, dspec, dataset_cls, trainer_cls, base_cache, num_threads):
+    r"""
+    Runs once in each fold worker process. Everything needed to run a fold is kept in the worker,
+     so that only split file names are sent over for each task. The runner is rebuilt from its args
+     instead of being sent over.
+    """
+    _torch.set_num_threads(num_threads)
+    runner = runner_cls.__new__(runner_cls)
+    runner.args, runner.dataspecs = args, [dspec]
+    _fold_worker.update(runner=runner, dspec=dspec, dataset_cls=dataset_cls,
+                        trainer_cls=trainer_cls, base_cache=base_cache)
+
+
+def _run_fold_worker(split_file):
+    trainer = _fold_worker['trainer_cls'](_fold_worker['runner'].args)
+    trainer.cache.update(_copy.deepcopy(_fold_worker['base_cache']))
+    return _fold_worker['runner']._run_fold(trainer, _fold_worker['dspec'], split_file,
+                                            _fold_worker['dataset_cls'], check_logs=False)
+
+
+def _run_rank(runner, rank, method, dataset_cls, trainer_cls, data_splitter):
+    r"""
+    Entry point of each rank spawned by easytorch. Only the master rank prints logs.
+    """
+    runner.args.update(verbose=runner.args['verbose'] and rank == 0)
+    _torch.set_num_threads(max(_os.cpu_count() // runner.args['world_size'], 1))
+    _dist_utils.init_process_group(runner.args, rank=rank)
+    try:
+        getattr(runner, method)(dataset_cls, trainer_cls, data_splitter=data_splitter)
+    finally:
+        _dist_utils.destroy_process_group()
 
 
 class EasyTorch:
@@ -27,7 +64,7 @@ class EasyTorch:
         '\n\tor loading provided weights in pretrained_path argument) '
 
     def __init__(self, dataspecs: _List[dict],
-                 args: _Union[dict, _AP] = _conf.args,
+                 args: _Union[dict, _AP] = None,
                  phase: str = None,
                  batch_size: int = None,
                  epochs: int = None,
@@ -55,7 +92,8 @@ class EasyTorch:
         @param dataspecs: List of dict with which dataset details like data_files path, ground truth path...
                 Example: [{'data_dir':'images', 'labels_dir':'manuals', 'splits_dir':'splits'}]
                 Each key with _dir in it will be appended before the value provided in 'dataset_dir' argument.
-        @param args: An argument parser, or, dict. (Defaults are loaded from easytorch.conf.default_args.)
+        @param args: An argument parser, or, dict. (Defaults are loaded from easytorch.conf.default_args,
+                    parsed from runtime arguments.)
                     Note: values in args will be overridden by the listed args below if provided.
         @param phase: phase of operation; train/test. (Default: None)
                     train phase will run all train, validation, and test step.
@@ -111,11 +149,14 @@ class EasyTorch:
         self._make_reproducible()
 
     def _device_check_(self):
-        self.args['gpus'] = self.args.get('gpus', [])
+        if self.args.get('gpus') is None:
+            self.args['gpus'] = [0] if _conf.cuda_available else []
+        if self.args.get('pin_memory') is None:
+            self.args['pin_memory'] = _conf.cuda_available
         if self.args['verbose'] and len(self.args['gpus']) > _conf.num_gpus:
             warn(f"{len(self.args['gpus'])} GPU(s) requested "
                  f"but {_conf.num_gpus if _conf.cuda_available else 'GPU(s) not'} detected. "
-                 f"Using {_conf.num_gpus + ' GPU(s)' if _conf.cuda_available else 'CPU(Much slower)'}.")
+                 f"Using {str(_conf.num_gpus) + ' GPU(s)' if _conf.cuda_available else 'CPU(Much slower)'}.")
             self.args['gpus'] = list(range(_conf.num_gpus))
 
     def _show_args(self):
@@ -125,7 +166,9 @@ class EasyTorch:
             warn('Defaults args are loaded from easytorch.config.default_args.')
 
     def _init_args_(self, args):
-        if isinstance(args, _AP):
+        if args is None:
+            self.args = {**_conf.args}
+        elif isinstance(args, _AP):
             self.args = vars(args.parse_args())
         elif isinstance(args, dict):
             self.args = {**args}
@@ -156,6 +199,7 @@ class EasyTorch:
             for k in dspec:
                 if '_dir' in k:
                     dspec[k] = _os.path.join(self.args['dataset_dir'], dspec[k])
+            dspec.setdefault('manifest_dir', self.args.get('manifest_dir') or self.args['log_dir'] + _sep + 'manifests')
 
     def _get_train_dataset(self, split, dspec, dataset_cls):
         r"""
@@ -176,39 +220,160 @@ class EasyTorch:
     def _get_test_dataset(self, split, dspec, dataset_cls):
         r"""
         Load the test data from current fold/split.
-        If -sp/--load-sparse arg is set, we need to load one image in one dataloader.
-        So that we can correctly gather components of one image(components like output patches)
+        If -sp/--load-sparse arg is set, indices of each image are kept together as a group of the dataset,
+         so that we can correctly gather components of one image(components like output patches).
         """
-        test_dataset_list = []
         if self.args.get('load_sparse'):
-            for f in split.get('test', []):
-                if len(test_dataset_list) >= self.args['load_limit']:
-                    break
-                test_dataset = dataset_cls(mode='eval', limit=self.args['load_limit'], **self.args)
-                test_dataset.add(files=[f], verbose=False, **dspec)
-                test_dataset_list.append(test_dataset)
+            test_dataset = dataset_cls(mode='eval', limit=_conf.data_load_limit, **self.args)
+            test_dataset.add_sparse(files=split.get('test', [])[:self.args['load_limit']], **dspec)
             if self.args['verbose']:
-                success(f'{len(test_dataset_list)} sparse dataset loaded.')
+                success(f'{len(test_dataset.groups)} sparse files loaded.')
         else:
             test_dataset = dataset_cls(mode='eval', limit=self.args['load_limit'], **self.args)
             test_dataset.add(files=split.get('test', []), verbose=self.args['verbose'], **dspec)
-            test_dataset_list.append(test_dataset)
-        return test_dataset_list
+        return [test_dataset]
+
+    def _run_fold(self, trainer, dspec, split_file, dataset_cls, check_logs=True):
+        r"""
+        Train(if phase is train) and test on a single split file.
+        Returns the split file name along with test averages and scores of this fold.
+        """
+        split = _du.load_split(dspec['split_dir'], split_file)
+
+        """
+        Experiment id is split file name. For the example of k-fold.
+        """
+        trainer.cache['experiment_id'] = split_file.split('.')[0]
+        trainer.cache['checkpoint'] = trainer.cache['experiment_id'] + '.pt'
+        trainer.cache['training_state'] = trainer.cache['experiment_id'] + '_state.pt'
+        _utils.reset_cache_log(trainer.cache['log_dir'], trainer.cache['experiment_id'])
+        trainer.cache.update(best_epoch=0, best_score=0.0)
+        if trainer.cache['metric_direction'] == 'minimize':
+            trainer.cache['best_score'] = 1e11
+
+        if check_logs:
+            trainer.check_previous_logs()
+        trainer.init_nn()
+
+        """
+        Clear cache to save scores for each fold
+        """
+        trainer.cache.update(training_log=[], validation_log=[], image_cache_log=[], test_score=[])
+
+        """
+        An intervention point if anyone wants to change things for each fold.
+        """
+        trainer.reset_fold_cache()
+
+        """###########  Run training phase ########################"""
+        if self.args['phase'] == 'train':
+            trainset = self._get_train_dataset(split, dspec, dataset_cls)
+            valset = self._get_validation_dataset(split, dspec, dataset_cls)
+            trainer.train(trainset, valset)
+            cache = {**self.args, **trainer.cache, **dspec, **trainer.nn, **trainer.optimizer}
+            if _dist_utils.is_master():
+                _utils.save_cache(cache, experiment_id=trainer.cache['experiment_id'])
+        """#########################################################"""
+
+        if self.args['phase'] == 'train' or self.args['pretrained_path'] is None:
+            """
+            Best model will be split_name.pt in training phase, and if no pretrained path is supplied.
+            """
+            trainer.load_checkpoint_from_key(key='checkpoint')
+
+        """########## Run test phase. ##############################"""
+        testset = self._get_test_dataset(split, dspec, dataset_cls)
+        test_averages, test_score = trainer.evaluation(split_key='test', save_pred=True,
+                                                       dataset_list=testset)
+        trainer.close_loaders()
+
+        """
+        Save the calculated scores in list so that later we can do extra things(Like save to a file.)
+        """
+        trainer.cache['test_score'].append([*test_averages.get(), *test_score.get()])
+        if _dist_utils.is_master():
+            _utils.save_scores(trainer.cache, experiment_id=trainer.cache['experiment_id'],
+                               file_keys=['test_score'])
+        return split_file, test_averages, test_score
+
+    def _run_folds_parallel(self, trainer, dspec, split_files, dataset_cls, trainer_cls):
+        r"""
+        Run independent folds in a pool of -pf/--parallel_folds worker processes.
+        Each worker builds its own trainer from the dataset level cache of the given trainer,
+         and uses -pft/--fold_threads torch threads(Default: all cpus divided among the workers).
+        Results are yielded in the order of split_files so global scores are the same as running one by one.
+        Workers are started fresh(forkserver, or spawn) rather than forked from this process, that may already
+         run threads(torch/OpenMP, background writers) or have CUDA initialized. So dataset_cls and trainer_cls
+         must be importable(defined at the top level of a module, or of the main script).
+        """
+        num_workers = min(self.args['parallel_folds'], len(split_files))
+        num_threads = self.args.get('fold_threads') or max(_os.cpu_count() // num_workers, 1)
+
+        """
+        Previous logs of all the folds are checked once here, as workers cannot prompt for input.
+        """
+        trainer.check_previous_logs(experiment_ids=[split_file.split('.')[0] for split_file in split_files])
+
+        base_cache = {k: v for k, v in trainer.cache.items() if k != 'global_test_score'}
+        """
+        Splits are already created, so split making functions(that may be lambdas, see init_kfolds_) are not sent.
+        """
+        dspec = {k: v for k, v in dspec.items() if k not in ['stratify_by', 'group_by']}
+        ctx = _mp.get_context('forkserver' if 'forkserver' in _mp.get_all_start_methods() else 'spawn')
+        with _futures.ProcessPoolExecutor(max_workers=num_workers, mp_context=ctx,
+                                          initializer=_init_fold_worker,
+                                          initargs=(type(self), self.args, dspec, dataset_cls, trainer_cls,
+                                                    base_cache, num_threads)) as pool:
+            if self.args['verbose']:
+                success(f'Running {len(split_files)} folds in {num_workers} workers'
+                        f' with {num_threads} thread(s) each.')
+            yield from pool.map(_run_fold_worker, split_files)
+
+    def _run_distributed(self, method, dataset_cls, trainer_cls, data_splitter):
+        r"""
+        Run the given method(run/run_pooled) in -ws/--world_size processes, one for each rank.
+        If ranks are started by an external launcher(like torchrun), only join the process group and run.
+        Else, the splits are created once here, and one process for each rank is started in this machine.
+        """
+        if _dist_utils.launched_externally():
+            self.args.update(verbose=self.args['verbose'] and int(_os.environ['RANK']) == 0)
+            _dist_utils.init_process_group(self.args)
+            try:
+                return getattr(self, method)(dataset_cls, trainer_cls, data_splitter=data_splitter)
+            finally:
+                _dist_utils.destroy_process_group()
+
+        for dspec in self.dataspecs:
+            if _du.create_splits_(self.args['log_dir'] + _sep + dspec['name'], dspec):
+                data_splitter(dspec=dspec, args=self.args)
+
+        ctx = _mp.get_context('fork' if 'fork' in _mp.get_all_start_methods() else 'spawn')
+        ranks = [ctx.Process(target=_run_rank, args=(self, rank, method, dataset_cls, trainer_cls, data_splitter))
+                 for rank in range(self.args['world_size'])]
+        for r in ranks:
+            r.start()
+        for r in ranks:
+            r.join()
+        if any(r.exitcode != 0 for r in ranks):
+            raise RuntimeError(f"Distributed {method} failed with exit codes: {[r.exitcode for r in ranks]}")
 
     def run(self, dataset_cls, trainer_cls,
             data_splitter: _Callable = _du.init_kfolds_):
         r"""
         Run for individual datasets
         """
+        if self.args.get('world_size', 1) > 1 and not _dist_utils.is_distributed():
+            return self._run_distributed('run', dataset_cls, trainer_cls, data_splitter)
+
         for dspec in self.dataspecs:
             trainer = trainer_cls(self.args)
 
             trainer.cache['log_dir'] = self.args['log_dir'] + _sep + dspec['name']
             if _du.create_splits_(trainer.cache['log_dir'], dspec):
                 data_splitter(dspec=dspec, args=self.args)
-                success(f"{len(_os.listdir(dspec['split_dir']))} split(s) created in '{dspec['split_dir']}' directory.")
+                success(f"{len(_du.list_splits(dspec['split_dir']))} split(s) created in '{dspec['split_dir']}' directory.")
             elif self.args['verbose']:
-                success(f"{len(_os.listdir(dspec['split_dir']))} split(s) loaded from '{dspec['split_dir']}' directory.")
+                success(f"{len(_du.list_splits(dspec['split_dir']))} split(s) loaded from '{dspec['split_dir']}' directory.")
 
             """
             We will save the global scores of all folds if any.
@@ -238,76 +403,36 @@ class EasyTorch:
             """
             _os.makedirs(trainer.cache['log_dir'], exist_ok=True)
             self._show_args()
-            for split_file in _os.listdir(dspec['split_dir']):
-                split = _json.loads(open(dspec['split_dir'] + _sep + split_file).read())
-
-                """
-                Experiment id is split file name. For the example of k-fold.
-                """
-                trainer.cache['experiment_id'] = split_file.split('.')[0]
-                trainer.cache['checkpoint'] = trainer.cache['experiment_id'] + '.pt'
-                trainer.cache.update(best_epoch=0, best_score=0.0)
-                if trainer.cache['metric_direction'] == 'minimize':
-                    trainer.cache['best_score'] = 1e11
-
-                trainer.check_previous_logs()
-                trainer.init_nn()
-
-                """
-                Clear cache to save scores for each fold
-                """
-                trainer.cache.update(training_log=[], validation_log=[], test_score=[])
-
-                """
-                An intervention point if anyone wants to change things for each fold.
-                """
-                trainer.reset_fold_cache()
-
-                """###########  Run training phase ########################"""
-                if self.args['phase'] == 'train':
-                    trainset = self._get_train_dataset(split, dspec, dataset_cls)
-                    valset = self._get_validation_dataset(split, dspec, dataset_cls)
-                    trainer.train(trainset, valset)
-                    cache = {**self.args, **trainer.cache, **dspec, **trainer.nn, **trainer.optimizer}
-                    _utils.save_cache(cache, experiment_id=trainer.cache['experiment_id'])
-                """#########################################################"""
-
-                if self.args['phase'] == 'train' or self.args['pretrained_path'] is None:
-                    """
-                    Best model will be split_name.pt in training phase, and if no pretrained path is supplied.
-                    """
-                    trainer.load_checkpoint_from_key(key='checkpoint')
-
-                """########## Run test phase. ##############################"""
-                testset = self._get_test_dataset(split, dspec, dataset_cls)
-                test_averages, test_score = trainer.evaluation(split_key='test', save_pred=True,
-                                                               dataset_list=testset)
-
+            split_files = _du.list_splits(dspec['split_dir'])
+            if self.args.get('parallel_folds', 0) > 1 and len(split_files) > 1 \
+                    and not _dist_utils.is_distributed():
+                fold_scores = self._run_folds_parallel(trainer, dspec, split_files, dataset_cls, trainer_cls)
+            else:
+                fold_scores = (self._run_fold(trainer, dspec, split_file, dataset_cls) for split_file in split_files)
+
+            for split_file, test_averages, test_score in fold_scores:
                 """
                 Accumulate global scores-scores of each fold to report single global score for each datasets.
                 """
                 global_averages.accumulate(test_averages)
                 global_score.accumulate(test_score)
-
-                """
-                Save the calculated scores in list so that later we can do extra things(Like save to a file.)
-                """
-                trainer.cache['test_score'].append([*test_averages.get(), *test_score.get()])
                 trainer.cache['global_test_score'].append([split_file, *test_averages.get(), *test_score.get()])
-                _utils.save_scores(trainer.cache, experiment_id=trainer.cache['experiment_id'],
-                                   file_keys=['test_score'])
 
             """
             Finally, save the global score to a file
             """
             trainer.cache['global_test_score'].append(['Global', *global_averages.get(), *global_score.get()])
-            _utils.save_scores(trainer.cache, file_keys=['global_test_score'])
+            if _dist_utils.is_master():
+                _utils.save_scores(trainer.cache, file_keys=['global_test_score'])
 
     def run_pooled(self, dataset_cls, trainer_cls,
                    data_splitter: _Callable = _du.init_kfolds_):
         r"""
         Run in pooled fashion.
         """
+        if self.args.get('world_size', 1) > 1 and not _dist_utils.is_distributed():
+            return self._run_distributed('run_pooled', dataset_cls, trainer_cls, data_splitter)
+
         trainer = trainer_cls(self.args)
 
         """
@@ -353,6 +478,8 @@ class EasyTorch:
 
         trainer.cache['experiment_id'] = 'pooled'
         trainer.cache['checkpoint'] = trainer.cache['experiment_id'] + '.pt'
+        trainer.cache['training_state'] = trainer.cache['experiment_id'] + '_state.pt'
+        _utils.reset_cache_log(trainer.cache['log_dir'], trainer.cache['experiment_id'])
 
         trainer.cache.update(best_epoch=0, best_score=0.0)
         if trainer.cache['metric_direction'] == 'minimize':
@@ -364,7 +491,7 @@ class EasyTorch:
         """
         Clear cache to save scores for each fold
         """
-        trainer.cache.update(training_log=[], validation_log=[], test_score=[])
+        trainer.cache.update(training_log=[], validation_log=[], image_cache_log=[], test_score=[])
 
         """
         An intervention point if anyone wants to change things for each fold.
@@ -378,7 +505,8 @@ class EasyTorch:
                                            load_sparse=False)[0]
             trainer.train(train_dataset, val_dataset)
             cache = {**self.args, **trainer.cache, 'dataspecs': self.dataspecs}
-            _utils.save_cache(cache, experiment_id=cache['experiment_id'])
+            if _dist_utils.is_master():
+                _utils.save_cache(cache, experiment_id=cache['experiment_id'])
 
         if self.args['phase'] == 'train' or self.args['pretrained_path'] is None:
             """
@@ -389,8 +517,10 @@ class EasyTorch:
         test_dataset_list = dataset_cls.pool(self.args, dataspecs=self.dataspecs, split_key='test',
                                              load_sparse=self.args['load_sparse'])
         test_averages, test_score = trainer.evaluation(split_key='test', save_pred=True, dataset_list=test_dataset_list)
+        trainer.close_loaders()
 
         global_averages.accumulate(test_averages)
         global_score.accumulate(test_score)
         trainer.cache['test_score'].append(['Global', *global_averages.get(), *global_score.get()])
-        _utils.save_scores(trainer.cache, experiment_id=trainer.cache['experiment_id'], file_keys=['test_score'])
+        if _dist_utils.is_master():
+            _utils.save_scores(trainer.cache, experiment_id=trainer.cache['experiment_id'], file_keys=['test_score'])
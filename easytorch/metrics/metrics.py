@@ -12,6 +12,18 @@ import torch as _torch
 from easytorch.config import metrics_num_precision as _nump, metrics_eps as _eps
 
 
+def _on_device_of(value, *counts):
+    r"""
+    value(if a tensor) moved to the device of the first tensor in counts, so values from another device
+     (like cpu metrics accumulated into cuda ones) add up.
+    """
+    if isinstance(value, _torch.Tensor):
+        for c in counts:
+            if isinstance(c, _torch.Tensor):
+                return value.to(c.device)
+    return value
+
+
 class SerializableMetrics:
     def __init__(self, **kw):
         pass
@@ -53,6 +65,8 @@ class ETMetrics(SerializableMetrics):
     def accumulate(self, other):
         r"""
         Add all the content from another ETMetrics object.
+        In distributed runs, the attributes named in _reducible_(if any) are summed across the ranks directly,
+         else whole objects are gathered and accumulated(see easytorch.utils.distributed.all_reduce_metrics).
         """
         pass
 
@@ -90,38 +104,74 @@ class ETMetrics(SerializableMetrics):
 
 
 class ETAverages(ETMetrics):
+    _reducible_ = ('values', 'counts')
+
     def __init__(self, num_averages=1, **kw):
         r"""
         This class can keep track of K averages.
         For example, in GAN we need to keep track of Generators loss
         """
         super().__init__(**kw)
-        self.values = _np.array([0.0] * num_averages, dtype=_np.float)
-        self.counts = _np.array([0.0] * num_averages, dtype=_np.float)
+        self.values = _np.array([0.0] * num_averages, dtype=float)
+        self.counts = _np.array([0.0] * num_averages, dtype=float)
         self.num_averages = num_averages
 
+    def _device_values(self, device):
+        r"""
+        Move the running sums to the given device(where the added tensors are) if not there already.
+        """
+        if not isinstance(self.values, _torch.Tensor):
+            values = _torch.zeros(self.num_averages, dtype=_torch.float64, device=device)
+            if _np.any(self.values):
+                values += _torch.as_tensor(_np.asarray(self.values, dtype=float), device=device)
+            self.values = values
+        return self.values
+
+    def _add_values(self, values):
+        if isinstance(self.values, _torch.Tensor):
+            self.values = self.values + _torch.as_tensor(values, dtype=_torch.float64, device=self.values.device)
+        elif isinstance(values, _torch.Tensor):
+            self.values = self._device_values(values.device) + values
+        else:
+            self.values = _np.asarray(self.values, dtype=float) + _np.asarray(values, dtype=float)
+
+    def _sync(self):
+        r"""
+        Bring the running sums to python numbers. Only needed when the averages are asked for.
+        """
+        if isinstance(self.values, _torch.Tensor):
+            self.values = self.values.cpu().numpy()
+        self.values = _np.asarray(self.values, dtype=float)
+        self.counts = _np.asarray(self.counts, dtype=float)
+
     def add(self, val=0, n=1, index=0):
         r"""
         Keep adding val, n to get the average later.
         Index is the position on where to add the values.
         For example:
             avg = ETAverages(num_averages=2)
-            avg.add(lossG.item(), len(batch), 0)
-            avg.add(lossD.item(), len(batch), 1)
+            avg.add(lossG, len(batch), 0)
+            avg.add(lossD, len(batch), 1)
+        val can be a tensor(like loss), which is summed up in its own device without any host-device sync.
+        It is only brought to a python number when get() is called.
         """
-        self.values[index] += val * n
+        if isinstance(val, _torch.Tensor):
+            values = self._device_values(val.device)
+            values[index] += val.detach().to(values.device) * n
+        else:
+            self.values[index] += val * n
         self.counts[index] += n
 
     def update(self, values: _typing.List[float] = None, counts: _typing.List[int] = None, **kw):
-        self.values += _np.array(values)
+        self._add_values(values)
         self.counts += _np.array(counts)
 
     def accumulate(self, other):
         r"""
         Add another ETAverage object to self
         """
-        self.values += other.values
-        self.counts += other.counts
+        self._add_values(other.values)
+        self.counts += _np.asarray(other.counts, dtype=float)
 
     def reset(self):
         r"""
@@ -134,6 +184,7 @@ class ETAverages(ETMetrics):
         r"""
         Computes/Returns self.num_averages number of averages in vectorized way.
         """
+        self._sync()
         counts = self.counts.copy()
         counts[counts == 0] = _np.inf
         return _np.round(self.values / counts, self.num_precision)
@@ -161,7 +212,10 @@ class Prf1a(ETMetrics):
     r"""
     A class that has GPU based computation of:
         Precision, Recall, F1 Score, Accuracy, and Overlap(IOU).
+    TP, FP, TN, FN are kept as tensors in the device of the added predictions,
+     and are only brought to python numbers once the scores are asked for.
     """
+    _reducible_ = ('tn', 'fp', 'fn', 'tp')
 
     def __init__(self):
         super().__init__()
@@ -182,32 +236,50 @@ class Prf1a(ETMetrics):
 
         y_true = y_true * 2
         y_cases = y_true + y_pred
-        self.tp += _torch.sum(y_cases == 3).item()
-        self.fp += _torch.sum(y_cases == 1).item()
-        self.tn += _torch.sum(y_cases == 0).item()
-        self.fn += _torch.sum(y_cases == 2).item()
+        y_cases = _on_device_of(y_cases, self.tp, self.fp, self.tn, self.fn)
+        self.tp = self.tp + _torch.sum(y_cases == 3)
+        self.fp = self.fp + _torch.sum(y_cases == 1)
+        self.tn = self.tn + _torch.sum(y_cases == 0)
+        self.fn = self.fn + _torch.sum(y_cases == 2)
+
+    def _sync(self):
+        r"""
+        Bring all the device counts to python numbers in a single transfer.
+        """
+        counts = [self.tn, self.fp, self.fn, self.tp]
+        ix = [i for i, c in enumerate(counts) if isinstance(c, _torch.Tensor)]
+        if ix:
+            device = counts[ix[0]].device
+            synced = _torch.stack([counts[i].to(device, _torch.float64) for i in ix]).tolist()
+            for i, c in zip(ix, synced):
+                counts[i] = c
+            self.tn, self.fp, self.fn, self.tp = counts
 
     def accumulate(self, other):
-        self.tp += other.tp
-        self.fp += other.fp
-        self.tn += other.tn
-        self.fn += other.fn
+        counts = self.tp, self.fp, self.tn, self.fn
+        self.tp = self.tp + _on_device_of(other.tp, *counts)
+        self.fp = self.fp + _on_device_of(other.fp, *counts)
+        self.tn = self.tn + _on_device_of(other.tn, *counts)
+        self.fn = self.fn + _on_device_of(other.fn, *counts)
 
     def reset(self):
         self.tn, self.fp, self.fn, self.tp = [0] * 4
 
     @property
     def precision(self):
+        self._sync()
         p = self.tp / max(self.tp + self.fp, self.eps)
         return round(p, self.num_precision)
 
     @property
     def recall(self):
+        self._sync()
         r = self.tp / max(self.tp + self.fn, self.eps)
         return round(r, self.num_precision)
 
     @property
     def accuracy(self):
+        self._sync()
         a = (self.tp + self.tn) / \
             max(self.tp + self.fp + self.fn + self.tn, self.eps)
         return round(a, self.num_precision)
@@ -229,6 +301,7 @@ class Prf1a(ETMetrics):
 
     @property
     def overlap(self):
+        self._sync()
         o = self.tp / max(self.tp + self.fp + self.fn, self.eps)
         return round(o, self.num_precision)
 
@@ -236,64 +309,88 @@ class Prf1a(ETMetrics):
 class ConfusionMatrix(ETMetrics):
     """
     Confusion matrix  is used in multi class classification case.
-    x-axis is predicted. y-axis is true label.
-    F1 score from average precision and recall is calculated
+    y-axis(rows) is true label. x-axis(columns) is predicted.
+    Counts are accumulated with a single bincount per batch in the given device(or the device of predictions if None).
+    Precision, recall, and F1 are computed for all classes at once, and averaged as:
+        - macro: unweighted mean over classes(Default).
+        - micro: from the total true positives, which is same as accuracy for single label classification.
+        - weighted: mean over classes weighted by the number of true samples of each class.
     """
+    _AVERAGES_ = ['macro', 'micro', 'weighted']
+    _reducible_ = ('matrix',)
 
-    def __init__(self, num_classes=None, device='cpu', **kw):
+    def __init__(self, num_classes=None, device=None, average='macro', **kw):
         super().__init__(**kw)
+        assert average in self._AVERAGES_, f'average must be one of {self._AVERAGES_}'
         self.num_classes = num_classes
-        self.matrix = _torch.zeros(num_classes, num_classes).float()
         self.device = device
+        self.average = average
+        self.matrix = _torch.zeros(num_classes, num_classes, dtype=_torch.long, device=device)
 
     def reset(self):
-        self.matrix = _torch.zeros(self.num_classes, self.num_classes).float()
+        self.matrix = _torch.zeros(self.num_classes, self.num_classes, dtype=_torch.long, device=self.matrix.device)
         return self
 
     def update(self, matrix=0, **kw):
-        self.matrix += _np.array(matrix)
+        self.matrix += _torch.as_tensor(_np.array(matrix), dtype=_torch.long, device=self.matrix.device)
 
     def accumulate(self, other):
-        self.matrix += other.matrix
+        self.matrix += _torch.as_tensor(other.matrix, dtype=_torch.long).to(self.matrix.device)
         return self
 
     def add(self, pred, true):
-        pred = pred.clone().long().reshape(1, -1).squeeze()
-        true = true.clone().long().reshape(1, -1).squeeze()
-        self.matrix += _torch.sparse.LongTensor(
-            _torch.stack([pred, true]).to(self.device),
-            _torch.ones_like(pred).long().to(self.device),
-            _torch.Size([self.num_classes, self.num_classes])).to_dense().to(self.device)
+        if self.device is None and self.matrix.device != pred.device:
+            self.matrix = self.matrix.to(pred.device)
+        pred = pred.reshape(-1).long().to(self.matrix.device)
+        true = true.reshape(-1).long().to(self.matrix.device)
+        self.matrix += _torch.bincount(true * self.num_classes + pred,
+                                       minlength=self.num_classes ** 2).view(self.num_classes, self.num_classes)
+
+    def _counts(self):
+        r"""
+        True positives, number of true samples, and number of predictions of each class.
+        The only host-device transfer needed to compute all the scores.
+        """
+        matrix = self.matrix.cpu().numpy().astype(float)
+        return matrix.diagonal(), matrix.sum(1), matrix.sum(0)
+
+    def _average(self, scores, tp, support, average):
+        if average is True:
+            average = self.average
+        if not average:
+            return scores
+        if average == 'micro':
+            return tp.sum() / max(support.sum(), self.eps)
+        if average == 'weighted':
+            return (scores * support).sum() / max(support.sum(), self.eps)
+        return scores.mean()
 
     def precision(self, average=True):
-        precision = [0] * self.num_classes
-        for i in range(self.num_classes):
-            precision[i] = self.matrix[i, i] / max(_torch.sum(self.matrix[:, i]).item(), self.eps)
-        precision = _np.array(precision)
-        return sum(precision) / self.num_classes if average else precision
+        r"""
+        average: True for the default averaging of this matrix, False for scores of each class,
+         or one of macro, micro, weighted.
+        """
+        tp, support, predicted = self._counts()
+        return self._average(tp / _np.maximum(predicted, self.eps), tp, support, average)
 
     def recall(self, average=True):
-        recall = [0] * self.num_classes
-        for i in range(self.num_classes):
-            recall[i] = self.matrix[i, i] / max(_torch.sum(self.matrix[i, :]).item(), self.eps)
-        recall = _np.array(recall)
-        return sum(recall) / self.num_classes if average else recall
+        tp, support, predicted = self._counts()
+        return self._average(tp / _np.maximum(support, self.eps), tp, support, average)
 
     def f1(self, average=True):
-        f_1 = []
-        precision = [self.precision(average)] if average else self.precision(average)
-        recall = [self.recall(average)] if average else self.recall(average)
-        for p, r in zip(precision, recall):
-            f_1.append(2 * p * r / max(p + r, self.eps))
-        f_1 = _np.array(f_1)
-        return f_1[0] if average else f_1
+        tp, support, predicted = self._counts()
+        p = tp / _np.maximum(predicted, self.eps)
+        r = tp / _np.maximum(support, self.eps)
+        f_1 = 2 * p * r / _np.maximum(p + r, self.eps)
+        return self._average(f_1, tp, support, average)
 
     def accuracy(self):
-        return self.matrix.trace().item() / max(self.matrix.sum().item(), self.eps)
+        tp, support, _ = self._counts()
+        return tp.sum() / max(support.sum(), self.eps)
 
     def prfa(self):
-        return [round(self.precision(), self.num_precision), round(self.recall(), self.num_precision),
-                round(self.f1(), self.num_precision), round(self.accuracy(), self.num_precision)]
+        return [round(float(self.precision()), self.num_precision), round(float(self.recall()), self.num_precision),
+                round(float(self.f1()), self.num_precision), round(float(self.accuracy()), self.num_precision)]
 
     def get(self):
         return self.prfa()
@@ -2,36 +2,84 @@ r"""
 The main core of EasyTorch
 """
 
+import contextlib as _contextlib
+import copy as _copy
+import gc as _gc
 import math as _math
 import os as _os
+import random as _random
+import time as _time
 from collections import OrderedDict as _ODict
 
+import numpy as _np
 import torch as _torch
 
 import easytorch.config as _config
 import easytorch.data as _etdata
 import easytorch.utils as _etutils
+import easytorch.utils.checkpoint as _ckpt
+import easytorch.utils.distributed as _dist_utils
+import easytorch.utils.predictions as _predictions
 from easytorch.metrics import metrics as _base_metrics
-from easytorch.utils.tensorutils import initialize_weights as _init_weights
-from .vision import plotter as _log_utils
+from easytorch.utils.tensorutils import initialize_weights as _init_weights, split_batch as _split_batch, \
+    to_channels_last as _to_channels_last, get_batch_size as _get_batch_size
 from easytorch.utils.logger import *
 
 _sep = _os.sep
 
 
+def _hashable(value):
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return id(value)
+
+
+def _unwrap(model):
+    r"""
+    The user model inside torch.compile(_orig_mod) and DataParallel/DistributedDataParallel(module) wrappers.
+    """
+    while True:
+        if hasattr(model, '_orig_mod'):
+            model = model._orig_mod
+        elif isinstance(model, (_torch.nn.DataParallel, _torch.nn.parallel.DistributedDataParallel)):
+            model = model.module
+        else:
+            return model
+
+
 class ETTrainer:
     def __init__(self, args: dict):
         r"""
-        args: receives the arguments passed by the ArgsParser.
+        args: receives the arguments passed by the ArgsParser. -gpus/-pin left unset(None) are resolved here too,
+         like in EasyTorch, for trainers used on their own.
         cache: Initialize all immediate things here. Like scores, loss, accuracies...
         nn:  Initialize our models here.
         optimizer: Initialize our optimizers.
+        checkpoint_writer: Writes checkpoints in the background if -acp/--async_checkpoint is set.
+        progress_plotter: Plots training progress from a background process while training.
+        loaders: Data loaders of the current fold, see data_loader().
+        prediction_writer: Saves predictions in background threads(-pwr/--prediction_writers).
+        grad_scaler: Scales the loss with -prc/--precision fp16, to keep small gradients from underflowing.
+        compile_env: Previous values of the environment variables set for torch.compile, restored in close_loaders().
         """
+        args = {**args}
+        if args.get('gpus') is None:
+            args['gpus'] = [0] if _config.cuda_available else []
+        if args.get('pin_memory') is None:
+            args['pin_memory'] = _config.cuda_available
         self.args = _etutils.FrozenDict(args)
         self.cache = _ODict()
         self.nn = _ODict()
         self.device = _ODict()
         self.optimizer = _ODict()
+        self.checkpoint_writer = _ckpt.AsyncCheckpointWriter()
+        self.progress_plotter = None
+        self.loaders = {}
+        self.prediction_writer = _predictions.PredictionWriter(self.args.get('prediction_writers', 2))
+        self.grad_scaler = None
+        self.compile_env = {}
 
     def init_nn(self, **kw):
         r"""
@@ -52,7 +100,94 @@ class ETTrainer:
 
         self._init_nn_weights(**kw)
         self._init_optimizer()
+        if self.args.get('channels_last'):
+            for k in self.nn:
+                self.nn[k] = self.nn[k].to(memory_format=_torch.channels_last)
         self._set_device()
+        self._compile_nn()
+        self.grad_scaler = self._new_grad_scaler()
+
+    def _compile_nn(self):
+        r"""
+        Compile the models with torch.compile if -cmp/--compile is set.
+        Compiled kernels are cached on disk(-ccd/--compile_cache_dir), so the next folds and runs reuse them
+         instead of compiling again. Checkpoints always have the state of the uncompiled models.
+        """
+        if not self.args.get('compile'):
+            return
+
+        """
+        Inductor reads these whenever it compiles(lazily, at the first call), so they stay set until the end of the
+         fold, and the previous values are restored then(close_loaders()).
+        """
+        env = {k: _os.environ.get(k, '1') for k in ['TORCHINDUCTOR_FX_GRAPH_CACHE', 'TORCHINDUCTOR_AUTOGRAD_CACHE']}
+        if self.args.get('compile_cache_dir'):
+            env['TORCHINDUCTOR_CACHE_DIR'] = _os.path.abspath(self.args['compile_cache_dir'])
+        for k, v in env.items():
+            self.compile_env.setdefault(k, _os.environ.get(k))
+            _os.environ[k] = v
+        """
+        Drop the compiled code of previous folds' models.
+        """
+        _torch._dynamo.reset()
+
+        dynamic = {'auto': None, 'true': True, 'false': False}[str(self.args.get('compile_dynamic', 'auto')).lower()]
+        for k in self.nn:
+            if isinstance(self.nn[k], _torch.nn.Module) and not hasattr(self.nn[k], '_orig_mod'):
+                self.nn[k] = _torch.compile(self.nn[k], mode=self.args.get('compile_mode', 'default'), dynamic=dynamic)
+
+    def _new_grad_scaler(self):
+        enabled = self.args.get('precision') == 'fp16'
+        try:
+            return _torch.amp.GradScaler(self.device['gpu'].type, enabled=enabled)
+        except (AttributeError, TypeError):
+            return _torch.cuda.amp.GradScaler(enabled=enabled and self.device['gpu'].type == 'cuda')
+
+    def autocast(self, precision=None):
+        r"""
+        Mixed precision context for -prc/--precision bf16(fast on cpus with AVX512-BF16/AMX, and recent gpus),
+         or fp16(gpus). Default fp32 does nothing.
+        """
+        dtype = {'bf16': _torch.bfloat16, 'fp16': _torch.float16}.get(precision or self.args.get('precision'))
+        if dtype is None:
+            return _contextlib.nullcontext()
+        return _torch.autocast(self.device['gpu'].type, dtype=dtype)
+
+    def _iteration(self, batch, precision=None):
+        r"""
+        Run the user iteration in the precision/memory format set by args.
+        """
+        if self.args.get('channels_last'):
+            batch = _to_channels_last(batch)
+        with self.autocast(precision):
+            return self.iteration(batch)
+
+    def compare_precision(self, batch, iterations=5):
+        r"""
+        Measure the training throughput(forward + backward, in samples/s) of a batch in -prc/--precision against fp32.
+        It runs on copies of the models(unwrapped from DataParallel/DistributedDataParallel/torch.compile), within
+         forked random states, so neither the models nor the random states of the training change.
+        Call it on all the ranks in distributed runs, in case a model syncs in forward(like SyncBatchNorm).
+        """
+        nn = self.nn
+        self.nn = _ODict((k, _copy.deepcopy(_unwrap(m))) for k, m in nn.items())
+        devices = [self.device['gpu']] if self.device['gpu'].type == 'cuda' else []
+        try:
+            with _torch.random.fork_rng(devices=devices):
+                throughput = {}
+                for k in self.nn:
+                    self.nn[k].train()
+                for precision in ['fp32', self.args.get('precision')]:
+                    for i in range(iterations + 1):
+                        if i == 1:
+                            start = _time.time()
+                        it = self._iteration(batch, precision)
+                        it['loss'].backward()
+                    throughput[precision] = iterations * (_get_batch_size(batch) or 1) / (_time.time() - start)
+        finally:
+            self.nn = nn
+        throughput['speedup'] = throughput[self.args.get('precision')] / throughput['fp32']
+        return throughput
 
     def _init_nn_weights(self, **kw):
         r"""
@@ -67,6 +202,11 @@ class ETTrainer:
                 _init_weights(self.nn[mk])
 
     def load_checkpoint_from_key(self, key='checkpoint'):
+        r"""
+        Wait for any checkpoint being written in the background(and the master, in distributed runs) first.
+        """
+        self.checkpoint_writer.flush()
+        _dist_utils.barrier()
         self.load_checkpoint(self.cache['log_dir'] + _sep + self.cache[key])
 
     def load_checkpoint(self, full_path):
@@ -81,23 +221,20 @@ class ETTrainer:
             chk = _torch.load(full_path, map_location='cpu')
 
         if chk.get('source', 'Unknown').lower() == 'easytorch':
-            for m in chk['models']:
-                try:
-                    self.nn[m].module.load_state_dict(chk['models'][m])
-                except:
-                    self.nn[m].load_state_dict(chk['models'][m])
-
-            for m in chk['optimizers']:
-                try:
-                    self.optimizer[m].module.load_state_dict(chk['optimizers'][m])
-                except:
-                    self.optimizer[m].load_state_dict(chk['optimizers'][m])
+            self._load_state_dicts(chk)
         else:
             mkey = list(self.nn.keys())[0]
+            _unwrap(self.nn[mkey]).load_state_dict(chk)
+
+    def _load_state_dicts(self, chk):
+        for m in chk['models']:
+            _unwrap(self.nn[m]).load_state_dict(chk['models'][m])
+
+        for m in chk['optimizers']:
             try:
-                self.nn[mkey].module.load_state_dict(chk)
+                self.optimizer[m].module.load_state_dict(chk['optimizers'][m])
             except:
-                self.nn[mkey].load_state_dict(chk)
+                self.optimizer[m].load_state_dict(chk['optimizers'][m])
 
     def _init_nn_model(self):
         r"""
@@ -110,8 +247,13 @@ class ETTrainer:
         Initialize GPUs based on whats provided in args(Default [0])
         Expects list of GPUS as [0, 1, 2, 3]., list of GPUS will make it use DataParallel.
         If no GPU is present, CPU is used.
+        In distributed runs(-ws/--world_size > 1), each rank uses DistributedDataParallel instead.
         """
         self.device['gpu'] = _torch.device("cpu")
+        if _dist_utils.is_distributed():
+            self._set_distributed_device()
+            return
+
         if _config.cuda_available and len(self.args['gpus']) >= 1:
             self.device['gpu'] = _torch.device(f"cuda:{self.args['gpus'][0]}")
             if len(self.args['gpus']) >= 2:
@@ -120,6 +262,22 @@ class ETTrainer:
         for model_key in self.nn:
             self.nn[model_key] = self.nn[model_key].to(self.device['gpu'])
 
+    def _set_distributed_device(self):
+        r"""
+        One process per rank. Ranks are assigned to the listed GPUs in round robin, or all use CPU.
+        Only models with trainable parameters are wrapped in DistributedDataParallel.
+        """
+        device_ids = None
+        if _config.cuda_available and len(self.args['gpus']) >= 1:
+            gpu = self.args['gpus'][_dist_utils.get_rank() % len(self.args['gpus'])]
+            self.device['gpu'] = _torch.device(f"cuda:{gpu}")
+            device_ids = [gpu]
+        for model_key in self.nn:
+            self.nn[model_key] = self.nn[model_key].to(self.device['gpu'])
+            if any(p.requires_grad for p in self.nn[model_key].parameters()):
+                self.nn[model_key] = _torch.nn.parallel.DistributedDataParallel(self.nn[model_key],
+                                                                                device_ids=device_ids)
+
     def _init_optimizer(self):
         r"""
         Initialize required optimizers here. Default is Adam,
@@ -142,45 +300,98 @@ class ETTrainer:
         """
         return _base_metrics.ETAverages(num_averages=1)
 
-    def check_previous_logs(self):
+    def check_previous_logs(self, experiment_ids=None):
         r"""
         Checks if there already is a previous run and prompt[Y/N] so that
         we avoid accidentally overriding previous runs and lose temper.
         User can supply -f True flag to override by force.
+        @param experiment_ids: Check all of these(like all the folds) with one prompt. Default is the current one.
         """
+        if not _dist_utils.is_master():
+            return
+        if self.args.get('resume'):
+            return
         if self.args['force']:
             warn('Forced overriding previous logs.')
             return
         i = 'y'
-        if self.args['phase'] == 'train':
-            train_log = f"{self.cache['log_dir']}{_sep}{self.cache['experiment_id']}_log.json"
-            if _os.path.exists(train_log):
-                i = input(f"*** {train_log} *** \n Exists. OVERRIDE [y/n]:")
-
-        if self.args['phase'] == 'test':
-            test_log = f"{self.cache['log_dir']}{_sep}{self.cache['experiment_id']}_test_scores.csv"
-            if _os.path.exists(test_log):
-                if _os.path.exists(test_log):
-                    i = input(f"*** {test_log} *** \n Exists. OVERRIDE [y/n]:")
+        suffix = {'train': '_log.jsonl', 'test': '_test_scores.csv'}.get(self.args['phase'])
+        if suffix:
+            logs = [f"{self.cache['log_dir']}{_sep}{e}{suffix}" for e in
+                    experiment_ids or [self.cache['experiment_id']]]
+            logs = [log for log in logs if _os.path.exists(log)]
+            if logs:
+                i = input(f"*** {', '.join(logs)} *** \n Exists. OVERRIDE [y/n]:")
 
         if i.lower() == 'n':
             raise FileExistsError(f' ##### {self.args["log_dir"]} directory is not empty. #####')
 
-    def save_checkpoint(self, file_name, src='easytorch'):
-        checkpoint = {'source': src}
+    def _state_dicts(self):
+        checkpoint = {'models': {}, 'optimizers': {}}
         for k in self.nn:
-            checkpoint['models'] = {}
-            try:
-                checkpoint['models'][k] = self.nn[k].module.state_dict()
-            except:
-                checkpoint['models'][k] = self.nn[k].state_dict()
+            checkpoint['models'][k] = _unwrap(self.nn[k]).state_dict()
         for k in self.optimizer:
-            checkpoint['optimizers'] = {}
             try:
                 checkpoint['optimizers'][k] = self.optimizer[k].module.state_dict()
             except:
                 checkpoint['optimizers'][k] = self.optimizer[k].state_dict()
-        _torch.save(checkpoint, self.cache['log_dir'] + _sep + file_name)
+        return checkpoint
+
+    def _write_checkpoint(self, checkpoint, file_name):
+        if self.args.get('async_checkpoint'):
+            self.checkpoint_writer.save(_ckpt.snapshot(checkpoint), self.cache['log_dir'] + _sep + file_name)
+        else:
+            _ckpt.atomic_save(checkpoint, self.cache['log_dir'] + _sep + file_name)
+
+    def save_checkpoint(self, file_name, src='easytorch'):
+        if not _dist_utils.is_master():
+            return
+        self._write_checkpoint({'source': src, **self._state_dicts()}, file_name)
+
+    def save_training_state(self, epoch, done=False):
+        r"""
+        Save everything needed to resume training of the current fold after the given epoch:
+            models, optimizers, logs/best scores in cache, and the random number generator states of this process.
+        Training resumes from the start of the next epoch; an epoch interrupted midway is run again from its start.
+        Data loader shuffling(and seeding of non-persistent workers) is driven by the torch random state, and
+         distributed samplers by the epoch, so a resumed run sees the same batches as an uninterrupted one.
+        Random states inside -pw/--persistent_workers data loader workers carry over between epochs and are not saved,
+         so random augmentations done there differ after resuming.
+        """
+        if not _dist_utils.is_master():
+            return
+        state = {'source': 'easytorch', 'epoch': epoch, 'done': done, **self._state_dicts(),
+                 'cache': {k: self.cache[k] for k in ['training_log', 'validation_log', 'image_cache_log', 'best_score',
+                                                      'best_epoch'] if k in self.cache},
+                 'rng': {'torch': _torch.get_rng_state(),
+                         'cuda': _torch.cuda.get_rng_state_all() if _config.cuda_available else [],
+                         'numpy': _np.random.get_state(),
+                         'random': _random.getstate()},
+                 'grad_scaler': self.grad_scaler.state_dict() if self.grad_scaler is not None else {}}
+        self._write_checkpoint(state, self.cache['training_state'])
+
+    def load_training_state(self):
+        r"""
+        Restore the state saved by save_training_state(if any) for the current fold.
+        Returns the last completed epoch(0 if nothing to resume from), and whether training of this fold was complete.
+        """
+        full_path = self.cache['log_dir'] + _sep + self.cache['training_state']
+        if not _os.path.exists(full_path):
+            return 0, False
+
+        state = _ckpt.load(full_path, map_location='cpu')
+        self._load_state_dicts(state)
+        self.cache.update(**state['cache'])
+        if state.get('grad_scaler') and self.grad_scaler is not None:
+            self.grad_scaler.load_state_dict(state['grad_scaler'])
+        _torch.set_rng_state(state['rng']['torch'])
+        if _config.cuda_available and state['rng']['cuda']:
+            _torch.cuda.set_rng_state_all(state['rng']['cuda'])
+        _np.random.set_state(state['rng']['numpy'])
+        _random.setstate(state['rng']['random'])
+        if self.args['verbose']:
+            success(f"Resuming {self.cache['experiment_id']} after epoch {state['epoch']}.")
+        return state['epoch'], state['done']
 
     def reset_dataset_cache(self):
         r"""
@@ -205,6 +416,34 @@ class ETTrainer:
         """
         pass
 
+    def data_loader(self, dataset, **kw):
+        r"""
+        Data loader of a dataset, created once and reused(with its workers if -pw/--persistent_workers)
+         in all the epochs and validation passes until close_loaders().
+        A loader is reused only for the same dataset with the same keyword arguments(mode, shuffle, sampler...).
+        """
+        key = (id(dataset), *sorted((k, _hashable(v)) for k, v in kw.items()))
+        if key not in self.loaders:
+            """
+            Keep the dataset along with its loader, so that its id is not reused by another dataset meanwhile.
+            """
+            self.loaders[key] = dataset, _etdata.ETDataLoader.new(dataset=dataset, **{**self.args, **kw})
+        return self.loaders[key][1]
+
+    def close_loaders(self):
+        r"""
+        Drop all the data loaders, which shuts down their workers once they are garbage collected.
+         Called at the end of each fold. Also restores the environment variables set for torch.compile.
+        """
+        self.loaders = {}
+        _gc.collect()
+        for k, v in self.compile_env.items():
+            if v is None:
+                _os.environ.pop(k, None)
+            else:
+                _os.environ[k] = v
+        self.compile_env = {}
+
     def reset_fold_cache(self):
         """Nothing specific to do here.
         Just keeping in case we need to intervene with each of the k-folds just like each datasets above.
@@ -213,14 +452,18 @@ class ETTrainer:
 
     def save_if_better(self, epoch, metrics):
         r"""
-        Save the current model as best if it has better validation scores.
+        Save the current model as best if it has strictly better validation scores, so ties keep the earlier model.
+        Nothing saved in this fold yet(best_epoch 0, which a resumed fold restores from its training state), saves
+         in any case(even with a score like nan), so that the test phase never loads a stale checkpoint. A nan best
+         score is replaced by the next epoch.
         """
         sc = getattr(metrics, self.cache['monitor_metric'])
         if callable(sc):
             sc = sc()
 
-        if (self.cache['metric_direction'] == 'maximize' and sc >= self.cache['best_score']) or (
-                self.cache['metric_direction'] == 'minimize' and sc <= self.cache['best_score']):
+        first = self.cache['best_epoch'] == 0 or _math.isnan(self.cache['best_score'])
+        if first or (self.cache['metric_direction'] == 'maximize' and sc > self.cache['best_score']) or (
+                self.cache['metric_direction'] == 'minimize' and sc < self.cache['best_score']):
             self.save_checkpoint(self.cache['checkpoint'])
             self.cache['best_score'] = sc
             self.cache['best_epoch'] = epoch
@@ -243,7 +486,7 @@ class ETTrainer:
                     sc = self.new_metrics()
                     sc.add(pred, labels)
                     avg = self.new_averages()
-                    avg.add(loss.item(), len(inputs))
+                    avg.add(loss, len(inputs))
                     return {'loss': loss, 'averages': avg, 'output': out, 'metrics': sc, 'predictions': pred}
                 }
         Note: loss, averages, and metrics are required, whereas others are optional
@@ -258,8 +501,21 @@ class ETTrainer:
         If one needs to save complex predictions result like predicted segmentations.
          -Especially with U-Net architectures, we split images and train.
         Once the argument --sp/-sparse-load is set to True,
-        the argument 'its' will receive all the patches of single image at a time.
+        the argument 'its' will receive all the patches of single image at a time,
+         and dataset will only have the indices of that image.
         From there, we can recreate the whole image.
+        Iteration outputs are only kept in memory for this if it is implemented. To save predictions of a large
+         dataset without keeping them all, use save_batch_predictions() instead.
+        """
+        pass
+
+    def save_batch_predictions(self, dataset, batch, it):
+        r"""
+        Called with every batch and its iteration output while saving predictions(test phase), so nothing needs
+         to be kept in memory. Pass what to write to self.prediction_writer, that saves them in the background
+         while evaluation goes on. Example:
+            for file, pred in zip(batch['file'], it['predictions']):
+                self.prediction_writer.save(self.cache['log_dir'] + os.sep + file + '.png', pred.byte() * 255)
         """
         pass
 
@@ -279,32 +535,62 @@ class ETTrainer:
 
         eval_avg = self.new_averages()
         eval_metrics = self.new_metrics()
-        val_loaders = [_etdata.ETDataLoader.new(mode='eval', shuffle=False, dataset=d, **self.args) for d in
-                       dataset_list]
+        """
+        Validation is split among the ranks in distributed runs and the scores are reduced at the end.
+        Predictions need all of the data, so each rank runs the whole dataset when saving them.
+        """
+        write_pred = save_pred and _dist_utils.is_master()
+        keep_its = write_pred and type(self).save_predictions is not ETTrainer.save_predictions
         with _torch.no_grad():
-            for loader in val_loaders:
+            for dataset in dataset_list:
+                """
+                Sparse datasets(see ETDataset.add_sparse) run in one data loader, that never mixes two groups
+                 in a batch. Metrics are logged, and predictions saved, at the end of each group.
+                """
+                groups = dataset.groups if save_pred and getattr(dataset, 'groups', None) else [(0, len(dataset))]
+                sampler = _etdata.GroupedBatchSampler(groups, self.args['batch_size']) if len(groups) > 1 else None
+                loader = self.data_loader(mode='eval', shuffle=False, dataset=dataset, distributed=not save_pred,
+                                          batch_sampler=sampler)
+                group_ends = sampler.group_ends if sampler else {len(loader) - 1: 0}
+                sparse = len(dataset_list) > 1 or len(groups) > 1
+
                 its = []
                 metrics = self.new_metrics()
                 avg = self.new_averages()
                 for i, batch in enumerate(loader):
-
-                    it = self.iteration(batch)
-                    if not it.get('metrics'):
-                        it['metrics'] = _base_metrics.ETMetrics()
-
-                    metrics.accumulate(it['metrics'])
-                    avg.accumulate(it['averages'])
-                    if save_pred:
-                        its.append(it)
-                    if self.args['verbose'] and len(dataset_list) <= 1 and i % int(_math.log(i + 1) + 1) == 0:
-                        info(f"Itr:{i}/{len(loader)}, {it['averages'].get()}, {it['metrics'].get()}")
-
-                eval_metrics.accumulate(metrics)
-                eval_avg.accumulate(avg)
-                if self.args['verbose'] and len(dataset_list) > 1:
-                    info(f"{split_key}, {avg.get()}, {metrics.get()}")
-                if save_pred:
-                    self.save_predictions(loader.dataset, its)
+                    """
+                    A batch with no loadable items is None, but still counts for group_ends.
+                    """
+                    if batch is not None:
+                        it = self._iteration(batch)
+                        if not it.get('metrics'):
+                            it['metrics'] = _base_metrics.ETMetrics()
+
+                        metrics.accumulate(it['metrics'])
+                        avg.accumulate(it['averages'])
+                        if write_pred:
+                            self.save_batch_predictions(dataset, batch, it)
+                        if keep_its:
+                            its.append(it)
+                        if self.args['verbose'] and not sparse and i % int(_math.log(i + 1) + 1) == 0:
+                            info(f"Itr:{i}/{len(loader)}, {it['averages'].get()}, {it['metrics'].get()}")
+
+                    if i in group_ends:
+                        eval_metrics.accumulate(metrics)
+                        eval_avg.accumulate(avg)
+                        if self.args['verbose'] and sparse:
+                            info(f"{split_key}, {avg.get()}, {metrics.get()}")
+                        if keep_its and its:
+                            start, end = groups[group_ends[i]]
+                            self.save_predictions(dataset.subset(start, end) if sampler else dataset, its)
+                        its = []
+                        metrics = self.new_metrics()
+                        avg = self.new_averages()
+
+        if write_pred:
+            self.prediction_writer.close()
+        if not save_pred:
+            _dist_utils.all_reduce_metrics(eval_avg, eval_metrics)
 
         if self.args['verbose']:
             info(f"{self.cache['experiment_id']} {split_key} metrics: {eval_metrics.get()}")
@@ -314,21 +600,52 @@ class ETTrainer:
         r"""
         Learning step for one batch.
         We decoupled it so that user could implement any complex/multi/alternate training strategies.
+        With -ni/--num_iteration > 1, the batch is split into that many micro-batches that run one by one,
+         accumulating gradients with each loss weighted by the size of its micro-batch, then the optimizer steps once.
+        So a batch that does not fit in memory at once gives the same update as if it did.
         """
         first_optim = list(self.optimizer.keys())[0]
         self.optimizer[first_optim].zero_grad()
         its = []
-        for i in range(self.cache.get('num_iteration', 1)):
-            """Accumulate gradients"""
-            it = self.iteration(batch)
-            it['loss'].backward()
-            its.append(it)
-        self.optimizer[first_optim].step()
+        micro_batches = _split_batch(batch, self.args.get('num_iteration', 1))
+        with _contextlib.ExitStack() as no_sync:
+            for i, (micro_batch, weight) in enumerate(micro_batches, 1):
+                if i == len(micro_batches):
+                    """
+                    Gradients are all reduced across the ranks only with the last micro-batch.
+                    """
+                    no_sync.close()
+                elif i == 1:
+                    for m in self.nn.values():
+                        if hasattr(m, 'no_sync'):
+                            no_sync.enter_context(m.no_sync())
+
+                it = self._iteration(micro_batch)
+                if self.grad_scaler is not None:
+                    self.grad_scaler.scale(it['loss'] * weight).backward()
+                else:
+                    (it['loss'] * weight).backward()
+                it['weight'] = weight
+                its.append(it)
+        """
+        grad_scaler is None if init_nn() is overridden without setting it.
+        """
+        if self.grad_scaler is not None:
+            self.grad_scaler.step(self.optimizer[first_optim])
+            self.grad_scaler.update()
+        else:
+            self.optimizer[first_optim].step()
         return self._reduce_iteration(its)
 
     def _reduce_iteration(self, its):
+        r"""
+        Merge outputs of the micro-batches: averages and metrics are accumulated, scalar tensors(like loss) are
+         averaged by micro-batch size, other tensors are concatenated(detached), and everything else is listed.
+        """
         if len(its) == 1:
+            its[0].pop('weight', None)
             return its[0]
+        weights = [ik.pop('weight', 1 / len(its)) for ik in its]
         reduced = {}.fromkeys(its[0].keys(), None)
         for k in reduced:
             if isinstance(its[0][k], _base_metrics.ETAverages):
@@ -339,8 +656,11 @@ class ETTrainer:
                 reduced[k] = self.new_metrics()
                 [reduced[k].accumulate(ik[k]) for ik in its]
 
-            elif isinstance(its[0][k], _torch.Tensor) and not its[0][k].requires_grad and its[0][k].is_leaf:
-                reduced[k] = _torch.cat([ik[k] for ik in its])
+            elif isinstance(its[0][k], _torch.Tensor) and its[0][k].dim() == 0:
+                reduced[k] = sum(ik[k].detach() * w for ik, w in zip(its, weights))
+
+            elif isinstance(its[0][k], _torch.Tensor):
+                reduced[k] = _torch.cat([ik[k].detach() for ik in its])
 
             else:
                 reduced[k] = [ik[k] for ik in its]
@@ -350,8 +670,9 @@ class ETTrainer:
         r"""
         Any logic to run after an epoch ends.
         """
-        _log_utils.plot_progress(self.cache, experiment_id=self.cache['experiment_id'],
-                                 plot_keys=['training_log', 'validation_log'], epoch=ep)
+        if self.progress_plotter is not None:
+            self.progress_plotter.update(self.cache, experiment_id=self.cache['experiment_id'],
+                                         plot_keys=['training_log', 'validation_log'], epoch=ep)
 
     def _on_iteration_end(self, i, ep, it):
         r"""
@@ -373,46 +694,96 @@ class ETTrainer:
         r"""
         Main training loop.
         """
-        train_loader = _etdata.ETDataLoader.new(mode='train', shuffle=True, dataset=dataset, **self.args)
-        for ep in range(1, self.args['epochs'] + 1):
-            if self.args['verbose']: info('')
-
-            for k in self.nn:
-                self.nn[k].train()
-
-            _metrics = self.new_metrics()
-            _avg = self.new_averages()
-            ep_avg = self.new_averages()
-            ep_metrics = self.new_metrics()
-            for i, batch in enumerate(train_loader, 1):
-
-                it = self.training_iteration(batch)
-                if not it.get('metrics'):
-                    it['metrics'] = _base_metrics.ETMetrics()
+        train_loader = self.data_loader(mode='train', shuffle=True, dataset=dataset)
+
+        start_ep = 1
+        if self.args.get('resume'):
+            last_ep, done = self.load_training_state()
+            if done:
+                return
+            start_ep = last_ep + 1
+
+        if self.args.get('compare_precision') and self.args.get('precision', 'fp32') != 'fp32':
+            """
+            The first batch_size samples collated here, so that the training loader(its sampler and workers) is left
+             as it is, and no other loader loads(or materializes) the dataset.
+            """
+            batch = _etdata.safe_collate([dataset[i] for i in range(min(self.args['batch_size'], len(dataset)))])
+            if batch is not None:
+                throughput = self.compare_precision(batch)
+                if _dist_utils.is_master():
+                    info(f"Throughput(samples/s) of {self.args['precision']} vs fp32: {throughput}")
+
+        if _dist_utils.is_master():
+            from .vision import plotter as _log_utils
+            self.progress_plotter = _log_utils.ProgressPlotter(min_interval=self.args.get('plot_interval', 10))
+            self.progress_plotter.start()
 
-                ep_avg.accumulate(it['averages'])
-                ep_metrics.accumulate(it['metrics'])
+        try:
+            for ep in range(start_ep, self.args['epochs'] + 1):
+                if self.args['verbose']: info('')
+
+                for k in self.nn:
+                    self.nn[k].train()
+
+                for sampler in [train_loader.sampler, train_loader.batch_sampler]:
+                    if hasattr(sampler, 'set_epoch'):
+                        sampler.set_epoch(ep)
+
+                _metrics = self.new_metrics()
+                _avg = self.new_averages()
+                ep_avg = self.new_averages()
+                ep_metrics = self.new_metrics()
+                ep_start, ep_samples = _time.time(), 0
+                for i, batch in enumerate(train_loader, 1):
+                    if batch is None:
+                        continue
+                    ep_samples += _get_batch_size(batch) or 0
+
+                    it = self.training_iteration(batch)
+                    if not it.get('metrics'):
+                        it['metrics'] = _base_metrics.ETMetrics()
 
-                """
-                Running loss/metrics
-                """
-                _avg.accumulate(it['averages'])
-                _metrics.accumulate(it['metrics'])
-                if self.args['verbose'] and i % int(_math.log(i + 1) + 1) == 0:
-                    info(f"Ep:{ep}/{self.args['epochs']},Itr:{i}/{len(train_loader)},"
-                         f"{_avg.get()},{_metrics.get()}")
-
-                    self.cache['training_log'].append([*_avg.get(), *_metrics.get()])
-                    _metrics.reset()
-                    _avg.reset()
-
-                self._on_iteration_end(i, ep, it)
-
-            self.cache['training_log'].append([*ep_avg.get(), *ep_metrics.get()])
-            val_loss, val_metric = self.evaluation(split_key='validation', dataset_list=[val_dataset])
-            self.save_if_better(ep, val_metric)
-            self.cache['validation_log'].append([*val_loss.get(), *val_metric.get()])
-
-            self._on_epoch_end(ep, ep_avg, ep_metrics, val_loss, val_metric)
-            if self._early_stopping(ep, ep_avg, ep_metrics, val_loss, val_metric):
-                break
+                    ep_avg.accumulate(it['averages'])
+                    ep_metrics.accumulate(it['metrics'])
+
+                    """
+                    Running loss/metrics
+                    """
+                    _avg.accumulate(it['averages'])
+                    _metrics.accumulate(it['metrics'])
+                    if self.args['verbose'] and i % int(_math.log(i + 1) + 1) == 0:
+                        info(f"Ep:{ep}/{self.args['epochs']},Itr:{i}/{len(train_loader)},"
+                             f"{_avg.get()},{_metrics.get()}")
+
+                        self.cache['training_log'].append([*_avg.get(), *_metrics.get()])
+                        _metrics.reset()
+                        _avg.reset()
+
+                    self._on_iteration_end(i, ep, it)
+
+                _dist_utils.all_reduce_metrics(ep_avg, ep_metrics)
+                self.cache['training_log'].append([*ep_avg.get(), *ep_metrics.get()])
+                if self.args['verbose']:
+                    info(f"Ep:{ep} throughput: {ep_samples / (_time.time() - ep_start):.1f} samples/s")
+                if getattr(dataset, 'array_cache', None) is not None:
+                    self.cache.setdefault('image_cache_log', []).append({'epoch': ep, **dataset.array_cache.stats()})
+                    if self.args['verbose']:
+                        info(f"Image cache: {self.cache['image_cache_log'][-1]}")
+                val_loss, val_metric = self.evaluation(split_key='validation', dataset_list=[val_dataset])
+                self.save_if_better(ep, val_metric)
+                self.cache['validation_log'].append([*val_loss.get(), *val_metric.get()])
+                if _dist_utils.is_master():
+                    _etutils.save_cache(self.cache, experiment_id=self.cache['experiment_id'])
+
+                self._on_epoch_end(ep, ep_avg, ep_metrics, val_loss, val_metric)
+                stop = self._early_stopping(ep, ep_avg, ep_metrics, val_loss, val_metric)
+                if self.args.get('resume') and (stop or ep == self.args['epochs'] or ep % self.args['state_freq'] == 0):
+                    self.save_training_state(ep, done=stop or ep == self.args['epochs'])
+                if stop:
+                    break
+            self.checkpoint_writer.flush()
+        finally:
+            if self.progress_plotter is not None:
+                self.progress_plotter.close()
+                self.progress_plotter = None
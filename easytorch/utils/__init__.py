@@ -1,5 +1,4 @@
 import os as _os
-import copy as _copy
 import json as _json
 
 
@@ -59,8 +58,104 @@ def clean_recursive(obj):
             obj[k] = f'{v}'
 
 
+def _to_json(obj):
+    r"""
+    Numpy arrays/numbers, tensors as lists/numbers, and anything else that json does not know as string.
+    """
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return f'{obj}'
+
+
+def _json_keys(obj):
+    r"""
+    Dict keys that json can not take(like tuples) as strings. json.dumps(default=...) is not called for keys.
+    """
+    if isinstance(obj, dict):
+        return {k if k is None or isinstance(k, (str, int, float, bool)) else f'{k}': _json_keys(v)
+                for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_json_keys(v) for v in obj]
+    return obj
+
+
+class ExperimentLog:
+    def __init__(self, path):
+        r"""
+        Append only json lines log of an experiment.
+        Keys ending with _log(like training_log) hold rows, and only rows added since the last write are appended.
+        Everything else is meta data, and is only written again when it changes.
+        The first write replaces the file at path with the whole cache. So a resumed run(whose cache holds the rows
+         restored from the training state) drops the rows logged after that state, instead of the whole log.
+        Use load_cache() to read it back as the cache it was written from.
+        """
+        self.path = path
+        self._num_rows = {}
+        self._meta = {}
+        self._started = False
+
+    def write(self, cache):
+        lines, meta = [], []
+        for k, v in cache.items():
+            if k.endswith('_log') and isinstance(v, list):
+                n = self._num_rows.get(k, 0)
+                if len(v) < n:
+                    lines.append(_json.dumps({'reset': k}))
+                    n = 0
+                lines += [_json.dumps({'key': k, 'row': _json_keys(row)}, default=_to_json) for row in v[n:]]
+                self._num_rows[k] = len(v)
+            else:
+                value = _json.dumps(_json_keys(v), default=_to_json)
+                if self._meta.get(k) != value:
+                    meta.append(f'{_json.dumps(str(k))}: {value}')
+                    self._meta[k] = value
+
+        if meta:
+            lines.insert(0, '{"meta": {' + ', '.join(meta) + '}}')
+        if not self._started:
+            with open(self.path + '.tmp', 'w') as fp:
+                fp.write(''.join(ln + '\n' for ln in lines))
+            _os.replace(self.path + '.tmp', self.path)
+            self._started = True
+        elif lines:
+            with open(self.path, 'a') as fp:
+                fp.write('\n'.join(lines) + '\n')
+
+
+_experiment_logs = {}
+
+
+def reset_cache_log(log_dir, experiment_id=''):
+    r"""
+    Forget what was written to <log_dir>/<experiment_id>_log.jsonl so far in this process.
+    Called when a fold starts, so that the next save_cache() writes the file anew from that run's cache.
+    """
+    _experiment_logs.pop(log_dir + _os.sep + f"{experiment_id}_log.jsonl", None)
+
+
 def save_cache(cache, experiment_id=''):
-    with open(cache['log_dir'] + _os.sep + f"{experiment_id}_log.json", 'w') as fp:
-        log = _copy.deepcopy(cache)
-        clean_recursive(log)
-        _json.dump(log, fp)
+    r"""
+    Append what is new in the cache to <log_dir>/<experiment_id>_log.jsonl.
+    The file is written anew the first time it is saved to after reset_cache_log()(or in a process).
+    """
+    path = cache['log_dir'] + _os.sep + f"{experiment_id}_log.jsonl"
+    if path not in _experiment_logs:
+        _experiment_logs[path] = ExperimentLog(path)
+    _experiment_logs[path].write(cache)
+
+
+def load_cache(log_dir, experiment_id=''):
+    r"""
+    Rebuild the cache saved with save_cache() as a single dict.
+    """
+    cache = {}
+    with open(log_dir + _os.sep + f"{experiment_id}_log.jsonl") as fp:
+        for line in fp:
+            record = _json.loads(line)
+            if 'meta' in record:
+                cache.update(record['meta'])
+            elif 'reset' in record:
+                cache[record['reset']] = []
+            else:
+                cache.setdefault(record['key'], []).append(record['row'])
+    return cache
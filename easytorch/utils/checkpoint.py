@@ -0,0 +1,104 @@
+r"""
+Write checkpoints from a background thread so that the training loop does not wait for the disk.
+"""
+
+import os as _os
+import threading as _threading
+from collections import OrderedDict as _ODict
+
+import torch as _torch
+
+
+def snapshot(obj):
+    r"""
+    Copy all the tensors in a (nested) checkpoint to cpu memory.
+    Training can then go on updating the weights while the copy is being written.
+    """
+    if isinstance(obj, _torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        copied = type(obj)((k, snapshot(v)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):
+            copied._metadata = obj._metadata
+        return copied
+    if isinstance(obj, list):
+        return [snapshot(v) for v in obj]
+    if type(obj) is tuple:
+        return tuple(snapshot(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    r"""
+    Save to a temporary file first and rename, so a crash while writing never leaves a broken checkpoint.
+    """
+    tmp = f'{path}.tmp'
+    _torch.save(obj, tmp)
+    _os.replace(tmp, path)
+
+
+class AsyncCheckpointWriter:
+    def __init__(self):
+        r"""
+        Writes checkpoints one by one in a background thread.
+        If a newer checkpoint for the same path comes before the previous one is written,
+         only the newer one is written.
+        """
+        self._pending = _ODict()
+        self._writing = False
+        self._error = None
+        self._thread = None
+        self._cond = _threading.Condition()
+
+    def save(self, obj, path):
+        r"""
+        obj must not be modified after this call. Use snapshot() to get a safe copy of state_dicts.
+        """
+        with self._cond:
+            self._raise_error()
+            self._pending.pop(path, None)
+            self._pending[path] = obj
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = _threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def flush(self):
+        r"""
+        Wait until all the pending checkpoints are written.
+        """
+        with self._cond:
+            while self._pending or self._writing:
+                self._cond.wait()
+            self._raise_error()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                path, obj = self._pending.popitem(last=False)
+                self._writing = True
+            try:
+                atomic_save(obj, path)
+            except Exception as e:
+                self._error = e
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+
+    def _raise_error(self):
+        if self._error is not None:
+            e, self._error = self._error, None
+            raise RuntimeError(f'Failed to write checkpoint: {e}') from e
+
+
+def load(path, map_location=None):
+    r"""
+    Full training states have non tensor objects(like numpy random state) that newer torch does not load by default.
+    """
+    try:
+        return _torch.load(path, map_location=map_location, weights_only=False)
+    except TypeError:
+        return _torch.load(path, map_location=map_location)
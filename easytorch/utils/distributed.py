@@ -0,0 +1,107 @@
+r"""
+Helpers for multi-process data parallel(DistributedDataParallel) runs.
+Everything falls back to single process behaviour if no process group is initialized.
+"""
+
+import os as _os
+
+import numpy as _np
+import torch as _torch
+import torch.distributed as _dist
+
+
+def is_distributed():
+    return _dist.is_available() and _dist.is_initialized()
+
+
+def get_rank():
+    return _dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return _dist.get_world_size() if is_distributed() else 1
+
+
+def is_master():
+    r"""
+    Only the master(rank 0) process writes checkpoints, logs, and plots.
+    """
+    return get_rank() == 0
+
+
+def launched_externally():
+    r"""
+    True if ranks are started by an external launcher like torchrun, which sets RANK/WORLD_SIZE.
+    """
+    return 'RANK' in _os.environ and 'WORLD_SIZE' in _os.environ
+
+
+def init_process_group(args, rank=None):
+    r"""
+    Join the process group using -dbe/--dist_backend(Default gloo, which works on CPUs).
+    If rank is given, it is a local rank spawned by easytorch that rendezvous at -du/--dist_url.
+    Else rank, world size, and rendezvous are read from environment variables set by the launcher.
+    """
+    if rank is None:
+        _dist.init_process_group(backend=args['dist_backend'], init_method='env://')
+    else:
+        _dist.init_process_group(backend=args['dist_backend'], init_method=args['dist_url'],
+                                 rank=rank, world_size=args['world_size'])
+
+
+def barrier():
+    if is_distributed():
+        _dist.barrier()
+
+
+def _reduce_device(values):
+    r"""
+    nccl reduces on the gpu of this rank(where the counts already are), gloo on cpu.
+    """
+    if _dist.get_backend() != 'nccl':
+        return _torch.device('cpu')
+    for v in values:
+        if isinstance(v, _torch.Tensor) and v.is_cuda:
+            return v.device
+    return _torch.device('cuda', _torch.cuda.current_device())
+
+
+def _restore(reduced, like):
+    if isinstance(like, _torch.Tensor):
+        return reduced.to(like.device, like.dtype).reshape(like.shape)
+    if isinstance(like, _np.ndarray):
+        return reduced.cpu().numpy().astype(like.dtype).reshape(like.shape)
+    return type(like)(reduced.item())
+
+
+def all_reduce_metrics(*metrics):
+    r"""
+    Sum up the content of given ETMetrics/ETAverages across all ranks, in place.
+    Counts listed in _reducible_(like tp, fp, tn, fn of Prf1a) are summed with a single all_reduce on the device
+     of this rank. Other implementations are gathered as objects, and merged by their accumulate/reset contract.
+    """
+    if not is_distributed():
+        return
+    for m in metrics:
+        keys = getattr(m, '_reducible_', None)
+        if not keys:
+            gathered = [None] * get_world_size()
+            _dist.all_gather_object(gathered, m)
+            m.reset()
+            for other in gathered:
+                m.accumulate(other)
+            continue
+
+        values = [getattr(m, k) for k in keys]
+        device = _reduce_device(values)
+        flat = [_torch.as_tensor(_np.asarray(v) if not isinstance(v, _torch.Tensor) else v)
+                .to(device, _torch.float64).reshape(-1) for v in values]
+        reduced = _torch.cat(flat)
+        _dist.all_reduce(reduced)
+        for k, v, r in zip(keys, values, reduced.split([f.numel() for f in flat])):
+            setattr(m, k, _restore(r, v))
+
+
+def destroy_process_group():
+    if is_distributed():
+        _dist.destroy_process_group()
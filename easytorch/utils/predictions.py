@@ -0,0 +1,102 @@
+r"""
+Save predictions from a few background threads while evaluation goes on.
+"""
+
+import csv as _csv
+import os as _os
+import threading as _threading
+from concurrent import futures as _futures
+
+import numpy as _np
+import torch as _torch
+
+
+def _to_numpy(obj):
+    if isinstance(obj, _torch.Tensor):
+        return obj.detach().cpu().numpy()
+    return obj
+
+
+def _to_cpu(obj):
+    if isinstance(obj, _torch.Tensor):
+        return obj.detach().cpu()
+    return obj
+
+
+def write(path, obj):
+    r"""
+    Write an array(or tensor) by the extension of path: .npy, .pt(as a tensor), .csv(rows),
+     or an image(.png, .jpg, .tif...).
+    """
+    ext = _os.path.splitext(path)[1].lower()
+    if ext == '.npy':
+        _np.save(path, _to_numpy(obj))
+    elif ext == '.pt':
+        _torch.save(_torch.as_tensor(obj) if isinstance(obj, _np.ndarray) else obj, path)
+    elif ext == '.csv':
+        with open(path, 'w', newline='') as f:
+            _csv.writer(f).writerows(_np.asarray(_to_numpy(obj)).reshape(len(obj), -1).tolist())
+    else:
+        from PIL import Image as _Image
+        _Image.fromarray(_to_numpy(obj)).save(path)
+
+
+class PredictionWriter:
+    def __init__(self, num_threads=2, max_pending=None):
+        r"""
+        Runs writes in a pool of num_threads threads. If max_pending writes(Default 2 * num_threads) are already
+         waiting, save() blocks until one is done, so the predictions held in memory stay bounded.
+        """
+        self.num_threads = num_threads
+        self.max_pending = max_pending or 2 * num_threads
+        self._pool = None
+        self._slots = _threading.BoundedSemaphore(self.max_pending)
+        self._futures = set()
+        self._lock = _threading.Lock()
+
+    def submit(self, fn, *args, **kw):
+        r"""
+        Run any fn(*args, **kw) in the background. Arguments must not be modified afterwards.
+        """
+        if self.num_threads <= 0:
+            return fn(*args, **kw)
+
+        if self._pool is None:
+            self._pool = _futures.ThreadPoolExecutor(self.num_threads, thread_name_prefix='prediction-writer')
+        self._slots.acquire()
+        future = self._pool.submit(fn, *args, **kw)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        self._slots.release()
+        if future.exception() is None:
+            with self._lock:
+                self._futures.discard(future)
+
+    def save(self, path, obj):
+        r"""
+        Tensors are copied to cpu here, so the device memory of the batch is not held by pending writes.
+        """
+        self.submit(write, path, _to_cpu(obj))
+
+    def flush(self):
+        r"""
+        Wait for all the pending writes, and raise the first error if any of them failed.
+        """
+        with self._lock:
+            pending, self._futures = self._futures, set()
+        _futures.wait(pending)
+        for future in pending:
+            if future.exception() is not None:
+                raise RuntimeError(f'Failed to save predictions: {future.exception()}') from future.exception()
+
+    def close(self):
+        r"""
+        Wait for all the pending writes, and stop the threads. They are started again by the next save().
+        """
+        self.flush()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
@@ -32,3 +32,59 @@ def initialize_weights(*models):
                 module.bias.data.zero_()
 
 
+def get_batch_size(batch):
+    r"""
+    Size of the first dimension of the first tensor found in a (nested) batch, None if there is no tensor.
+    """
+    if isinstance(batch, _torch.Tensor):
+        return len(batch) if batch.dim() > 0 else None
+    items = batch.values() if isinstance(batch, dict) else batch if isinstance(batch, (list, tuple)) else []
+    for v in items:
+        n = get_batch_size(v)
+        if n is not None:
+            return n
+    return None
+
+
+def _split(batch, bounds):
+    if isinstance(batch, _torch.Tensor):
+        return [batch[a:b] for a, b in bounds]
+    if isinstance(batch, dict):
+        parts = {k: _split(v, bounds) for k, v in batch.items()}
+        return [{k: v[i] for k, v in parts.items()} for i in range(len(bounds))]
+    if isinstance(batch, (list, tuple)):
+        if any(isinstance(v, (_torch.Tensor, dict, list, tuple)) for v in batch):
+            """
+            Collated fields(like indices of [dataset_name, file] come as [names, files]).
+            """
+            return [type(batch)(p) for p in zip(*[_split(v, bounds) for v in batch])]
+        return [batch[a:b] for a, b in bounds]
+    return [batch] * len(bounds)
+
+
+def split_batch(batch, num_chunks):
+    r"""
+    Split a collated batch(tensors, and lists of strings etc. in nested dicts/lists) into num_chunks smaller batches
+     of (almost) equal size along the first dimension. Chunks are views, nothing is copied.
+    Returns a list of (chunk, its fraction of the batch size).
+    """
+    n = get_batch_size(batch)
+    if n is None or num_chunks <= 1:
+        return [(batch, 1.0)]
+
+    edges = _np.linspace(0, n, min(num_chunks, n) + 1).round().astype(int)
+    bounds = list(zip(edges[:-1].tolist(), edges[1:].tolist()))
+    return [(chunk, (b - a) / n) for chunk, (a, b) in zip(_split(batch, bounds), bounds)]
+
+
+def to_channels_last(batch):
+    r"""
+    Convert all 4D tensors(images batches) in a (nested) batch to channels_last memory format.
+    """
+    if isinstance(batch, _torch.Tensor):
+        return batch.contiguous(memory_format=_torch.channels_last) if batch.dim() == 4 else batch
+    if isinstance(batch, dict):
+        return type(batch)((k, to_channels_last(v)) for k, v in batch.items())
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(to_channels_last(v) for v in batch)
+    return batch
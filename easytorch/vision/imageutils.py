@@ -2,9 +2,7 @@ import copy as _copy
 import math as _math
 import os as _os
 
-import cv2 as _cv2
 import numpy as _np
-from PIL import Image as _IMG
 from easytorch.utils.logger import *
 
 """
@@ -18,6 +16,11 @@ def _same_file(x):
     return x
 
 
+def _open(path):
+    from PIL import Image as _IMG
+    return _IMG.open(path)
+
+
 class Image:
     def __init__(self, dtype=_np.uint8):
         self.dir = None
@@ -32,27 +35,27 @@ class Image:
         try:
             self.dir = dir
             self.file = file
-            self.array = _np.array(_IMG.open(self.path), dtype=self.dtype)
+            self.array = _np.array(_open(self.path), dtype=self.dtype)
         except Exception as e:
             error('Fail to load file: ' + self.file + ': ' + str(e))
 
     def load_mask(self, mask_dir=None, fget_mask=_same_file):
         try:
             mask_file = fget_mask(self.file)
-            self.mask = _np.array(_IMG.open(_os.path.join(mask_dir, mask_file)), dtype=self.dtype)
+            self.mask = _np.array(_open(_os.path.join(mask_dir, mask_file)), dtype=self.dtype)
         except Exception as e:
             error('Fail to load mask: ' + str(e))
 
     def load_ground_truth(self, gt_dir=None, fget_ground_truth=_same_file):
         try:
             gt_file = fget_ground_truth(self.file)
-            self.ground_truth = _np.array(_IMG.open(_os.path.join(gt_dir, gt_file)), dtype=self.dtype)
+            self.ground_truth = _np.array(_open(_os.path.join(gt_dir, gt_file)), dtype=self.dtype)
         except Exception as e:
             error('Fail to load ground truth: ' + str(e))
 
     def get_array(self, dir='', getter=_same_file, file=None):
         if not file: file = self.file
-        arr = _np.array(_IMG.open(_os.path.join(dir, getter(file))), dtype=self.dtype)
+        arr = _np.array(_open(_os.path.join(dir, getter(file))), dtype=self.dtype)
         return arr
 
     def apply_mask(self):
@@ -60,6 +63,7 @@ class Image:
             self.array[self.mask == 0] = 0
 
     def apply_clahe(self, clip_limit=2.0, tile_shape=(8, 8)):
+        import cv2 as _cv2
         enhancer = _cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_shape)
         if len(self.array.shape) == 2:
             self.array = enhancer.apply(self.array)
@@ -174,6 +178,29 @@ def whiten_image2d(img_arr2d=None):
     return _np.array(rescale2d(img_arr2d) * 255, dtype=_np.uint8)
 
 
+def _chunk_starts(img_size, chunk_size, offset):
+    starts = _np.arange(0, img_size, offset)
+    over = _np.nonzero(starts + chunk_size > img_size)[0]
+    if len(over) > 0:
+        starts = starts[:over[0] + 1]
+        starts[-1] = img_size - chunk_size
+    return starts
+
+
+def chunk_indexes(img_shape=(0, 0), chunk_shape=(0, 0), offset_row_col=None):
+    """
+    Four corners of all the patches within image(same as get_chunk_indexes) as a single array.
+    :param img_shape: Shape of the original image
+    :param chunk_shape: Shape of desired patch
+    :param offset_row_col: Offset for each patch on both x, y directions
+    :return: int array of shape (number of patches, 4) with row_from, row_to, col_from, col_to in each row.
+    """
+    rows = _chunk_starts(img_shape[0], chunk_shape[0], offset_row_col[0])
+    cols = _chunk_starts(img_shape[1], chunk_shape[1], offset_row_col[1])
+    row_from, col_from = [a.ravel() for a in _np.meshgrid(rows, cols, indexing='ij')]
+    return _np.stack([row_from, row_from + chunk_shape[0], col_from, col_from + chunk_shape[1]], 1)
+
+
 def get_chunk_indexes(img_shape=(0, 0), chunk_shape=(0, 0), offset_row_col=None):
     """
     Returns a generator for four corners of each patch within image as specified.
@@ -182,30 +209,60 @@ def get_chunk_indexes(img_shape=(0, 0), chunk_shape=(0, 0), offset_row_col=None)
     :param offset_row_col: Offset for each patch on both x, y directions
     :return:
     """
-    img_rows, img_cols = img_shape
-    chunk_row, chunk_col = chunk_shape
-    offset_row, offset_col = offset_row_col
-
-    row_end = False
-    for i in range(0, img_rows, offset_row):
-        if row_end:
-            continue
-        row_from, row_to = i, i + chunk_row
-        if row_to > img_rows:
-            row_to = img_rows
-            row_from = img_rows - chunk_row
-            row_end = True
-
-        col_end = False
-        for j in range(0, img_cols, offset_col):
-            if col_end:
-                continue
-            col_from, col_to = j, j + chunk_col
-            if col_to > img_cols:
-                col_to = img_cols
-                col_from = img_cols - chunk_col
-                col_end = True
-            yield [int(row_from), int(row_to), int(col_from), int(col_to)]
+    yield from chunk_indexes(img_shape, chunk_shape, offset_row_col).tolist()
+
+
+class PatchExtractor:
+    def __init__(self, img=None, chunk_shape=(0, 0), offset_row_col=None, expand_by=(0, 0), indexes=None,
+                 pad_mode='reflect'):
+        """
+        Extracts patches of an image as strided views, without copying the image.
+        The image is mirror padded only once by half of expand_by on each side, so each patch comes with the same
+         surrounding region expand_and_mirror_patch() gives(like the wider input of u-net).
+        :param img: Image array with rows, cols as the first two dimensions.
+        :param chunk_shape: Shape of desired patch
+        :param offset_row_col: Offset for each patch on both x, y directions
+        :param expand_by: Expand each patch by (x, y) in each dimension
+        :param indexes: Four corners of the patches as an array of shape (n, 4). Default is chunk_indexes(...)
+        :param pad_mode: numpy.pad mode to fill the expanded region outside the image.
+        Patches have shape (*img.shape[2:], rows, cols), i.e. channels first for rgb images.
+        Example:
+            patches = PatchExtractor(img, (388, 388), (200, 200), expand_by=(184, 184))
+            batch = torch.empty((len(patches), 3, 572, 572), dtype=torch.uint8)
+            patches.extract(out=batch)
+        """
+        self.indexes = chunk_indexes(img.shape[:2], chunk_shape, offset_row_col) if indexes is None \
+            else _np.asarray(indexes)
+        self.expand_by = (int(expand_by[0] / 2), int(expand_by[1] / 2))
+        i, j = self.expand_by
+        padded = img
+        if i or j:
+            padded = _np.pad(img, [(i, i), (j, j)] + [(0, 0)] * (img.ndim - 2), pad_mode)
+        self.patch_shape = (chunk_shape[0] + 2 * i, chunk_shape[1] + 2 * j)
+        self.windows = _np.lib.stride_tricks.sliding_window_view(padded, self.patch_shape, axis=(0, 1))
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __getitem__(self, index):
+        """
+        A read only view of one patch.
+        """
+        return self.windows[self.indexes[index, 0], self.indexes[index, 2]]
+
+    def extract(self, ids=None, out=None):
+        """
+        Copy many patches at once.
+        :param ids: Which patches(positions in self.indexes) to extract. Default is all.
+        :param out: Preallocated array or cpu tensor of shape (len(ids), *patch shape) to copy the patches into.
+        :return: out, or a new array if out is None.
+        """
+        ix = self.indexes if ids is None else self.indexes[ids]
+        if out is None:
+            return self.windows[ix[:, 0], ix[:, 2]]
+
+        _np.asarray(out)[...] = self.windows[ix[:, 0], ix[:, 2]]
+        return out
 
 
 def get_chunk_indices_by_index(img_shape=(0, 0), chunk_shape=(0, 0), indices=None):
@@ -226,6 +283,71 @@ def get_chunk_indices_by_index(img_shape=(0, 0), chunk_shape=(0, 0), indices=Non
     return ix
 
 
+def blend_weights(patch_shape=(0, 0), mode='gaussian', sigma_scale=1 / 8):
+    """
+    Weights to blend overlapping patches while merging, so that the borders of a patch(where predictions are
+     usually worse) count less than its center.
+    :param patch_shape: Shape of the patch
+    :param mode: 'gaussian', 'linear'(falls off linearly from the center), or 'uniform'(plain average).
+    :param sigma_scale: Standard deviation of the gaussian as a fraction of the patch size.
+    :return: float32 array of patch_shape with the maximum 1.
+    """
+    if mode == 'uniform':
+        return _np.ones(patch_shape, dtype=_np.float32)
+
+    axes = []
+    for n in patch_shape:
+        x = _np.arange(n, dtype=_np.float64)
+        if mode == 'gaussian':
+            axes.append(_np.exp(-0.5 * ((x - (n - 1) / 2) / max(n * sigma_scale, 1e-5)) ** 2))
+        elif mode == 'linear':
+            axes.append(_np.minimum(x + 1, n - x) / _math.ceil(n / 2))
+        else:
+            raise ValueError(f'Unknown blending mode: {mode}')
+    weights = _np.outer(*axes)
+    weights = weights / weights.max()
+    weights[weights == 0] = weights[weights > 0].min()
+    return weights.astype(_np.float32)
+
+
+class PatchMerger:
+    def __init__(self, image_shape=(0, 0), patch_shape=(0, 0), weights='uniform', channels=(), sum_buffer=None,
+                 weight_buffer=None):
+        """
+        Merge patches into a full image by weighted average of the overlapping regions.
+        Each patch is added in place to the slice of a sum and a weight buffer it covers, so patches can be added as
+         they come(and dropped) instead of keeping them all.
+        :param image_shape: Full image size
+        :param patch_shape: A patch size(Patches must be uniform in size to be able to merge)
+        :param weights: A mode of blend_weights(), or an array of patch_shape.
+        :param channels: Leading dimensions of a patch(like number of classes), if any.
+        :param sum_buffer, weight_buffer: Preallocated zero buffers of shape (*channels, *image_shape) and image_shape.
+            They can be torch tensors(like on gpu), in which case weights must also be a tensor on the same device.
+        """
+        self.weights = blend_weights(patch_shape, weights) if isinstance(weights, str) else weights
+        self.sum = _np.zeros((*channels, *image_shape), dtype=_np.float32) if sum_buffer is None else sum_buffer
+        self.weight = _np.zeros(image_shape, dtype=_np.float32) if weight_buffer is None else weight_buffer
+
+    def add(self, patch, corners):
+        """
+        :param patch: A patch of shape (*channels, *patch_shape)
+        :param corners: row_from, row_to, col_from, col_to of the patch in full image.
+        """
+        row_from, row_to, col_from, col_to = [int(c) for c in corners]
+        self.sum[..., row_from:row_to, col_from:col_to] += patch * self.weights
+        self.weight[row_from:row_to, col_from:col_to] += self.weights
+
+    def add_batch(self, patches, indexes):
+        for patch, corners in zip(patches, indexes):
+            self.add(patch, corners)
+
+    def result(self):
+        """
+        Weighted average. Pixels not covered by any patch are 0.
+        """
+        return self.sum / self.weight.clip(min=1e-8)
+
+
 def merge_patches(patches=None, image_size=(0, 0), patch_size=(0, 0), offset_row_col=None):
     """
     Merge different pieces of image to form a full image. Overlapped regions are averaged.
@@ -235,19 +357,10 @@ def merge_patches(patches=None, image_size=(0, 0), patch_size=(0, 0), offset_row
     :param offset_row_col: Offset used to chunk the patches.
     :return:
     """
-    padded_sum = _np.zeros([image_size[0], image_size[1]])
-    non_zero_count = _np.zeros_like(padded_sum)
+    merger = PatchMerger(image_size, patch_size)
     for i, chunk_ix in enumerate(get_chunk_indexes(image_size, patch_size, offset_row_col)):
-        row_from, row_to, col_from, col_to = chunk_ix
-
-        patch = _np.array(patches[i, :, :]).squeeze()
-
-        padded = _np.pad(patch, [(row_from, image_size[0] - row_to), (col_from, image_size[1] - col_to)],
-                         'constant')
-        padded_sum = padded + padded_sum
-        non_zero_count = non_zero_count + _np.array(padded > 0).astype(int)
-    non_zero_count[non_zero_count == 0] = 1
-    return _np.array(padded_sum / non_zero_count, dtype=_np.uint8)
+        merger.add(_np.array(patches[i, :, :]).squeeze(), chunk_ix)
+    return _np.array(merger.result(), dtype=_np.uint8)
 
 
 def expand_and_mirror_patch(full_img_shape=None, orig_patch_indices=None, expand_by=None):
@@ -1,21 +1,36 @@
+import multiprocessing as _mp
 import os as _os
+import queue as _queue
+import time as _time
 
-import matplotlib.pyplot as _plt
 import numpy as _np
-import pandas as _pd
-from sklearn.preprocessing import MinMaxScaler as _MinMaxScaler
 
-_plt.switch_backend('agg')
-_plt.rcParams["figure.figsize"] = [16, 9]
+_plt = None
+
+
+def _pyplot():
+    r"""
+    Matplotlib is only loaded by whoever plots.
+    """
+    global _plt
+    if _plt is None:
+        import matplotlib.pyplot as _plt
+        _plt.switch_backend('agg')
+        _plt.rcParams["figure.figsize"] = [16, 9]
+    return _plt
 
 
 def plot_progress(cache, experiment_id='', plot_keys=[], num_points=11, epoch=None):
     r"""
     Custom plot to plot data from the cache by keys.
     """
+    import pandas as _pd
+    from sklearn.preprocessing import MinMaxScaler as _MinMaxScaler
+
+    plt = _pyplot()
     scaler = _MinMaxScaler()
     for k in plot_keys:
-        _plt.clf()
+        plt.clf()
 
         data = cache.get(k, [])
 
@@ -52,6 +67,146 @@ def plot_progress(cache, experiment_id='', plot_keys=[], num_points=11, epoch=No
             ax.set_xticks(xticks)
             ax.set_xticklabels(list(range(len(xticks))))
 
-        _plt.xlabel('Epochs')
-        _plt.savefig(cache['log_dir'] + _os.sep + f"{experiment_id}_{k}.png")
-        _plt.close('all')
+        plt.xlabel('Epochs')
+        plt.savefig(cache['log_dir'] + _os.sep + f"{experiment_id}_{k}.png")
+        plt.close('all')
+
+
+class _Progress:
+    def __init__(self, title, header):
+        r"""
+        Rows of one plot kept in the plotting process. New rows are added in a growing buffer,
+         and running min/max(for scaling columns larger than 1 like plot_progress) are updated with new rows only.
+        """
+        self.title = title
+        self.header = header
+        self.data = _np.zeros((64, len(header)))
+        self.size = 0
+        self.min = _np.full(len(header), _np.inf)
+        self.max = _np.full(len(header), -_np.inf)
+        self.epoch = None
+
+    def add(self, rows, epoch):
+        rows = _np.array(rows, dtype=float)[:, :len(self.header)]
+        if self.size + len(rows) > len(self.data):
+            self.data = _np.resize(self.data, (max(2 * len(self.data), self.size + len(rows)), len(self.header)))
+        self.data[self.size:self.size + len(rows)] = rows
+        self.size += len(rows)
+        self.min = _np.minimum(self.min, rows.min(0))
+        self.max = _np.maximum(self.max, rows.max(0))
+        self.epoch = epoch
+
+    def save(self, path, num_points=11):
+        data = self.data[:self.size].copy()
+        if len(data) == 0 or _np.sum(data) <= 0:
+            return
+
+        scale = self.max > 1
+        data[:, scale] = (data[:, scale] - self.min[scale]) / _np.maximum(self.max - self.min, 1e-11)[scale]
+
+        """
+        Rolling mean(with min_periods=1) from cumulative sums.
+        """
+        window = max(len(data) // num_points + 1, 3)
+        cumsum = _np.vstack([_np.zeros((1, data.shape[1])), _np.cumsum(data, 0)])
+        end = _np.arange(1, len(data) + 1)
+        start = _np.maximum(end - window, 0)
+        rolling = (cumsum[end] - cumsum[start]) / (end - start)[:, None]
+
+        plt = _pyplot()
+        fig, ax = plt.subplots()
+        ax.plot(data, alpha=0.2)
+        ax.set_prop_cycle(None)
+        ax.legend(ax.plot(rolling), self.header)
+        ax.set_title(self.title)
+
+        if self.epoch and self.epoch != len(data):
+            """
+            Set correct epoch as x-tick-labels.
+            """
+            xticks = list(range(0, len(data), len(data) // self.epoch)) + [len(data) - 1]
+            ax.set_xticks(xticks)
+            ax.set_xticklabels(list(range(len(xticks))))
+
+        ax.set_xlabel('Epochs')
+        fig.savefig(path)
+        plt.close(fig)
+
+
+def _plot_worker(messages, min_interval, num_points):
+    r"""
+    Runs in the plotting process. Collects new rows as they come, and re-draws each changed plot
+     at most once in every min_interval seconds. Draws all pending plots before exiting.
+    """
+    plots, dirty, last_saved = {}, set(), {}
+    running = True
+    while running or dirty:
+        try:
+            msg = messages.get(timeout=min_interval if dirty else None) if running else None
+            if msg is None:
+                running = False
+            elif msg[0] == 'reset':
+                plots.pop(msg[1], None)
+                dirty.discard(msg[1])
+            else:
+                _, path, title, header, rows, epoch = msg
+                if path not in plots:
+                    plots[path] = _Progress(title, header)
+                plots[path].add(rows, epoch)
+                dirty.add(path)
+        except _queue.Empty:
+            pass
+
+        for path in list(dirty):
+            if not running or _time.time() - last_saved.get(path, 0) >= min_interval:
+                plots[path].save(path, num_points)
+                last_saved[path] = _time.time()
+                dirty.discard(path)
+
+
+class ProgressPlotter:
+    def __init__(self, min_interval=10, num_points=11):
+        r"""
+        Plots progress(same as plot_progress) from a background process so that training never waits for it.
+        Only the rows added to the cache since the last update are sent over,
+         and each plot is re-drawn at most once in every min_interval seconds.
+        The process is spawned(not forked), so it never inherits the threads, CUDA context, or data of the trainer.
+        """
+        self.min_interval = min_interval
+        self.num_points = num_points
+        self._sent = {}
+        self._messages = None
+        self._process = None
+
+    def start(self):
+        if self._process is not None:
+            return
+        ctx = _mp.get_context('spawn')
+        self._messages = ctx.Queue()
+        self._process = ctx.Process(target=_plot_worker, args=(self._messages, self.min_interval, self.num_points),
+                                    daemon=True)
+        self._process.start()
+
+    def update(self, cache, experiment_id='', plot_keys=[], epoch=None):
+        self.start()
+        for k in plot_keys:
+            path = cache['log_dir'] + _os.sep + f"{experiment_id}_{k}.png"
+            data = cache.get(k, [])
+            sent = self._sent.get(path, 0)
+            if len(data) < sent:
+                self._messages.put(('reset', path))
+                sent = 0
+            if len(data) > sent:
+                self._messages.put(('rows', path, k.upper(), cache['log_header'].split(','), data[sent:], epoch))
+            self._sent[path] = len(data)
+
+    def close(self):
+        r"""
+        Wait for the pending plots to be drawn and stop the plotting process.
+        """
+        if self._process is None:
+            return
+        self._messages.put(None)
+        self._process.join()
+        self._messages.close()
+        self._sent, self._messages, self._process = {}, None, None
@@ -0,0 +1,84 @@
+r"""
+Sliding window inference over images too large for the model(like in the test phase of U-Net).
+"""
+
+import numpy as _np
+import torch as _torch
+
+from easytorch.vision import imageutils as _imgutils
+
+
+class TiledInference:
+    def __init__(self, model, chunk_shape=(0, 0), offset_row_col=None, expand_by=(0, 0), batch_size=32,
+                 blend='gaussian', device='cpu', prepare=None, pad_mode='reflect'):
+        r"""
+        Runs the model on overlapping patches of an image and blends the outputs into a full size prediction.
+        Patches are extracted batch by batch from a once padded image(imageutils.PatchExtractor) into reused
+         buffers, and each output is added in place to the sum/weight buffers(imageutils.PatchMerger) on the device.
+         So only one batch of patches is in memory at a time.
+        On cuda, two pinned buffers take turns, so that the next batch is extracted into one while the other is still
+         being copied to the device(a buffer is reused only after the event recorded after its copy is done).
+        @param model: Called on a batch of patches. Its output must be (batch, *channels, rows, cols), where rows,
+            cols is either chunk_shape, or the expanded patch shape from which the center chunk_shape is used.
+        @param chunk_shape, offset_row_col, expand_by: Same as in imageutils.PatchExtractor.
+        @param blend: 'gaussian', 'linear', or 'uniform' weights for the overlapping regions(imageutils.blend_weights)
+        @param prepare: Applied on each batch(already on the device) before the model. Default casts to float.
+        Example in save_predictions:
+            tiled = TiledInference(self.nn['model'], (388, 388), (200, 200), expand_by=(184, 184),
+                                   device=self.device['gpu'])
+            probs = tiled(img).softmax(0)
+        """
+        self.model = model
+        self.chunk_shape = tuple(chunk_shape)
+        self.offset_row_col = offset_row_col
+        self.expand_by = expand_by
+        self.batch_size = batch_size
+        self.blend = blend
+        self.device = _torch.device(device)
+        self.prepare = prepare if prepare is not None else lambda x: x.float()
+        self.pad_mode = pad_mode
+
+    def _crop(self, out, patch_shape):
+        if tuple(out.shape[-2:]) == self.chunk_shape:
+            return out
+        if tuple(out.shape[-2:]) == patch_shape:
+            i, j = (patch_shape[0] - self.chunk_shape[0]) // 2, (patch_shape[1] - self.chunk_shape[1]) // 2
+            return out[..., i:i + self.chunk_shape[0], j:j + self.chunk_shape[1]]
+        raise ValueError(f'Model output of shape {tuple(out.shape[-2:])} does not match the patch {self.chunk_shape}.')
+
+    @_torch.no_grad()
+    def __call__(self, img):
+        r"""
+        @param img: Image array with rows, cols as the first two dimensions.
+        @return: Blended output of shape (*channels, *img.shape[:2]) on the device.
+        """
+        patches = _imgutils.PatchExtractor(img, self.chunk_shape, self.offset_row_col, self.expand_by,
+                                           pad_mode=self.pad_mode)
+        dtype = _torch.from_numpy(_np.empty(0, dtype=img.dtype)).dtype
+        cuda = self.device.type == 'cuda'
+        buffers = [_torch.empty((min(self.batch_size, len(patches)), *patches[0].shape), dtype=dtype, pin_memory=cuda)
+                   for _ in range(2 if cuda else 1)]
+        copied = [None] * len(buffers)
+
+        merger = None
+        for k, start in enumerate(range(0, len(patches), self.batch_size)):
+            b = k % len(buffers)
+            if copied[b] is not None:
+                copied[b].synchronize()
+            ids = _np.arange(start, min(start + self.batch_size, len(patches)))
+            inputs = patches.extract(ids, out=buffers[b][:len(ids)]).to(self.device, non_blocking=cuda)
+            if cuda:
+                copied[b] = _torch.cuda.Event()
+                copied[b].record(_torch.cuda.current_stream(self.device))
+            out = self._crop(self.model(self.prepare(inputs)), patches.patch_shape)
+
+            if merger is None:
+                channels, image_shape = tuple(out.shape[1:-2]), img.shape[:2]
+                weights = _torch.as_tensor(_imgutils.blend_weights(self.chunk_shape, self.blend), device=out.device)
+                merger = _imgutils.PatchMerger(
+                    weights=weights,
+                    sum_buffer=_torch.zeros((*channels, *image_shape), dtype=_torch.float32, device=out.device),
+                    weight_buffer=_torch.zeros(image_shape, dtype=_torch.float32, device=out.device)
+                )
+            merger.add_batch(out.float(), patches.indexes[ids])
+        return merger.result()
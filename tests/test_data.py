@@ -0,0 +1,230 @@
+import numpy as np
+import pytest
+import torch
+
+from easytorch.data import data as etdata
+
+
+def test_cache_index_generations_and_resize():
+    index = etdata._CacheIndex(max_bytes=30)
+    for i in range(3):
+        assert index.put(f'k{i}', (f's{i}', (10,), '|u1', 10)) == []
+    assert index.get('k0') == (('s0', (10,), '|u1', 10), 0)
+    assert index.put('k3', ('s3', (10,), '|u1', 10)) == ['s1']
+    assert index.evicted_since(0) == ['s1']
+    assert index.resize(10) == ['s2', 's0']
+    assert index.get('k1') == (None, 3)
+    assert index.evicted_since(1) == ['s2', 's0'] and index.evicted_since(3) == []
+
+
+def test_shared_array_cache_detaches_evicted():
+    cache = etdata.SharedArrayCache(max_bytes=200)
+    try:
+        for i in range(2):
+            cache.put(f'k{i}', np.full(100, i, dtype=np.uint8))
+        worker = etdata.SharedArrayCache.__new__(etdata.SharedArrayCache)
+        worker.__dict__.update(cache.__getstate__())
+        assert worker.get('k0')[0] == 0 and len(worker._handles) == 1
+
+        cache.get('k1')
+        cache.put('k2', np.full(100, 2, dtype=np.uint8))
+        assert worker.get('k2')[0] == 2
+        assert list(worker._handles) == [worker._index.get('k2')[0][0]]
+        assert worker.get('k0') is None
+    finally:
+        cache.clear()
+
+
+def test_indices_are_a_list_unless_compact():
+    assert etdata.ETDataset().indices == []
+    assert isinstance(etdata.ETDataset(compact_indices=True).indices, etdata.IndexStore)
+
+
+def test_interleaved_sampler_of_pool_with_list_and_store():
+    for kw in [{}, {'compact_indices': True}]:
+        dataset = etdata.ETDataset(**kw)
+        for name, n in [('a', 3), ('b', 5)]:
+            for i in range(n):
+                dataset.indices.append([name, f'{i}.png', i])
+        assert etdata.InterleavedSampler.of_pool(dataset).sizes.tolist() == [3, 5]
+
+
+def test_list_and_load_splits(tmp_path):
+    from easytorch.data import datautils
+
+    files = [f'{i}.png' for i in range(10)]
+    datautils.create_k_fold_splits(files, k=2, save_to_dir=str(tmp_path), name='c', compact=True)
+    (tmp_path / 'legacy_split').write_text('{"train": ["0.png"], "test": ["1.png"]}')
+    assert datautils.list_splits(str(tmp_path)) == ['c_0.npz', 'c_1.npz', 'legacy_split']
+    assert datautils.load_split(str(tmp_path), 'legacy_split') == {'train': ['0.png'], 'test': ['1.png']}
+    assert sorted(sum(datautils.load_split(str(tmp_path), 'c_0.npz').values(), [])) == sorted(files)
+
+    (tmp_path / 'notes.txt').write_text('not a split')
+    with pytest.raises(ValueError, match='not a split file'):
+        [datautils.load_split(str(tmp_path), f) for f in datautils.list_splits(str(tmp_path))]
+
+
+def test_manifest_round_trip_and_rescan(tmp_path):
+    from easytorch.data import datautils
+
+    data_dir = tmp_path / 'data'
+    data_dir.mkdir()
+    names = ['b.png', 'a.png', 'ünïcode name.txt']
+    for name in names:
+        (data_dir / name).write_bytes(b'x' * len(name))
+    dspec = {'data_dir': str(data_dir), 'manifest_dir': str(tmp_path / 'manifests')}
+    m = datautils.manifest(dspec)
+    assert m.files.dtype == object and m.select() == sorted(names)
+
+    loaded = datautils.Manifest.load(datautils.manifest_path(dspec))
+    assert loaded.select() == sorted(names) and loaded.info('b.png')['size'] == 5
+
+    (data_dir / 'c.png').touch()
+    (data_dir / 'a.png').unlink()
+    rescanned = datautils.scan(str(data_dir), previous=loaded)
+    assert rescanned.select() == ['b.png', 'c.png', 'ünïcode name.txt']
+
+
+def test_scan_skips_files_removed_while_scanning(tmp_path, monkeypatch):
+    from easytorch.data import datautils
+
+    (tmp_path / 'kept.png').touch()
+    monkeypatch.setattr(datautils, 'list_files', lambda data_dir: iter(['gone.png', 'kept.png']))
+    assert datautils.scan(str(tmp_path)).select() == ['kept.png']
+
+
+def test_class_ids():
+    from easytorch.data import datautils
+
+    assert [x.tolist() if hasattr(x, 'tolist') else x for x in datautils.class_ids([2, 0, 2])] == [[2, 0, 2], 3]
+    ids, n = datautils.class_ids([-1, 1, -1, 0])
+    assert ids.tolist() == [0, 2, 0, 1] and n == 3
+    assert datautils.balanced_weights([-1, 1, -1, 1, 1]).tolist() == [2.5, 5 / 3, 2.5, 5 / 3, 5 / 3]
+    ids, n = datautils.class_ids(['b', 'a', 'b'])
+    assert ids.tolist() == [1, 0, 1] and n == 2
+
+
+class _Squares(etdata.ETDataset):
+    def __getitem__(self, index):
+        return {'x': torch.tensor(float(self.indices[index][1]) ** 2)}
+
+
+def test_in_memory_loader_takes_sampler_in_batches():
+    dataset = _Squares(in_memory=True)
+    dataset.indices += [['a', i] for i in range(10)]
+    sampler = etdata.InterleavedSampler([10], seed=1)
+    taken = []
+
+    class Counting(torch.utils.data.Sampler):
+        def __iter__(self):
+            for i in sampler:
+                taken.append(i)
+                yield i
+
+        def __len__(self):
+            return len(sampler)
+
+    loader = etdata.ETDataLoader.new(dataset=dataset, batch_size=4, sampler=Counting(), drop_last=True)
+    batches = iter(loader)
+    first = next(batches)
+    assert len(taken) == 4 and first['x'].tolist() == [float(i) ** 2 for i in taken]
+    assert len(list(batches)) == 1 and len(loader) == 2
+
+
+def test_pool_passes_args_to_datasets(tmp_path):
+    from easytorch.data import datautils
+
+    for name in ['a', 'b']:
+        (tmp_path / name).mkdir()
+        datautils.create_ratio_split([f'{name}{i}' for i in range(4)], save_to_dir=str(tmp_path / name),
+                                     ratio=[0.5, 0.5], name=name)
+    dspecs = [{'name': n, 'data_dir': str(tmp_path / n), 'split_dir': str(tmp_path / n)} for n in ['a', 'b']]
+    args = {'load_limit': 100, 'verbose': False, 'in_memory': True, 'compact_indices': True}
+    pooled, = _Squares.pool(args, dspecs, split_key='train')
+    assert pooled.in_memory and isinstance(pooled.indices, etdata.IndexStore) and len(pooled) == 4
+
+
+@pytest.mark.parametrize('n', [0, 5, 8, 11])
+def test_shard_sampler_covers_each_sample_once(n):
+    shards = [list(etdata.ShardSampler(n, rank, 4)) for rank in range(4)]
+    assert sum(shards, []) == list(range(n))
+    assert max(map(len, shards)) - min(map(len, shards)) <= 1
+
+
+def test_grouped_batch_sampler_keeps_batches_within_groups():
+    groups = [(0, 5), (5, 5), (5, 6), (6, 13)]
+    sampler = etdata.GroupedBatchSampler(groups, batch_size=3)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) and sum(batches, []) == list(range(13))
+    for b in batches:
+        assert len(b) <= 3 and len({g for g, (s, e) in enumerate(groups) if s <= b[0] < e and s <= b[-1] < e}) == 1
+    assert sampler.group_ends == {1: 0, 2: 2, 5: 3}
+    assert [batches[i][-1] + 1 for i in sampler.group_ends] == [e for s, e in groups if e > s]
+
+
+def test_kfold_ids_stratified_and_grouped():
+    from easytorch.data import datautils
+
+    labels = np.random.default_rng(0).integers(0, 3, 103)
+    fold = datautils.kfold_ids(len(labels), 5, labels=labels)
+    assert np.bincount(fold, minlength=5).ptp() <= 1
+    for c in range(3):
+        assert np.bincount(fold[labels == c], minlength=5).ptp() <= 1
+
+    groups = np.random.default_rng(1).integers(0, 20, 103)
+    fold = datautils.kfold_ids(len(groups), 5, groups=groups)
+    assert set(fold.tolist()) == set(range(5))
+    for g in np.unique(groups):
+        assert len(set(fold[groups == g].tolist())) == 1
+
+
+@pytest.mark.parametrize('labels', [[0] * 40 + [1] * 9 + [2] * 3, [-1] * 40 + [7] * 9 + [-5] * 3])
+def test_stratified_batches_are_balanced(labels):
+    labels = np.array(labels)
+    sampler = etdata.StratifiedBatchSampler(labels, batch_size=7, seed=1)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == len(labels) // 7
+    for b in batches:
+        counts = [np.sum(labels[b] == c) for c in np.unique(labels)]
+        assert len(b) == 7 and max(counts) - min(counts) <= 1
+    assert set(sum(batches, [])) >= set(np.flatnonzero(labels != labels[0]).tolist())
+
+
+@pytest.mark.parametrize('labels', [[0] * 60 + [1] * 30 + [2] * 10, [-2] * 60 + [-1] * 30 + [4] * 10])
+def test_class_balanced_sampler_follows_balanced_weights(labels):
+    from easytorch.data import datautils
+
+    sampler = etdata.ClassBalancedSampler(labels, num_samples=200000, seed=3)
+    drawn = np.bincount(list(sampler), minlength=len(labels)) / len(sampler)
+    weights = datautils.balanced_weights(labels)
+    assert np.abs(drawn - weights / weights.sum()).max() < 2e-3
+    sampler.set_epoch(1)
+    assert list(sampler)[:100] != list(etdata.ClassBalancedSampler(labels, num_samples=200000, seed=3))[:100]
+
+
+@pytest.mark.parametrize('n', [1, 2, 3, 16, 17, 100, 1000, 4097])
+def test_lazy_permutation_covers_each_index_once(n):
+    perm = etdata._lazy_permutation(np.arange(n), n, [0, n])
+    assert sorted(perm.tolist()) == list(range(n))
+    assert n < 16 or perm.tolist() != list(range(n))
+    assert perm[n // 2:].tolist() == etdata._lazy_permutation(np.arange(n // 2, n), n, [0, n]).tolist()
+
+
+def test_interleaved_sampler_ratios_per_epoch():
+    sizes, ratios = [10, 300, 50], [1, 1, 2]
+    starts = np.cumsum(sizes) - sizes
+    sampler = etdata.InterleavedSampler(sizes, ratios=ratios, num_samples=1001, chunk_size=64)
+    ix = np.array(list(sampler))
+    assert len(ix) == len(sampler) == 1001
+    counts = np.bincount(np.searchsorted(starts, ix, side='right') - 1, minlength=3)
+    assert counts.tolist() == [250, 250, 501]
+
+    """
+    Without replacement, each dataset is gone through fully before any of its indices repeats.
+    """
+    large = ix[(ix >= starts[1]) & (ix < starts[2])]
+    assert len(set(large.tolist())) == len(large)
+    small = ix[ix < starts[1]]
+    assert all(sorted(small[i:i + 10].tolist()) == list(range(10)) for i in range(0, len(small) - 9, 10))
+
+    assert sorted(etdata.InterleavedSampler(sizes)) == list(range(sum(sizes)))
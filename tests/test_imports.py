@@ -0,0 +1,24 @@
+import re
+import subprocess
+import sys
+
+HEAVY = ['torch', 'numpy', 'cv2', 'PIL', 'matplotlib', 'sklearn', 'scipy', 'skimage', 'pandas']
+
+
+def _run(code, *flags):
+    return subprocess.run([sys.executable, *flags, '-c', code], capture_output=True, text=True, check=True)
+
+
+def test_import_loads_no_heavy_modules():
+    loaded = _run(f"import sys, easytorch; print([m for m in {HEAVY!r} if m in sys.modules])").stdout.strip()
+    assert loaded == '[]'
+
+
+def test_import_time():
+    err = _run('import easytorch', '-X', 'importtime').stderr
+    total = int(re.search(r'^import time:\s*\d+ \|\s*(\d+) \| easytorch$', err, re.M).group(1))
+    assert total < 500_000, f'import easytorch took {total / 1e6:.2f}s'
+
+
+def test_exports_resolve_lazily():
+    _run("import sys, easytorch; easytorch.ETTrainer; assert 'torch' in sys.modules")
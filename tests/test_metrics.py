@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+import torch
+from sklearn.metrics import confusion_matrix, precision_recall_fscore_support
+
+from easytorch.metrics.metrics import ConfusionMatrix, ETAverages, Prf1a
+
+cuda = pytest.mark.skipif(not torch.cuda.is_available(), reason='needs cuda')
+
+
+def test_prf1a_scores():
+    m = Prf1a()
+    m.add(torch.tensor([1, 1, 0, 0, 1]), torch.tensor([1, 0, 0, 1, 1]))
+    assert [int(c) for c in (m.tp, m.fp, m.tn, m.fn)] == [2, 1, 1, 1]
+    assert m.get() == [round(2 / 3, 5), round(2 / 3, 5), round(2 / 3, 5), 0.6]
+
+
+def test_prf1a_accumulate_mixed_counts():
+    a, b = Prf1a(), Prf1a()
+    a.update(tp=1, fp=1)
+    b.add(torch.tensor([1, 0]), torch.tensor([1, 0]))
+    a.accumulate(b)
+    b.accumulate(a)
+    assert (a.tp, a.fp, a.tn) == (2, 1, 1)
+    assert (b.tp, b.fp, b.tn) == (3, 1, 2)
+
+
+def test_averages_tensor_and_numbers():
+    avg = ETAverages(num_averages=2)
+    avg.add(torch.tensor(2.0), 3)
+    avg.add(1.0, 2, index=1)
+    other = ETAverages(num_averages=2)
+    other.add(4.0, 1)
+    avg.accumulate(other)
+    assert avg.get().tolist() == [2.5, 1.0]
+
+
+@cuda
+def test_metrics_accumulate_across_devices():
+    avg, cpu_avg = ETAverages(), ETAverages()
+    avg.add(torch.tensor(1.0, device='cuda'), 1)
+    cpu_avg.add(torch.tensor(3.0), 1)
+    avg.accumulate(cpu_avg)
+    avg.add(torch.tensor(2.0), 1)
+    assert avg.get().tolist() == [2.0]
+
+    m, cpu_m = Prf1a(), Prf1a()
+    m.add(torch.tensor([1, 0], device='cuda'), torch.tensor([1, 0], device='cuda'))
+    cpu_m.add(torch.tensor([1, 1]), torch.tensor([0, 1]))
+    m.accumulate(cpu_m)
+    m.add(torch.tensor([0]), torch.tensor([1]))
+    assert [int(c) for c in (m.tp, m.fp, m.tn, m.fn)] == [2, 1, 1, 1]
+
+
+def test_confusion_matrix_matches_sklearn():
+    rng = np.random.default_rng(0)
+    true, pred = rng.integers(0, 4, 200), rng.integers(0, 4, 200)
+    m = ConfusionMatrix(num_classes=4)
+    for i in range(0, 200, 50):
+        m.add(torch.as_tensor(pred[i:i + 50]), torch.as_tensor(true[i:i + 50]))
+
+    assert m.matrix.tolist() == confusion_matrix(true, pred, labels=range(4)).tolist()
+    for average in ['macro', 'micro', 'weighted']:
+        p, r, f, _ = precision_recall_fscore_support(true, pred, average=average, zero_division=0)
+        assert np.allclose([m.precision(average), m.recall(average), m.f1(average)], [p, r, f], atol=1e-4)
+    assert np.isclose(m.accuracy(), (true == pred).mean())
+
+
+def test_confusion_matrix_accumulate_and_update():
+    a, b = ConfusionMatrix(num_classes=2), ConfusionMatrix(num_classes=2)
+    a.add(torch.tensor([0, 1]), torch.tensor([1, 1]))
+    b.update(matrix=[[1, 0], [0, 0]])
+    a.accumulate(b)
+    assert a.matrix.tolist() == [[1, 0], [1, 1]]
@@ -0,0 +1,19 @@
+import numpy as np
+import torch
+
+from easytorch.utils.predictions import PredictionWriter
+
+
+def test_prediction_writer_formats(tmp_path):
+    writer = PredictionWriter(num_threads=2)
+    pred = torch.arange(6, dtype=torch.uint8).reshape(2, 3)
+    for ext in ['.pt', '.npy', '.csv', '.png']:
+        writer.save(str(tmp_path / f'pred{ext}'), pred)
+    writer.save(str(tmp_path / 'array.pt'), pred.numpy())
+    writer.close()
+    assert writer._pool is None
+
+    assert torch.equal(torch.load(tmp_path / 'pred.pt'), pred)
+    assert torch.equal(torch.load(tmp_path / 'array.pt'), pred)
+    assert np.array_equal(np.load(tmp_path / 'pred.npy'), pred.numpy())
+    assert np.loadtxt(tmp_path / 'pred.csv', delimiter=',').tolist() == pred.tolist()
@@ -0,0 +1,219 @@
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+import easytorch.config as config
+from easytorch import ETDataset, ETTrainer, EasyTorch
+
+
+class Trainer(ETTrainer):
+    def _init_nn_model(self):
+        self.nn['model'] = torch.nn.Linear(4, 2)
+
+
+@pytest.fixture
+def trainer(tmp_path):
+    t = Trainer({**config.args, 'verbose': False, 'async_checkpoint': False})
+    t.cache.update(log_dir=str(tmp_path), checkpoint='fold.pt', monitor_metric='f1', metric_direction='maximize',
+                   best_score=0.0, best_epoch=0)
+    t.nn['model'] = torch.nn.Linear(4, 2)
+    return t
+
+
+def _saved(trainer):
+    path = os.path.join(trainer.cache['log_dir'], trainer.cache['checkpoint'])
+    saved = os.path.exists(path)
+    if saved:
+        os.remove(path)
+    return saved
+
+
+def test_save_if_better_first_epoch(trainer):
+    trainer.save_if_better(1, SimpleNamespace(f1=float('nan')))
+    assert _saved(trainer) and trainer.cache['best_epoch'] == 1
+    trainer.save_if_better(2, SimpleNamespace(f1=0.1))
+    assert _saved(trainer) and trainer.cache['best_epoch'] == 2
+
+
+def test_save_if_better_improvement_tie_and_worse(trainer):
+    trainer.save_if_better(1, SimpleNamespace(f1=0.5))
+    assert _saved(trainer)
+    trainer.save_if_better(2, SimpleNamespace(f1=0.6))
+    assert _saved(trainer) and trainer.cache['best_score'] == 0.6
+    trainer.save_if_better(3, SimpleNamespace(f1=0.6))
+    assert not _saved(trainer) and trainer.cache['best_epoch'] == 2
+    trainer.save_if_better(4, SimpleNamespace(f1=0.4))
+    assert not _saved(trainer) and trainer.cache['best_epoch'] == 2
+
+
+def test_save_if_better_minimize(trainer):
+    trainer.cache.update(monitor_metric='loss', metric_direction='minimize', best_score=1e11)
+    trainer.save_if_better(1, SimpleNamespace(loss=2.0))
+    assert _saved(trainer)
+    trainer.save_if_better(2, SimpleNamespace(loss=3.0))
+    assert not _saved(trainer)
+
+
+def test_save_if_better_replaces_stale_checkpoint(trainer):
+    r"""
+    A checkpoint left by an earlier run in the same log_dir is replaced by the first epoch, even with a nan score.
+    """
+    open(os.path.join(trainer.cache['log_dir'], 'fold.pt'), 'w').close()
+    trainer.save_if_better(1, SimpleNamespace(f1=float('nan')))
+    assert os.path.getsize(os.path.join(trainer.cache['log_dir'], 'fold.pt')) > 0
+    assert trainer.cache['best_epoch'] == 1
+
+
+def test_save_if_better_keeps_checkpoint_of_resumed_fold(trainer):
+    r"""
+    A resumed fold restores best_score/best_epoch, so a worse epoch does not replace its checkpoint.
+    """
+    open(os.path.join(trainer.cache['log_dir'], 'fold.pt'), 'w').close()
+    trainer.cache.update(best_score=0.9, best_epoch=2)
+    trainer.save_if_better(3, SimpleNamespace(f1=0.5))
+    assert os.path.getsize(os.path.join(trainer.cache['log_dir'], 'fold.pt')) == 0
+    assert trainer.cache['best_epoch'] == 2
+
+
+class Interrupted(Exception):
+    pass
+
+
+class ToyDataset(ETDataset):
+    def __getitem__(self, index):
+        name, file = self.indices[index][:2]
+        x = torch.randn(8, generator=torch.Generator().manual_seed(int(file[1:].split('.')[0])))
+        return {'input': x + 0.1 * torch.randn(8), 'label': int(x.sum() > 0)}
+
+
+class ToyTrainer(ETTrainer):
+    interrupt_after = None
+
+    def _init_nn_model(self):
+        self.nn['model'] = torch.nn.Linear(8, 2)
+
+    def iteration(self, batch):
+        out = self.nn['model'](batch['input'].float())
+        loss = F.cross_entropy(out, batch['label'].long())
+        _, pred = torch.max(out, 1)
+        sc = self.new_metrics()
+        sc.add(pred, batch['label'])
+        avg = self.new_averages()
+        avg.add(loss, len(out))
+        return {'loss': loss, 'averages': avg, 'output': out, 'metrics': sc, 'predictions': pred}
+
+    def _on_epoch_end(self, ep, *args):
+        super()._on_epoch_end(ep, *args)
+        if ep == self.interrupt_after:
+            raise Interrupted
+
+
+def _train_toy(root, log_dir, **kw):
+    runner = EasyTorch([{'name': 'toy', 'data_dir': 'data', 'split_dir': 'splits'}], phase='train', epochs=4,
+                       batch_size=4, num_workers=0, dataset_dir=str(root), log_dir=str(root / log_dir), force=True,
+                       verbose=False, seed_all=True, resume=True, async_checkpoint=False, patience=99, **kw)
+    runner.run(ToyDataset, ToyTrainer)
+    return torch.load(root / log_dir / 'toy' / 'split_state.pt', weights_only=False)['models']['model']
+
+
+def test_resumed_training_matches_uninterrupted(tmp_path):
+    files = [f'f{i}.txt' for i in range(24)]
+    (tmp_path / 'data').mkdir()
+    (tmp_path / 'splits').mkdir()
+    for f in files:
+        (tmp_path / 'data' / f).touch()
+    with open(tmp_path / 'splits' / 'split.json', 'w') as f:
+        json.dump({'train': files[:16], 'validation': files[16:20], 'test': files[20:]}, f)
+
+    full = _train_toy(tmp_path, 'full')
+    ToyTrainer.interrupt_after = 3
+    try:
+        with pytest.raises(Interrupted):
+            _train_toy(tmp_path, 'resumed')
+    finally:
+        ToyTrainer.interrupt_after = None
+    resumed = _train_toy(tmp_path, 'resumed')
+    for k in full:
+        assert torch.equal(full[k], resumed[k])
+
+
+@pytest.mark.parametrize('num_iteration', [4, 5])
+def test_micro_batches_give_full_batch_gradients(num_iteration):
+    batch = {'input': torch.randn(12, 8), 'label': torch.randint(0, 2, (12,))}
+    grads = []
+    for k in [1, num_iteration]:
+        trainer = ToyTrainer({**config.args, 'verbose': False, 'gpus': [], 'num_iteration': k})
+        torch.manual_seed(0)
+        trainer.init_nn()
+        it = trainer.training_iteration(batch)
+        assert len(it['output']) == 12
+        grads.append([p.grad.clone() for p in trainer.nn['model'].parameters()])
+    for full, accumulated in zip(*grads):
+        assert torch.allclose(full, accumulated, atol=1e-6)
+
+
+def test_compare_precision_leaves_models_and_random_state(tmp_path):
+    trainer = ToyTrainer({**config.args, 'verbose': False, 'gpus': [], 'precision': 'bf16'})
+    trainer.init_nn()
+    state = {k: v.clone() for k, v in trainer.nn['model'].state_dict().items()}
+    batch = {'input': torch.randn(4, 8), 'label': torch.tensor([0, 1, 0, 1])}
+    rng = torch.get_rng_state()
+    throughput = trainer.compare_precision(batch, iterations=2)
+    assert set(throughput) == {'fp32', 'bf16', 'speedup'}
+    assert torch.equal(torch.get_rng_state(), rng)
+    assert all(torch.equal(v, state[k]) for k, v in trainer.nn['model'].state_dict().items())
+    assert all(p.grad is None for p in trainer.nn['model'].parameters())
+
+
+def test_training_iteration_without_grad_scaler():
+    trainer = ToyTrainer({**config.args, 'verbose': False, 'gpus': []})
+    trainer.init_nn()
+    trainer.grad_scaler = None
+    before = trainer.nn['model'].weight.clone()
+    trainer.training_iteration({'input': torch.randn(4, 8), 'label': torch.tensor([0, 1, 0, 1])})
+    assert not torch.equal(before, trainer.nn['model'].weight)
+
+
+def test_compile_sets_cache_dir_for_the_fold_only(tmp_path, monkeypatch):
+    monkeypatch.setenv('TORCHINDUCTOR_CACHE_DIR', 'previous')
+    monkeypatch.delenv('TORCHINDUCTOR_FX_GRAPH_CACHE', raising=False)
+    trainer = ToyTrainer({**config.args, 'verbose': False, 'gpus': [], 'compile': True,
+                          'compile_cache_dir': str(tmp_path)})
+    trainer.init_nn()
+    assert os.environ['TORCHINDUCTOR_CACHE_DIR'] == str(tmp_path)
+    assert os.environ['TORCHINDUCTOR_FX_GRAPH_CACHE'] == '1'
+    trainer.close_loaders()
+    assert os.environ['TORCHINDUCTOR_CACHE_DIR'] == 'previous'
+    assert 'TORCHINDUCTOR_FX_GRAPH_CACHE' not in os.environ
+
+
+class PatchDataset(ETDataset):
+    def load_index(self, dataset_name, file):
+        for p in range(3):
+            self.indices.append([dataset_name, file, p])
+
+    def __getitem__(self, index):
+        name, file, p = self.indices[index]
+        if file == 'f1':
+            return None
+        return {'input': torch.full((8,), float(p)), 'label': p % 2}
+
+
+class SavingTrainer(ToyTrainer):
+    def save_predictions(self, dataset, its):
+        self.saved.append(({ix[1] for ix in dataset.indices}, sum(len(it['predictions']) for it in its)))
+
+
+@pytest.mark.parametrize('in_memory', [False, True])
+def test_evaluation_of_sparse_files_with_an_unloadable_file(in_memory):
+    dataset = PatchDataset(in_memory=in_memory)
+    dataset.add_sparse(['f0', 'f1', 'f2', 'f3'], name='toy')
+    trainer = SavingTrainer({**config.args, 'verbose': False, 'gpus': [], 'batch_size': 2, 'num_workers': 0})
+    trainer.init_nn()
+    trainer.saved = []
+    trainer.evaluation(split_key='test', save_pred=True, dataset_list=[dataset])
+    assert trainer.saved == [({'f0'}, 3), ({'f2'}, 3), ({'f3'}, 3)]
@@ -0,0 +1,37 @@
+import easytorch.utils as etutils
+
+
+def _cache(tmp_path, **kw):
+    return {'log_dir': str(tmp_path), 'log_header': 'Loss,F1', **kw}
+
+
+def test_cache_log_round_trip(tmp_path):
+    cache = _cache(tmp_path, training_log=[[1.0, 0.5]], params={('a', 1): 2, 'b': (1, 2)})
+    etutils.reset_cache_log(str(tmp_path), 'fold')
+    etutils.save_cache(cache, experiment_id='fold')
+    cache['training_log'].append([0.5, 0.7])
+    etutils.save_cache(cache, experiment_id='fold')
+
+    loaded = etutils.load_cache(str(tmp_path), 'fold')
+    assert loaded['training_log'] == [[1.0, 0.5], [0.5, 0.7]]
+    assert loaded['params'] == {"('a', 1)": 2, 'b': [1, 2]}
+
+
+def test_cache_log_new_run_keeps_restored_rows_only(tmp_path):
+    etutils.reset_cache_log(str(tmp_path), 'fold')
+    cache = _cache(tmp_path, training_log=[])
+    for row in range(3):
+        cache['training_log'].append([row])
+        etutils.save_cache(cache, experiment_id='fold')
+
+    """Like a resumed run, with the rows of the first two epochs restored from the training state."""
+    etutils.reset_cache_log(str(tmp_path), 'fold')
+    assert etutils.load_cache(str(tmp_path), 'fold')['training_log'] == [[0], [1], [2]]
+    resumed = _cache(tmp_path, training_log=[[0], [1], [5]])
+    etutils.save_cache(resumed, experiment_id='fold')
+    assert etutils.load_cache(str(tmp_path), 'fold')['training_log'] == [[0], [1], [5]]
+
+    """A new run that starts with fewer rows than the previous one wrote."""
+    etutils.reset_cache_log(str(tmp_path), 'fold')
+    etutils.save_cache(_cache(tmp_path, training_log=[[9]]), experiment_id='fold')
+    assert etutils.load_cache(str(tmp_path), 'fold')['training_log'] == [[9]]
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from easytorch.vision import imageutils
+
+
+@pytest.mark.parametrize('channels', [(), (3,)])
+def test_patch_extractor_matches_expand_and_mirror_patch(channels):
+    img = np.arange(23 * 17 * int(np.prod(channels)), dtype=np.int32).reshape((23, 17, *channels))
+    patches = imageutils.PatchExtractor(img, (8, 6), (5, 4), expand_by=(6, 4))
+    out = np.empty((len(patches), *patches[0].shape), dtype=img.dtype)
+    patches.extract(out=out)
+    assert len(patches) == len(imageutils.chunk_indexes(img.shape[:2], (8, 6), (5, 4)))
+    for k, corners in enumerate(patches.indexes):
+        a, b, c, d, pad = imageutils.expand_and_mirror_patch(img.shape[:2], corners, (6, 4))
+        expected = np.pad(img[a:b, c:d], pad + [(0, 0)] * len(channels), 'reflect')
+        assert np.array_equal(out[k], np.moveaxis(expected, (0, 1), (-2, -1)))
+        assert np.array_equal(patches[k], out[k])
+
+
+@pytest.mark.parametrize('blend', ['gaussian', 'linear', 'uniform'])
+@pytest.mark.parametrize('expand_by', [(0, 0), (6, 4)])
+def test_tiled_inference_with_identity_model_reconstructs_input(blend, expand_by):
+    import torch
+    from easytorch.vision.tiling import TiledInference
+
+    img = np.random.default_rng(0).random((23, 17, 3)).astype(np.float32)
+    tiled = TiledInference(lambda x: x, (8, 6), (5, 4), expand_by=expand_by, batch_size=4, blend=blend)
+    out = tiled(img)
+    assert out.shape == (3, 23, 17)
+    assert torch.allclose(out, torch.from_numpy(img).permute(2, 0, 1), atol=1e-5)
+
+
+def test_merge_patches_averages_zeros():
+    patches = np.stack([np.zeros((4, 4)), np.full((4, 4), 200)])
+    merged = imageutils.merge_patches(patches, (4, 6), (4, 4), (4, 3))
+    assert (merged[:, :2] == 0).all()
+    assert (merged[:, 2:4] == 100).all()
+    assert (merged[:, 4:] == 200).all()